@@ -1,7 +1,8 @@
 from fastapi import HTTPException,Request
 from pydantic import BaseModel
 import httpx
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Union
+from utils.http_client import HttpClientPool, get_http_pool
 
 class thread_tiket(BaseModel):
     user_id: str
@@ -29,7 +30,7 @@ class question_ticket_go(BaseModel):
 
 # --- 内部API呼び出しのためのヘルパー関数 (オプション) ---
 async def call_internal_api(
-    client: httpx.AsyncClient,
+    client: Optional[Union[httpx.AsyncClient, HttpClientPool]],
     method: str,
     endpoint: str, # 例: "/db/threads/"
     base_url: str, # 例: "http://localhost:49604"
@@ -40,7 +41,10 @@ async def call_internal_api(
     """
     内部APIを呼び出すための汎用ヘルパー。
     エラーハンドリングを含む。
+    clientにNoneを渡すとアプリ共有のコネクションプールを使う。
     """
+    if client is None:
+        client = get_http_pool()
     try:
         url = f"{base_url}{endpoint}"
         response = await client.request(
@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
+from typing import List, Optional
+import json
 
-from . import crud, models, schemas
-from .db_database import get_db
+from . import crud, models, schemas, search
+from .db_database import get_db, AsyncSessionLocal
 # from ..auth import get_current_active_user # 認証用 (今回は省略)
 
 
@@ -24,6 +26,11 @@ question_router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+search_router = APIRouter(
+    prefix="/search",
+    tags=["db"],
+)
+
 user_router = APIRouter(
     prefix="/users", # このルーターのプレフィックス
     tags=["Users"],  # Swagger UI でのタグ
@@ -50,7 +57,7 @@ async def create_new_thread(
 
     # 次に、リレーションシップを含めて完全にロードされたスレッドオブジェクトを取得して返す
     # これにより、レスポンスモデルのシリアライズ時に遅延読み込みが発生するのを防ぐ
-    db_thread_with_relations = await crud.get_thread(db, thread_id=created_thread_basic_info.id, include_messages=True)
+    db_thread_with_relations = await crud.get_thread(db, thread_id=created_thread_basic_info.id, include_messages=True, message_limit=crud.request_db_contexts_limit)
     if not db_thread_with_relations:
         # 作成直後に見つからないのは通常ありえないが、念のため
         raise HTTPException(status_code=500, detail="Failed to retrieve created thread with details")
@@ -64,7 +71,8 @@ async def read_thread_details(
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user_mock) # 認証済みユーザー
 ):
-    db_thread = await crud.get_thread(db, thread_id=thread_id, include_messages=True)
+    # 全メッセージは読み込まず先頭ページだけを含める (続きは /{thread_id}/messages で取得する)
+    db_thread = await crud.get_thread(db, thread_id=thread_id, include_messages=True, message_limit=crud.request_db_contexts_limit)
     if db_thread is None:
         raise HTTPException(status_code=404, detail="Thread not found")
     # ここで認可チェック: current_userがこのスレッドを閲覧する権限があるか
@@ -73,6 +81,68 @@ async def read_thread_details(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
     return db_thread
 
+
+@thread_router.get("/", response_model=schemas.ThreadPage)
+async def read_my_threads(
+    limit: int = Query(default=20, ge=1, le=crud.request_db_contexts_limit),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_mock)
+):
+    """自分のスレッドを新しい順にカーソルでページングして返す"""
+    try:
+        threads, next_cursor = await crud.get_user_threads_page(db, user_id=current_user.id, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return schemas.ThreadPage(items=threads, next_cursor=next_cursor)
+
+
+async def _get_readable_thread(db: AsyncSession, thread_id: str, current_user: models.User) -> models.Thread:
+    db_thread = await crud.get_thread(db, thread_id=thread_id)
+    if db_thread is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    if db_thread.owner_user_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+    return db_thread
+
+
+@thread_router.get("/{thread_id}/messages", response_model=schemas.MessagePage)
+async def read_thread_messages(
+    thread_id: str,
+    limit: int = Query(default=50, ge=1, le=crud.request_db_contexts_limit),
+    cursor: Optional[str] = None,
+    newest_first: bool = False,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_mock)
+):
+    """スレッドのメッセージをカーソルでページングして返す"""
+    await _get_readable_thread(db, thread_id, current_user)
+    try:
+        messages, next_cursor = await crud.get_messages_for_thread_page(
+            db, thread_id=thread_id, limit=limit, cursor=cursor, descending=newest_first
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return schemas.MessagePage(items=messages, next_cursor=next_cursor)
+
+
+@thread_router.get("/{thread_id}/messages/stream")
+async def stream_thread_messages(
+    thread_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_mock)
+):
+    """スレッドの全メッセージを時系列順にNDJSON (1行1メッセージ) で返す。長いスレッドでもメモリ使用量は一定"""
+    await _get_readable_thread(db, thread_id, current_user)
+
+    async def generate_ndjson():
+        # レスポンスの送信中も使うので、依存関係のセッションとは別に開く
+        async with AsyncSessionLocal() as stream_db:
+            async for row in crud.stream_messages_for_thread(stream_db, thread_id):
+                yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+
+    return StreamingResponse(generate_ndjson(), media_type="application/x-ndjson")
+
 @thread_router.post("/{thread_id}/messages/", response_model=schemas.Message, status_code=status.HTTP_201_CREATED)
 async def add_message_to_thread(
     thread_id: str,
@@ -316,9 +386,27 @@ async def remove_user(
     return db_user # または status_code=204 でボディなし
 
 
+# Search API
+
+@search_router.get("/", response_model=schemas.SearchResult)
+async def search_my_data(
+    q: str,
+    kind: Optional[List[str]] = Query(default=None), # message / episode / person_data (省略時はすべて)
+    limit: int = Query(default=20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_mock)
+):
+    """自分のメッセージ・エピソード・人物データを全文検索する"""
+    try:
+        hits = await search.search(db, q, user_id=current_user.id, kinds=kind, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return schemas.SearchResult(query=q, items=hits)
+
 
 
 # deploy
 router.include_router(question_router)
 router.include_router(thread_router)
-router.include_router(user_router)
\ No newline at end of file
+router.include_router(user_router)
+router.include_router(search_router)
\ No newline at end of file
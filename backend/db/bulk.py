@@ -0,0 +1,457 @@
+# app/bulk.py
+"""
+会話・エピソード・Person Dataの一括インポート/エクスポート
+
+JSONL (1行1レコード) とParquet (pyarrowがインストールされている場合) に対応する
+- 入出力はchunk_size件ずつストリーミングし、件数によらずメモリ使用量は一定
+- インポートはチャンクごとに executemany で1トランザクションにまとめ、
+  読み込み位置 (チェックポイント) も同じトランザクションでDBに保存する。中断しても続きから再開できる
+- 主キーが重複するレコードは無視するので、同じファイルを再実行しても二重に登録されない
+
+使い方:
+    python -m db.bulk export messages messages.jsonl
+    python -m db.bulk import messages messages.jsonl --chunk-size 5000
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import Boolean, DateTime, Float, Integer, JSON, select, Table
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+import db_manager
+from . import models
+from .db_database import DATABASE_URL
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquetを使わないならpyarrowは不要
+    pa = None
+    pq = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5000
+
+CHECKPOINT_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS bulk_checkpoints (
+        checkpoint_key TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        rows INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+'''
+CHECKPOINT_UPSERT_SQL = '''
+    INSERT INTO bulk_checkpoints (checkpoint_key, position, rows, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(checkpoint_key) DO UPDATE SET
+        position = excluded.position, rows = excluded.rows, updated_at = excluded.updated_at
+'''
+
+
+@dataclass(frozen=True)
+class BulkTable:
+    """一括処理の対象テーブル。columnsは (列名, 種類) で、種類は int/float/bool/str/datetime/json"""
+    name: str
+    key: str
+    columns: Tuple[Tuple[str, str], ...]
+    table: Optional[Table] = None  # Noneならdb_manager (conversation_history) 側のテーブル
+
+
+@dataclass
+class BulkProgress:
+    table: str
+    rows: int
+    position: int
+    total: Optional[int]
+    elapsed: float
+
+    @property
+    def fraction(self) -> Optional[float]:
+        return self.position / self.total if self.total else None
+
+
+ProgressCallback = Callable[[BulkProgress], None]
+
+
+def _column_kind(column) -> str:
+    if isinstance(column.type, JSON):
+        return 'json'
+    if isinstance(column.type, DateTime):
+        return 'datetime'
+    if isinstance(column.type, Boolean):
+        return 'bool'
+    if isinstance(column.type, Integer):
+        return 'int'
+    if isinstance(column.type, Float):
+        return 'float'
+    return 'str'
+
+
+def _from_model(name: str, model) -> BulkTable:
+    table = model.__table__
+    return BulkTable(
+        name=name,
+        key=list(table.primary_key.columns)[0].name,
+        columns=tuple((column.name, _column_kind(column)) for column in table.columns),
+        table=table,
+    )
+
+
+BULK_TABLES: Dict[str, BulkTable] = {
+    'messages': _from_model('messages', models.Message),
+    'episodes': _from_model('episodes', models.Episode),
+    'person_data_entries': _from_model('person_data_entries', models.PersonDataEntry),
+    'conversation_history': BulkTable(
+        name='conversation_history',
+        key='message_id',
+        columns=(('message_id', 'int'), ('user_id', 'int'), ('role', 'str'), ('content', 'str'), ('timestamp', 'str'),
+                 ('token_count', 'int')),
+    ),
+}
+
+
+# region レコードの変換
+def _encode(spec: BulkTable, row: Dict[str, Any], fmt: str) -> Dict[str, Any]:
+    """DBの行を出力用のレコードにする (日時はISO形式、ParquetではJSON列を文字列にする)"""
+    record = {}
+    for name, kind in spec.columns:
+        value = row.get(name)
+        if value is not None:
+            if kind == 'datetime' and isinstance(value, (datetime.datetime, datetime.date)):
+                value = value.isoformat()
+            elif kind == 'json' and fmt == 'parquet':
+                value = json.dumps(value, ensure_ascii=False)
+        record[name] = value
+    return record
+
+
+def _decode(spec: BulkTable, record: Dict[str, Any], fmt: str) -> Dict[str, Any]:
+    """入力レコードをDBに書き込む値にする。テーブルにない列は無視する"""
+    row = {}
+    for name, kind in spec.columns:
+        if name not in record:
+            continue
+        value = record[name]
+        if value is not None:
+            if kind == 'datetime' and isinstance(value, str):
+                value = datetime.datetime.fromisoformat(value)
+            elif kind == 'json' and fmt == 'parquet' and isinstance(value, str):
+                value = json.loads(value)
+        row[name] = value
+    return row
+
+
+def _arrow_schema(spec: BulkTable):
+    types = {'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_()}
+    return pa.schema([(name, types.get(kind, pa.string())) for name, kind in spec.columns])
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise RuntimeError("Parquet support requires pyarrow (pip install pyarrow)")
+
+
+def _detect_format(path: str, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    return 'parquet' if path.endswith(('.parquet', '.pq')) else 'jsonl'
+# endregion
+
+
+# region 入力の読み込み (チャンク単位)
+def _read_jsonl_chunk(path: str, offset: int, chunk_size: int) -> Tuple[List[Dict[str, Any]], int]:
+    """offsetバイト目からchunk_size件読み、(レコード, 次のoffset) を返す"""
+    records = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while len(records) < chunk_size:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                records.append(json.loads(line))
+        return records, f.tell()
+
+
+def _iter_parquet_batches(path: str, start_batch: int, chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    parquet_file = pq.ParquetFile(path)
+    for index, batch in enumerate(parquet_file.iter_batches(batch_size=chunk_size)):
+        if index >= start_batch:
+            yield batch.to_pylist()
+# endregion
+
+
+# region チェックポイント
+def checkpoint_key(spec: BulkTable, source: str) -> str:
+    return f"import:{spec.name}:{os.path.abspath(source)}"
+
+
+async def _load_checkpoint(engine: Optional[AsyncEngine], sqlite_path: str, spec: BulkTable, key: str) -> Tuple[int, int]:
+    """(position, rows) を返す。なければ (0, 0)"""
+    if spec.table is None:
+        pool = db_manager.get_database_pool(sqlite_path)
+        await pool.run_write(lambda conn: conn.execute(CHECKPOINT_TABLE_SQL))
+        row = await pool.fetchone('SELECT position, rows FROM bulk_checkpoints WHERE checkpoint_key = ?', (key,))
+    else:
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql(CHECKPOINT_TABLE_SQL)
+            result = await conn.exec_driver_sql(
+                'SELECT position, rows FROM bulk_checkpoints WHERE checkpoint_key = ?', (key,)
+            )
+            row = result.first()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+async def clear_checkpoint(spec: BulkTable, source: str, engine: Optional[AsyncEngine] = None, sqlite_path: str = db_manager.DATABASE) -> None:
+    """チェックポイントを消して、次回は最初からインポートし直す"""
+    key = checkpoint_key(spec, source)
+    if spec.table is None:
+        pool = db_manager.get_database_pool(sqlite_path)
+        await pool.run_write(lambda conn: conn.execute(CHECKPOINT_TABLE_SQL))
+        await pool.execute('DELETE FROM bulk_checkpoints WHERE checkpoint_key = ?', (key,))
+    else:
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql(CHECKPOINT_TABLE_SQL)
+            await conn.exec_driver_sql('DELETE FROM bulk_checkpoints WHERE checkpoint_key = ?', (key,))
+# endregion
+
+
+# region 書き込み
+def _group_by_columns(rows: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """executemanyは全行で同じ列が必要なので、列の組み合わせごとに分ける (列の省略時はDBのデフォルト値を使う)"""
+    groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(tuple(row), []).append(row)
+    return list(groups.values())
+
+
+async def _write_sqlalchemy_chunk(engine: AsyncEngine, spec: BulkTable, rows: List[Dict[str, Any]], key: str, position: int, total_rows: int) -> None:
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    async with engine.begin() as conn:
+        for group in _group_by_columns(rows):
+            await conn.execute(sqlite_insert(spec.table).on_conflict_do_nothing(), group)
+        await conn.exec_driver_sql(CHECKPOINT_UPSERT_SQL, (key, position, total_rows, now))
+
+
+async def _write_conversation_chunk(sqlite_path: str, rows: List[Dict[str, Any]], key: str, position: int, total_rows: int) -> None:
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def _write(conn) -> None:
+        for group in _group_by_columns(rows):
+            columns = list(group[0])
+            conn.executemany(
+                f"INSERT OR IGNORE INTO conversation_history ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [tuple(row[column] for column in columns) for row in group]
+            )
+        conn.execute(CHECKPOINT_UPSERT_SQL, (key, position, total_rows, now))
+
+    await db_manager.get_database_pool(sqlite_path).run_write(_write)
+# endregion
+
+
+async def import_records(
+    table_name: str,
+    source: str,
+    engine: Optional[AsyncEngine] = None,
+    sqlite_path: str = db_manager.DATABASE,
+    fmt: Optional[str] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    resume: bool = True,
+    progress: Optional[ProgressCallback] = None
+) -> int:
+    """
+    JSONL/Parquetファイルをテーブルに一括登録し、今回登録を試みた件数を返す
+    resume=Trueなら前回のチェックポイントの続きから読む
+    conversation_historyはsqlite_path (db_manager側のDB) 、それ以外はengineのDBに書き込む
+    """
+    spec = BULK_TABLES[table_name]
+    fmt = _detect_format(source, fmt)
+    if fmt == 'parquet':
+        _require_pyarrow()
+    if spec.table is not None and engine is None:
+        raise ValueError(f"engine is required to import {table_name}")
+    key = checkpoint_key(spec, source)
+
+    position, total_rows = await _load_checkpoint(engine, sqlite_path, spec, key) if resume else (0, 0)
+    if position:
+        logger.info(f"Resuming import of {source} into {table_name} from position {position} ({total_rows} rows done)")
+    imported = 0
+    started = time.monotonic()
+    total = os.path.getsize(source) if fmt == 'jsonl' else -(-pq.ParquetFile(source).metadata.num_rows // chunk_size)
+
+    async def _write(records: List[Dict[str, Any]], next_position: int) -> None:
+        nonlocal imported, total_rows
+        rows = [_decode(spec, record, fmt) for record in records]
+        total_rows += len(rows)
+        if spec.table is None:
+            await _write_conversation_chunk(sqlite_path, rows, key, next_position, total_rows)
+        else:
+            await _write_sqlalchemy_chunk(engine, spec, rows, key, next_position, total_rows)
+        imported += len(rows)
+        report = BulkProgress(table_name, total_rows, next_position, total, time.monotonic() - started)
+        logger.info(f"Imported {total_rows} rows into {table_name} ({imported / max(report.elapsed, 1e-9):.0f} rows/s)")
+        if progress is not None:
+            progress(report)
+
+    if fmt == 'jsonl':
+        while True:
+            records, next_position = await asyncio.to_thread(_read_jsonl_chunk, source, position, chunk_size)
+            if not records:
+                break
+            await _write(records, next_position)
+            position = next_position
+    else:
+        # Parquetはバッチ番号をチェックポイントにする
+        batches = _iter_parquet_batches(source, position, chunk_size)
+        while True:
+            records = await asyncio.to_thread(next, batches, None)
+            if records is None:
+                break
+            position += 1
+            await _write(records, position)
+    return imported
+
+
+# region エクスポート
+async def _iter_sqlalchemy_rows(engine: AsyncEngine, spec: BulkTable, after: Any, chunk_size: int):
+    query = select(spec.table).order_by(spec.table.c[spec.key])
+    if after is not None:
+        query = query.where(spec.table.c[spec.key] > after)
+    async with engine.connect() as conn:
+        result = await conn.stream(query.execution_options(yield_per=chunk_size))
+        async for partition in result.mappings().partitions(chunk_size):
+            yield [dict(row) for row in partition]
+
+
+async def _iter_conversation_rows(sqlite_path: str, after: Any, chunk_size: int):
+    # キーセットページングで chunk_size 件ずつ読む
+    pool = db_manager.get_database_pool(sqlite_path)
+    columns = ', '.join(name for name, _ in BULK_TABLES['conversation_history'].columns)
+    last = after if after is not None else -1
+    while True:
+        rows = await pool.fetchall(
+            f'SELECT {columns} FROM conversation_history WHERE message_id > ? ORDER BY message_id LIMIT ?',
+            (last, chunk_size)
+        )
+        if not rows:
+            return
+        yield [dict(row) for row in rows]
+        last = rows[-1]['message_id']
+
+
+def _export_checkpoint_path(destination: str) -> str:
+    return destination + '.checkpoint'
+
+
+async def export_records(
+    table_name: str,
+    destination: str,
+    engine: Optional[AsyncEngine] = None,
+    sqlite_path: str = db_manager.DATABASE,
+    fmt: Optional[str] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    resume: bool = True,
+    progress: Optional[ProgressCallback] = None
+) -> int:
+    """
+    テーブルを主キー順にJSONL/Parquetへ書き出し、今回書き出した件数を返す
+    JSONLはチャンクごとに <出力先>.checkpoint に最後の主キーを記録し、resume=Trueならその続きから追記する
+    """
+    spec = BULK_TABLES[table_name]
+    fmt = _detect_format(destination, fmt)
+    if spec.table is not None and engine is None:
+        raise ValueError(f"engine is required to export {table_name}")
+
+    checkpoint_path = _export_checkpoint_path(destination)
+    after, total_rows, size = None, 0, 0
+    if fmt == 'jsonl' and resume and os.path.exists(checkpoint_path) and os.path.exists(destination):
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        after, total_rows, size = checkpoint['last_key'], checkpoint['rows'], checkpoint['bytes']
+        logger.info(f"Resuming export of {table_name} to {destination} after key {after} ({total_rows} rows done)")
+
+    if spec.table is None:
+        chunks = _iter_conversation_rows(sqlite_path, after, chunk_size)
+    else:
+        chunks = _iter_sqlalchemy_rows(engine, spec, after, chunk_size)
+
+    exported = 0
+    started = time.monotonic()
+    if fmt == 'parquet':
+        _require_pyarrow()
+        schema = _arrow_schema(spec)
+        writer = pq.ParquetWriter(destination, schema)
+        try:
+            async for rows in chunks:
+                records = [_encode(spec, row, fmt) for row in rows]
+                await asyncio.to_thread(writer.write_table, pa.Table.from_pylist(records, schema=schema))
+                exported += len(records)
+                if progress is not None:
+                    progress(BulkProgress(table_name, exported, exported, None, time.monotonic() - started))
+        finally:
+            writer.close()
+        return exported
+
+    with open(destination, 'r+b' if size else 'wb') as f:
+        # 前回のチェックポイント以降に書きかけた分は捨てる
+        f.truncate(size)
+        f.seek(size)
+        async for rows in chunks:
+            lines = b''.join(
+                json.dumps(_encode(spec, row, fmt), ensure_ascii=False).encode('utf-8') + b'\n' for row in rows
+            )
+            await asyncio.to_thread(f.write, lines)
+            f.flush()
+            exported += len(rows)
+            total_rows += len(rows)
+            checkpoint = {'last_key': rows[-1][spec.key], 'rows': total_rows, 'bytes': f.tell()}
+            with open(checkpoint_path, 'w', encoding='utf-8') as cp:
+                json.dump(checkpoint, cp)
+            logger.info(f"Exported {total_rows} rows from {table_name}")
+            if progress is not None:
+                progress(BulkProgress(table_name, total_rows, total_rows, None, time.monotonic() - started))
+    # 最後まで書き出せたらチェックポイントは不要
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return exported
+# endregion
+
+
+async def _main(args: argparse.Namespace) -> None:
+    engine = create_async_engine(args.database_url) if args.table != 'conversation_history' else None
+    try:
+        if args.command == 'import':
+            if not args.resume:
+                await clear_checkpoint(BULK_TABLES[args.table], args.path, engine, args.sqlite_path)
+            count = await import_records(args.table, args.path, engine, args.sqlite_path, args.format, args.chunk_size, args.resume)
+        else:
+            count = await export_records(args.table, args.path, engine, args.sqlite_path, args.format, args.chunk_size, args.resume)
+        print(f"{args.command}: {count} rows ({args.table})")
+    finally:
+        if engine is not None:
+            await engine.dispose()
+        await db_manager.close_database_pools()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="会話・エピソード・Person Dataの一括インポート/エクスポート")
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('table', choices=list(BULK_TABLES))
+    parser.add_argument('path', help="入力/出力ファイル (.jsonl / .parquet)")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default=None)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help="チェックポイントを無視して最初から処理する")
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--sqlite-path', default=db_manager.DATABASE, help="conversation_historyのDB (db_manager)")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
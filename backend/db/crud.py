@@ -2,16 +2,22 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select # SQLAlchemy 1.4以降の非同期select
 from sqlalchemy.orm import selectinload # リレーションを効率的にロードするため
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import String, tuple_, type_coerce
 
 from . import models, schemas
 from typing import Optional
+import base64
+import json
 import uuid # thread_id生成用など
 import datetime
-from typing import Optional,List 
+from typing import Any, AsyncIterator, Dict, Optional, List, Tuple
 
 
 # Config
 request_db_contexts_limit = 100 
+# NDJSONストリーミングでDBから1回に取り出す行数
+stream_fetch_size = 500
 
 
 # --- User CRUD ---
@@ -203,9 +209,48 @@ async def create_thread(db: AsyncSession, thread_data: schemas.ThreadCreate, own
     # return loaded_thread if loaded_thread else db_thread # loaded_thread が取得できればそれを使う    
 
 
-async def get_thread(db: AsyncSession, thread_id: str, include_messages: bool = False):
+# --- Keyset pagination ---
+# カーソルは最後に返した行の (timestamp, id) 。timestampはDBに保存されている文字列のまま比較し、
+# (owner_user_id|thread_id, timestamp, id) の複合インデックスをそのまま使えるようにする
+def encode_cursor(timestamp_raw: str, row_id: Any) -> str:
+    payload = json.dumps([timestamp_raw, row_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, Any]:
+    """不正なカーソルはValueError"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp_raw, row_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return timestamp_raw, row_id
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+async def _keyset_page(db: AsyncSession, model, filter_clause, limit: int, cursor: Optional[str], descending: bool):
+    """(timestamp, id) 順に limit 件と次ページのカーソルを返す。OFFSETを使わないので深いページでも速度が落ちない"""
+    timestamp_raw = type_coerce(model.timestamp, String)
+    query = select(model, timestamp_raw.label("timestamp_raw")).filter(filter_clause)
+    if cursor is not None:
+        after_timestamp, after_id = decode_cursor(cursor)
+        key = tuple_(timestamp_raw, model.id)
+        after = tuple_(type_coerce(after_timestamp, String), after_id)
+        query = query.filter(key < after if descending else key > after)
+    if descending:
+        query = query.order_by(model.timestamp.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.timestamp, model.id)
+    # 1件多く取って次のページがあるかを判定する
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp_raw, rows[-1][0].id)
+    return [row[0] for row in rows], next_cursor
+
+
+async def get_thread(db: AsyncSession, thread_id: str, include_messages: bool = False, message_limit: Optional[int] = None):
+    """include_messages=Trueなら古い順に最大message_limit件 (Noneなら全件) のメッセージも読み込む"""
     query = select(models.Thread).filter(models.Thread.id == thread_id)
-    if include_messages:
+    if include_messages and message_limit is None:
         # N+1問題を避けるためにselectinloadを使う
         query = query.options(
             selectinload(models.Thread.messages).options(
@@ -213,7 +258,12 @@ async def get_thread(db: AsyncSession, thread_id: str, include_messages: bool =
                     )
                 )
     result = await db.execute(query)
-    return result.scalars().first()
+    thread = result.scalars().first()
+    if thread is not None and include_messages and message_limit is not None:
+        # 全件を読み込まず、先頭ページだけを (遅延読み込みを起こさないように) セットする
+        messages, _ = await _keyset_page(db, models.Message, models.Message.thread_id == thread_id, message_limit, None, False)
+        set_committed_value(thread, "messages", messages)
+    return thread
 
 async def get_user_threads(db: AsyncSession, user_id: str, skip: int = 0, limit: int = request_db_contexts_limit):
     result = await db.execute(
@@ -224,6 +274,16 @@ async def get_user_threads(db: AsyncSession, user_id: str, skip: int = 0, limit:
     )
     return result.scalars().all()
 
+async def get_user_threads_page(
+    db: AsyncSession,
+    user_id: str,
+    limit: int = request_db_contexts_limit,
+    cursor: Optional[str] = None,
+    descending: bool = True
+) -> Tuple[List[models.Thread], Optional[str]]:
+    """ユーザーのスレッドをカーソルでページングして返す (既定は新しい順)"""
+    return await _keyset_page(db, models.Thread, models.Thread.owner_user_id == user_id, limit, cursor, descending)
+
 
 # --- Message CRUD ---
 async def create_message(db: AsyncSession, message_data: schemas.MessageCreate, thread_id: str) -> models.Message:
@@ -277,6 +337,33 @@ async def get_messages_for_thread(db: AsyncSession, thread_id: str, skip: int =
     )
     return result.scalars().all()
 
+async def get_messages_for_thread_page(
+    db: AsyncSession,
+    thread_id: str,
+    limit: int = request_db_contexts_limit,
+    cursor: Optional[str] = None,
+    descending: bool = False
+) -> Tuple[List[models.Message], Optional[str]]:
+    """スレッドのメッセージをカーソルでページングして返す (既定は時系列順)"""
+    return await _keyset_page(db, models.Message, models.Message.thread_id == thread_id, limit, cursor, descending)
+
+async def stream_messages_for_thread(db: AsyncSession, thread_id: str) -> AsyncIterator[Dict[str, Any]]:
+    """
+    スレッドのメッセージを時系列順に1行ずつ返す
+    サーバーサイドカーソルからstream_fetch_size件ずつ取り出すので、メッセージ数によらずメモリ使用量は一定
+    ORMオブジェクトやsenderは作らず、列の値だけを返す
+    """
+    table = models.Message.__table__
+    query = (
+        select(table)
+        .filter(table.c.thread_id == thread_id)
+        .order_by(table.c.timestamp, table.c.id)
+        .execution_options(yield_per=stream_fetch_size)
+    )
+    result = await db.stream(query)
+    async for row in result.mappings():
+        yield dict(row)
+
 
 # --- Feedback CRUD ---
 async def create_feedback(db: AsyncSession, feedback_data: schemas.FeedbackCreate, user_id: str) -> models.Feedback:
@@ -396,6 +483,25 @@ async def update_question_status( # ★★★ この関数 ★★★
     return db_question
 
 
+# --- Person Data CRUD ---
+async def get_person_data_version(db: AsyncSession, user_id: str) -> int:
+    """PersonDataEntryが変わるたびに増えるバージョン (一度も変更されていなければ0)"""
+    version = await db.scalar(
+        select(models.PersonDataVersion.version).filter(models.PersonDataVersion.user_id == user_id)
+    )
+    return version or 0
+
+async def get_person_data_source(db: AsyncSession, user_id: str) -> Tuple[int, List[models.PersonDataEntry]]:
+    """人格スナップショット用に (PersonDataEntryのバージョン, 有効なエントリ) を返す"""
+    version = await get_person_data_version(db, user_id)
+    result = await db.execute(
+        select(models.PersonDataEntry)
+        .filter(models.PersonDataEntry.user_id == user_id, models.PersonDataEntry.status == "active")
+        .order_by(models.PersonDataEntry.tag_name, models.PersonDataEntry.id)
+    )
+    return version, list(result.scalars().all())
+
+
 # --- User CRUD ---
 
 # (オプション) パスワードハッシュ化のための設定
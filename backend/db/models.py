@@ -1,5 +1,5 @@
 # app/models.py
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, CheckConstraint, Text, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, CheckConstraint, Text, Boolean, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.sqlite import JSON
 from sqlalchemy.sql import func
@@ -62,6 +62,8 @@ class Thread(Base):
 
     __table_args__ = (
         CheckConstraint(mode.in_(['chat', 'search']), name='thread_mode_check'), # 制約名を具体的に
+        # ユーザーのスレッド一覧のキーセットページング用 (owner_user_id, timestamp, id)
+        Index('ix_thread_owner_timestamp_id', 'owner_user_id', 'timestamp', 'id'),
     )
 
 class Message(Base):
@@ -90,6 +92,8 @@ class Message(Base):
 
     __table_args__ = (
         CheckConstraint(role.in_(['system', 'user', 'assistant', 'ai_question']), name='message_role_check'), # 制約名を具体的に
+        # スレッド内メッセージのキーセットページング用 (thread_id, timestamp, id)
+        Index('ix_message_thread_timestamp_id', 'thread_id', 'timestamp', 'id'),
     )
 
 class Feedback(Base):
@@ -234,6 +238,14 @@ class PersonDataEntry(Base):
         back_populates="person_data_entries"
     )
 
+# PersonDataEntryが変わるたびに増えるバージョン (人格スナップショットの作り直しの判定に使う)
+# 値はトリガーで更新する (create_person_data_version_triggers)
+class PersonDataVersion(Base):
+    __tablename__ = "person_data_versions"
+
+    user_id = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
 # initの管理用のもの
 # 初期化質問管理用の新規モデル
 class InitializationQuestion(Base):
@@ -293,4 +305,23 @@ class AIEvaluationLog(Base):
     processing_time_ms = Column(Integer, nullable=True)
     model_version = Column(String, nullable=True)
     
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+def create_missing_indexes(connection) -> None:
+    """create_allは既存のテーブルにインデックスを追加しないので、後から定義したインデックスをここで作る"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def create_person_data_version_triggers(connection) -> None:
+    """person_data_entries の変更で person_data_versions を進めるトリガーを作る (run_sync から呼ぶ)"""
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        connection.exec_driver_sql(f"""
+            CREATE TRIGGER IF NOT EXISTS person_data_version_{event.lower()}
+            AFTER {event} ON person_data_entries BEGIN
+                INSERT INTO person_data_versions (user_id, version) VALUES ({row}.user_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+            END
+        """)
@@ -73,6 +73,46 @@ class ThreadCreate(ThreadBase):
     # initial_message_context: Optional[str] = None
     pass
 
+# --- Pagination Schemas ---
+# next_cursor を次のリクエストの cursor に渡すと続きを取得できる (最後のページでは None)
+class MessageListItem(MessageBase):
+    id: int
+    thread_id: str
+    sender_user_id: Optional[str] = None
+    timestamp: datetime.datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class MessagePage(BaseModel):
+    items: List[MessageListItem]
+    next_cursor: Optional[str] = None
+
+class ThreadListItem(ThreadBase):
+    id: str
+    owner_user_id: str
+    timestamp: datetime.datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class ThreadPage(BaseModel):
+    items: List[ThreadListItem]
+    next_cursor: Optional[str] = None
+
+
+# --- Search Schemas ---
+class SearchHit(BaseModel):
+    kind: str # "message" | "episode" | "person_data"
+    ref_id: str
+    thread_id: Optional[str] = None
+    snippet: str
+    score: float # BM25 (大きいほどよく一致)
+
+    model_config = ConfigDict(from_attributes=True)
+
+class SearchResult(BaseModel):
+    query: str
+    items: List[SearchHit]
+
 
 class Thread(ThreadBase):
     id: str
@@ -0,0 +1,211 @@
+# db/search.py
+# Message / Episode / PersonDataEntry を横断する全文検索 (SQLite FTS5)
+import logging
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# 日本語は単語区切りがないので trigram (3文字N-gram) でトークン化する
+SEARCH_TOKENIZER = "trigram"
+# trigram で索引を引ける最短の語の長さ (これより短い語は LIKE で絞り込む)
+MIN_MATCH_TERM_LENGTH = 3
+SNIPPET_TOKENS = 16
+
+# kind -> 索引の元になるテーブルと本文の取り出し方
+# body/user_id/thread_id はトリガー内で使うので NEW/OLD ではなく "src" を別名にしたSQL式で書く
+# columns はこれらが変わったときだけ索引を更新するための列
+SEARCH_SOURCES = {
+    "message": {
+        "table": '"Message"',
+        "ref_id": "src.id",
+        "user_id": '(SELECT owner_user_id FROM "Thread" WHERE id = src.thread_id)',
+        "thread_id": "src.thread_id",
+        "body": "src.context",
+        "columns": "context, thread_id",
+    },
+    "episode": {
+        "table": "episodes",
+        "ref_id": "src.id",
+        "user_id": "src.user_id",
+        "thread_id": "src.thread_id",
+        "body": "src.text_content",
+        "columns": "text_content, user_id, thread_id",
+    },
+    "person_data": {
+        "table": "person_data_entries",
+        "ref_id": "src.id",
+        "user_id": "src.user_id",
+        "thread_id": "NULL",
+        # JSONは \uXXXX でエスケープされて保存されるので、文字列の値だけを取り出して索引にする
+        "body": "(SELECT group_concat(value, ' ') FROM json_tree(src.entry_content) WHERE type = 'text')",
+        "columns": "entry_content, user_id",
+    },
+}
+
+
+@dataclass
+class SearchHit:
+    kind: str
+    ref_id: str
+    user_id: Optional[str]
+    thread_id: Optional[str]
+    snippet: str
+    score: float
+
+
+def _for_row(expression: str, alias: str) -> str:
+    return expression.replace("src.", f"{alias}.")
+
+
+def _trigger_sql(kind: str) -> List[str]:
+    source = SEARCH_SOURCES[kind]
+    table = source["table"]
+
+    def insert(alias: str) -> str:
+        return f"""
+            INSERT INTO search_docs (kind, ref_id, user_id, thread_id)
+            VALUES ('{kind}', {_for_row(source['ref_id'], alias)}, {_for_row(source['user_id'], alias)}, {_for_row(source['thread_id'], alias)});
+            INSERT INTO search_fts (rowid, body)
+            VALUES (last_insert_rowid(), coalesce({_for_row(source['body'], alias)}, ''));
+        """
+
+    def delete(alias: str) -> str:
+        return f"""
+            DELETE FROM search_fts WHERE rowid =
+                (SELECT doc_id FROM search_docs WHERE kind = '{kind}' AND ref_id = {_for_row(source['ref_id'], alias)});
+            DELETE FROM search_docs WHERE kind = '{kind}' AND ref_id = {_for_row(source['ref_id'], alias)};
+        """
+
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS search_{kind}_ai AFTER INSERT ON {table} BEGIN {insert('NEW')} END",
+        f"CREATE TRIGGER IF NOT EXISTS search_{kind}_ad AFTER DELETE ON {table} BEGIN {delete('OLD')} END",
+        f"CREATE TRIGGER IF NOT EXISTS search_{kind}_au AFTER UPDATE OF {source['columns']} ON {table} BEGIN {delete('OLD')} {insert('NEW')} END",
+    ]
+
+
+def rebuild_search_index(connection) -> None:
+    """索引を元テーブルから作り直す (run_sync から呼ぶ)"""
+    connection.exec_driver_sql("DELETE FROM search_fts")
+    connection.exec_driver_sql("DELETE FROM search_docs")
+    for kind, source in SEARCH_SOURCES.items():
+        connection.exec_driver_sql(f"""
+            INSERT INTO search_docs (kind, ref_id, user_id, thread_id)
+            SELECT '{kind}', {source['ref_id']}, {source['user_id']}, {source['thread_id']} FROM {source['table']} AS src
+        """)
+        connection.exec_driver_sql(f"""
+            INSERT INTO search_fts (rowid, body)
+            SELECT d.doc_id, coalesce({source['body']}, '')
+            FROM {source['table']} AS src
+            JOIN search_docs d ON d.kind = '{kind}' AND d.ref_id = {source['ref_id']}
+        """)
+    logger.info("Search index rebuilt.")
+
+
+def create_search_index(connection) -> None:
+    """
+    全文検索用のテーブルとトリガーを作る (run_sync から呼ぶ)
+    索引は元テーブルのトリガーで更新されるので、初めて作ったときだけ既存の行から作る
+    """
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_fts'"
+    ).first()
+    # search_docs は元の行と索引の行 (rowid) の対応表。利用者やkindでの絞り込みもここで行う
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS search_docs (
+            doc_id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            ref_id TEXT NOT NULL,
+            user_id TEXT,
+            thread_id TEXT,
+            UNIQUE (kind, ref_id)
+        )
+    """)
+    connection.exec_driver_sql(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(body, tokenize = '{SEARCH_TOKENIZER}')
+    """)
+    for kind in SEARCH_SOURCES:
+        for statement in _trigger_sql(kind):
+            connection.exec_driver_sql(statement)
+    if not exists:
+        rebuild_search_index(connection)
+
+
+def build_match_query(query: str) -> tuple[Optional[str], List[str]]:
+    """
+    検索文字列を FTS5 の MATCH 式と、trigram では引けない短い語のリストに分ける
+    語はすべてフレーズとして扱うので、利用者の入力が FTS5 の演算子として解釈されることはない
+    """
+    phrases = []
+    short_terms = []
+    for term in query.split():
+        if len(term) >= MIN_MATCH_TERM_LENGTH:
+            phrases.append('"' + term.replace('"', '""') + '"')
+        else:
+            short_terms.append(term)
+    return (" AND ".join(phrases) or None), short_terms
+
+
+async def search(
+    db: AsyncSession,
+    query: str,
+    user_id: Optional[str] = None,
+    kinds: Optional[Sequence[str]] = None,
+    limit: int = 20,
+) -> List[SearchHit]:
+    """全文検索してBM25のスコア順 (よく一致したもの順) にヒットを返す"""
+    match, short_terms = build_match_query(query)
+    if match is None and not short_terms:
+        return []
+
+    conditions = []
+    params = {"limit": limit}
+    if match is not None:
+        conditions.append("search_fts MATCH :match")
+        params["match"] = match
+    for i, term in enumerate(short_terms):
+        # 2文字以下の語は索引を使えないので、MATCHで絞り込んだ結果に対して LIKE で確認する
+        escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append(f"search_fts.body LIKE :short_{i} ESCAPE '\\'")
+        params[f"short_{i}"] = f"%{escaped}%"
+    if user_id is not None:
+        conditions.append("d.user_id = :user_id")
+        params["user_id"] = str(user_id)
+    if kinds:
+        unknown = set(kinds) - SEARCH_SOURCES.keys()
+        if unknown:
+            raise ValueError(f"Unknown search kinds: {sorted(unknown)}")
+        conditions.append("d.kind IN (" + ", ".join(f":kind_{i}" for i in range(len(kinds))) + ")")
+        params.update({f"kind_{i}": kind for i, kind in enumerate(kinds)})
+
+    if match is not None:
+        select_score = f"snippet(search_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}), bm25(search_fts)"
+        order_by = "bm25(search_fts)"
+    else:
+        # MATCHがないとbm25が使えないので新しいもの順にする
+        select_score = f"substr(search_fts.body, 1, {SNIPPET_TOKENS * 4}), 0.0"
+        order_by = "d.doc_id DESC"
+
+    result = await db.execute(text(f"""
+        SELECT d.kind, d.ref_id, d.user_id, d.thread_id, {select_score}
+        FROM search_fts
+        JOIN search_docs d ON d.doc_id = search_fts.rowid
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {order_by}
+        LIMIT :limit
+    """), params)
+    # bm25は小さいほどよく一致しているので、返すときは符号を反転して大きいほど良いスコアにする
+    return [
+        SearchHit(kind=kind, ref_id=ref_id, user_id=hit_user_id, thread_id=thread_id, snippet=snippet, score=-score if score else 0.0)
+        for kind, ref_id, hit_user_id, thread_id, snippet, score in result.all()
+    ]
+
+
+async def search_persona_entries(
+    db: AsyncSession, user_id: str, query: str, limit: int = 10
+) -> List[SearchHit]:
+    """人格の根拠に使うPersonDataEntryを1回の索引検索で取り出す"""
+    return await search(db, query, user_id=user_id, kinds=["person_data"], limit=limit)
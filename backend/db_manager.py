@@ -1,25 +1,271 @@
 # db_manager.py
-import aiosqlite
+import asyncio
 import logging
 import datetime
 import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
 
 DATABASE = 'bot_database.db'
 logger = logging.getLogger('discord') # discord.pyのロガーを使う
 
+T = TypeVar('T')
+
+# 読み取り用の接続数 (書き込みは常に1本の接続に直列化する)
+POOL_READERS = 4
+# 接続ごとに準備済みステートメントを保持する数 (同じSQL文字列なら再パースしない)
+CACHED_STATEMENTS = 256
+# 接続を開いたときに設定するPRAGMA
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',        # 読み取りと書き込みを並行できるようにする
+    'synchronous': 'NORMAL',      # WALではコミットごとのfsyncを省いても破損しない
+    'mmap_size': 268435456,       # 256MB
+    'cache_size': -16000,         # 約16MB (負の値はKB単位)
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+# 会話履歴の書き込みをまとめる間隔 (秒) と1回にまとめる最大件数
+CONVERSATION_FLUSH_INTERVAL = 0.005
+CONVERSATION_MAX_BATCH = 256
+
+# 会話履歴の保存時にトークン数を数える関数 (モデルのトークナイザ。set_token_counterで登録する)
+_token_counter: Optional[Callable[[str], int]] = None
+
+
+def set_token_counter(counter: Optional[Callable[[str], int]]) -> None:
+    """会話履歴を保存するときに token_count を計算する関数を登録する (Noneで解除)"""
+    global _token_counter
+    _token_counter = counter
+
+
+class DatabasePool:
+    """
+    1つのDBファイルに対する長期接続のプール
+    接続はワーカースレッドごとに1本ずつ開いたまま使い回す
+    書き込みは1スレッドのexecutorに積むことで到着順に1本の接続で実行し (single-writer) 、
+    読み取りは複数のスレッドで並行して実行する
+    """
+
+    def __init__(self, db_path: str, readers: int = POOL_READERS):
+        self.db_path = db_path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._closed = False
+
+    def _connection(self) -> sqlite3.Connection:
+        """呼び出したワーカースレッド専用の接続を返す (初回だけ開く)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+            conn.row_factory = sqlite3.Row
+            for name, value in CONNECTION_PRAGMAS.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _write_sync(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        conn = self._connection()
+        try:
+            result = fn(conn)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _read_sync(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        return fn(self._connection())
+
+    async def run_write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """書き込み用の接続でfn(conn)を実行してコミットする。例外時はロールバックする"""
+        if self._closed:
+            raise RuntimeError(f"DatabasePool for {self.db_path} is closed")
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._write_sync, fn)
+
+    async def run_read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """読み取り用の接続でfn(conn)を実行する"""
+        if self._closed:
+            raise RuntimeError(f"DatabasePool for {self.db_path} is closed")
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read_sync, fn)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> Tuple[Optional[int], int]:
+        """書き込みを1件実行して (lastrowid, rowcount) を返す"""
+        def _execute(conn: sqlite3.Connection) -> Tuple[Optional[int], int]:
+            cursor = conn.execute(sql, params)
+            return cursor.lastrowid, cursor.rowcount
+        return await self.run_write(_execute)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        """同じ書き込みを複数のパラメータで1トランザクションで実行し、rowcountを返す"""
+        return await self.run_write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+        return await self.run_read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[sqlite3.Row]:
+        return await self.run_read(lambda conn: conn.execute(sql, params).fetchone())
+
+    def _close_sync(self) -> None:
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    async def close(self) -> None:
+        """実行中の処理が終わるのを待ってから全ての接続を閉じる"""
+        if self._closed:
+            return
+        self._closed = True
+        await asyncio.to_thread(self._close_sync)
+
+
+class ConversationWriteBuffer:
+    """
+    conversation_historyへのINSERTを全ユーザー分ためて、executemanyで1トランザクションにまとめて書き込む (group commit)
+    flush_intervalが経過するかmax_batch件たまった時点で書き込み、コミットのfsyncを1回にする
+    add()はコミットされたら (成功ならTrue、失敗ならFalse) 完了するFutureを返す
+    """
+
+    INSERT_SQL = '''
+        INSERT INTO conversation_history (user_id, role, content, timestamp, token_count)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+
+    def __init__(self, pool: DatabasePool, flush_interval: float = CONVERSATION_FLUSH_INTERVAL, max_batch: int = CONVERSATION_MAX_BATCH):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Tuple[Any, ...], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._writing: set = set()
+        self.stats = {'rows': 0, 'batches': 0, 'failed_rows': 0, 'max_batch_size': 0}
+
+    def add(self, user_id: int, role: str, content: str, token_count: Optional[int] = None) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # DEFAULT CURRENT_TIMESTAMP だと書き込み時刻になるので、受け付けた時刻を同じ形式 (UTC) で入れる
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        if token_count is None and _token_counter is not None:
+            token_count = _token_counter(content)
+        self._pending.append(((user_id, role, content, timestamp, token_count), future))
+        if len(self._pending) >= self.max_batch:
+            self._start_write()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._start_write)
+        return future
+
+    def _start_write(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        # 書き込みはsingle-writerのexecutorに到着順に積まれるので、バッチの順序は保たれる
+        task = asyncio.get_running_loop().create_task(self._write(batch))
+        self._writing.add(task)
+        task.add_done_callback(self._writing.discard)
+
+    async def _write(self, batch: List[Tuple[Tuple[Any, ...], asyncio.Future]]) -> None:
+        try:
+            await self.pool.executemany(self.INSERT_SQL, [params for params, _ in batch])
+            succeeded = True
+            self.stats['rows'] += len(batch)
+            self.stats['batches'] += 1
+            self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+            logger.debug(f"Flushed {len(batch)} conversation messages")
+        except Exception as e:
+            succeeded = False
+            self.stats['failed_rows'] += len(batch)
+            logger.error(f"Error flushing {len(batch)} conversation messages: {e}")
+        for _, future in batch:
+            if not future.done():
+                future.set_result(succeeded)
+
+    async def flush(self) -> None:
+        """ためている分をすぐに書き込み、書き込み中のものも含めて完了を待つ"""
+        self._start_write()
+        if self._writing:
+            await asyncio.gather(*self._writing)
+
+
+_pools: Dict[str, DatabasePool] = {}
+_conversation_buffers: Dict[str, ConversationWriteBuffer] = {}
+_pools_lock = threading.Lock()
+
+
+def get_database_pool(db_path: str = DATABASE) -> DatabasePool:
+    """db_pathごとに共有するDatabasePoolを返す (なければ作る)"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = DatabasePool(db_path)
+            _pools[key] = pool
+        return pool
+
+
+def get_conversation_buffer(db_path: str = DATABASE) -> ConversationWriteBuffer:
+    """db_pathごとに共有する会話履歴の書き込みバッファを返す (なければ作る)"""
+    key = os.path.abspath(db_path)
+    pool = get_database_pool(db_path)
+    with _pools_lock:
+        buffer = _conversation_buffers.get(key)
+        if buffer is None:
+            buffer = ConversationWriteBuffer(pool)
+            _conversation_buffers[key] = buffer
+        return buffer
+
+
+async def close_database_pool(db_path: str = DATABASE) -> None:
+    """ためている書き込みを反映してからプールを閉じる"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        buffer = _conversation_buffers.pop(key, None)
+        pool = _pools.pop(key, None)
+    if buffer is not None:
+        await buffer.flush()
+    if pool is not None:
+        await pool.close()
+
+
+async def close_database_pools() -> None:
+    """全てのDatabasePoolを閉じる (アプリの終了時に呼ぶ)"""
+    with _pools_lock:
+        buffers = list(_conversation_buffers.values())
+        pools = list(_pools.values())
+        _conversation_buffers.clear()
+        _pools.clear()
+    for buffer in buffers:
+        await buffer.flush()
+    for pool in pools:
+        await pool.close()
+
+
 async def initialize_database(db_path: str = DATABASE):
     """データベースを初期化し、必要なテーブルを作成する"""
     try:
+        # DBファイルを作り直した場合に古い接続を使い続けないように、既存のプールは閉じる
+        await close_database_pool(db_path)
+
         # データベースファイルのディレクトリが存在することを確認
         db_dir = os.path.dirname(db_path)
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
             logger.info(f"Created database directory: {db_dir}")
 
-        # データベースに接続（ファイルが存在しない場合は自動的に作成される）
-        async with aiosqlite.connect(db_path) as db:
+        def _create_tables(db: sqlite3.Connection):
             # ユーザー設定などを保存するテーブル
-            await db.execute('''
+            db.execute('''
                 CREATE TABLE IF NOT EXISTS user_info (
                     user_id INTEGER NOT NULL,
                     info_type TEXT NOT NULL,
@@ -28,17 +274,22 @@ async def initialize_database(db_path: str = DATABASE):
                 )
             ''')
             # LLMの会話履歴を保存するテーブル
-            await db.execute('''
+            db.execute('''
                 CREATE TABLE IF NOT EXISTS conversation_history (
                     message_id INTEGER PRIMARY KEY AUTOINCREMENT,
                     user_id INTEGER NOT NULL,
                     role TEXT NOT NULL CHECK(role IN ('system', 'user', 'assistant')),
                     content TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    token_count INTEGER
                 )
             ''')
+            # token_count は後から追加した列なので、古いDBには列を足す (既存の行はNULLのまま)
+            columns = {row[1] for row in db.execute('PRAGMA table_info(conversation_history)')}
+            if 'token_count' not in columns:
+                db.execute('ALTER TABLE conversation_history ADD COLUMN token_count INTEGER')
             # Episodesテーブルを作成
-            await db.execute('''
+            db.execute('''
                 CREATE TABLE IF NOT EXISTS episodes (
                     episode_id INTEGER PRIMARY KEY AUTOINCREMENT,
                     user_id INTEGER NOT NULL,
@@ -61,17 +312,72 @@ async def initialize_database(db_path: str = DATABASE):
                     FOREIGN KEY (user_id) REFERENCES user_info(user_id)
                 )
             ''')
+            # 分析中のエピソード (プロセスが落ちても続きから処理できるように保存する)
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS active_episodes (
+                    user_id INTEGER PRIMARY KEY,
+                    episode_json TEXT NOT NULL,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # 会話履歴のメッセージ同士の関連の重み (種類ごとに各メッセージの上位k件だけを持つ)
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS relation_weights (
+                    message_id INTEGER NOT NULL,
+                    related_message_id INTEGER NOT NULL,
+                    weight_type TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    weight_score REAL NOT NULL,
+                    confidence_score REAL,
+                    metadata TEXT,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (message_id, weight_type, related_message_id)
+                )
+            ''')
+            db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_relation_weights_user_type
+                ON relation_weights (user_id, weight_type)
+            ''')
+            # ユーザー情報が変わるたびに増えるバージョン (人格スナップショットの作り直しの判定に使う)
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS persona_versions (
+                    user_id INTEGER PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+                db.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS persona_version_user_info_{event.lower()}
+                    AFTER {event} ON user_info BEGIN
+                        INSERT INTO persona_versions (user_id, version) VALUES ({row}.user_id, 1)
+                        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+                    END
+                ''')
+            # 描画済みのプロンプトとトークン列 (runtime.core.person_data_manager が作る)
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS persona_snapshots (
+                    user_id INTEGER PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    sections_json TEXT NOT NULL,
+                    prompt_text TEXT NOT NULL,
+                    token_ids BLOB,
+                    token_count INTEGER,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
             # user_id と timestamp にインデックスを作成して検索を高速化
-            await db.execute('''
+            db.execute('''
                 CREATE INDEX IF NOT EXISTS idx_conv_history_user_id_timestamp
                 ON conversation_history (user_id, timestamp)
             ''')
-            await db.execute('''
+            db.execute('''
                 CREATE INDEX IF NOT EXISTS idx_episodes_user_id_timestamp
                 ON episodes (user_id, timestamp)
             ''')
-            await db.commit()
-            logger.info(f"Database initialized with user_info, conversation_history, and episodes tables. (db_path={db_path})")
+
+        # データベースに接続（ファイルが存在しない場合は自動的に作成される）
+        await get_database_pool(db_path).run_write(_create_tables)
+        logger.info(f"Database initialized with user_info, conversation_history, and episodes tables. (db_path={db_path})")
     except Exception as e:
         logger.error(f"Error initializing database at {db_path}: {e}")
         raise
@@ -80,82 +386,111 @@ async def initialize_database(db_path: str = DATABASE):
 
 async def add_user_info(user_id: int, info_type: str, content: str, db_path: str = DATABASE):
     """ユーザー情報を追加または更新する"""
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            await db.execute('''
-                INSERT INTO user_info (user_id, info_type, content)
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id, info_type) DO UPDATE SET content = excluded.content
-            ''', (user_id, info_type, content))
-            await db.commit()
-            logger.info(f"Added/Updated info for user {user_id}: type='{info_type}'")
-            return True
-        except Exception as e:
-            logger.error(f"Error adding/updating user info for {user_id}, type {info_type}: {e}")
-            return False
+    try:
+        await get_database_pool(db_path).execute('''
+            INSERT INTO user_info (user_id, info_type, content)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, info_type) DO UPDATE SET content = excluded.content
+        ''', (user_id, info_type, content))
+        logger.info(f"Added/Updated info for user {user_id}: type='{info_type}'")
+        return True
+    except Exception as e:
+        logger.error(f"Error adding/updating user info for {user_id}, type {info_type}: {e}")
+        return False
+
+async def add_user_info_many(user_id: int, infos: dict, db_path: str = DATABASE):
+    """複数のユーザー情報を1トランザクションでまとめて追加または更新する"""
+    try:
+        await get_database_pool(db_path).executemany('''
+            INSERT INTO user_info (user_id, info_type, content)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, info_type) DO UPDATE SET content = excluded.content
+        ''', [(user_id, info_type, content) for info_type, content in infos.items()])
+        logger.info(f"Added/Updated {len(infos)} info entries for user {user_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error adding/updating user info for {user_id}: {e}")
+        return False
 
 async def get_user_info(user_id: int, db_path: str = DATABASE) -> dict:
     """特定のユーザーのすべての設定情報を取得する"""
-    user_data = {}
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            async with db.execute('SELECT info_type, content FROM user_info WHERE user_id = ?', (user_id,)) as cursor:
-                async for row in cursor:
-                    user_data[row[0]] = row[1]
-            logger.debug(f"Retrieved info for user {user_id}: {user_data}")
-            return user_data
-        except Exception as e:
-            logger.error(f"Error getting user info for {user_id}: {e}")
-            return {} # エラー時は空辞書を返す
+    try:
+        rows = await get_database_pool(db_path).fetchall(
+            'SELECT info_type, content FROM user_info WHERE user_id = ?', (user_id,)
+        )
+        user_data = {row[0]: row[1] for row in rows}
+        logger.debug(f"Retrieved info for user {user_id}: {user_data}")
+        return user_data
+    except Exception as e:
+        logger.error(f"Error getting user info for {user_id}: {e}")
+        return {} # エラー時は空辞書を返す
 
 async def delete_user_info(user_id: int, db_path: str = DATABASE):
     """特定のユーザーのすべての設定情報を削除する"""
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            await db.execute('DELETE FROM user_info WHERE user_id = ?', (user_id,))
-            await db.commit()
-            logger.info(f"Deleted all info for user {user_id}")
-            return True
-        except Exception as e:
-            logger.error(f"Error deleting user info for {user_id}: {e}")
-            return False
+    try:
+        await get_database_pool(db_path).execute('DELETE FROM user_info WHERE user_id = ?', (user_id,))
+        logger.info(f"Deleted all info for user {user_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting user info for {user_id}: {e}")
+        return False
 
 async def get_specific_user_info(user_id: int, info_type: str, db_path: str = DATABASE) -> str | None:
     """特定のユーザーの特定のタイプの情報を取得する"""
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            async with db.execute('SELECT content FROM user_info WHERE user_id = ? AND info_type = ?', (user_id, info_type)) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else None
-        except Exception as e:
-            logger.error(f"Error getting specific info for user {user_id}, type {info_type}: {e}")
-            return None
+    try:
+        row = await get_database_pool(db_path).fetchone(
+            'SELECT content FROM user_info WHERE user_id = ? AND info_type = ?', (user_id, info_type)
+        )
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Error getting specific info for user {user_id}, type {info_type}: {e}")
+        return None
+
+async def get_user_info_by_types(user_id: int, info_types: list[str], db_path: str = DATABASE) -> dict:
+    """特定のユーザーの複数タイプの情報を主キー (user_id, info_type) を使う1回のクエリで取得する"""
+    if not info_types:
+        return {}
+    try:
+        placeholders = ", ".join("?" for _ in info_types)
+        rows = await get_database_pool(db_path).fetchall(
+            f'SELECT info_type, content FROM user_info WHERE user_id = ? AND info_type IN ({placeholders})',
+            (user_id, *info_types)
+        )
+        return {row[0]: row[1] for row in rows}
+    except Exception as e:
+        logger.error(f"Error getting info for user {user_id}, types {info_types}: {e}")
+        return {}
 
 # --- Conversation History Functions ---
 
-async def add_conversation_message(user_id: int, role: str, content: str, db_path: str = DATABASE):
-    """会話履歴に新しいメッセージを追加する"""
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            await db.execute('''
-                INSERT INTO conversation_history (user_id, role, content)
-                VALUES (?, ?, ?)
-            ''', (user_id, role, content))
-            await db.commit()
-            logger.debug(f"Added conversation message for user {user_id}: role='{role}'")
-            return True
-        except Exception as e:
-            logger.error(f"Error adding conversation message for user {user_id}: {e}")
+def buffer_conversation_message(user_id: int, role: str, content: str, db_path: str = DATABASE,
+                                token_count: int | None = None) -> asyncio.Future:
+    """
+    会話履歴への追加を書き込みバッファに積み、コミットを待たずに返す
+    戻り値のFutureはコミットされるとTrue (失敗ならFalse) になる。確認が必要な呼び出し側だけawaitする
+    token_count を省略すると登録されたトークナイザで数える (set_token_counter)
+    """
+    return get_conversation_buffer(db_path).add(user_id, role, content, token_count)
+
+async def add_conversation_message(user_id: int, role: str, content: str, db_path: str = DATABASE,
+                                   token_count: int | None = None):
+    """会話履歴に新しいメッセージを追加する (同時に来た他の書き込みとまとめてコミットされるのを待つ)"""
+    try:
+        if not await buffer_conversation_message(user_id, role, content, db_path, token_count):
             return False
+        logger.debug(f"Added conversation message for user {user_id}: role='{role}'")
+        return True
+    except Exception as e:
+        logger.error(f"Error adding conversation message for user {user_id}: {e}")
+        return False
 
 async def get_conversation_history(user_id: int, limit: int | None = None, db_path: str = DATABASE) -> list[dict[str, str]]:
     """特定のユーザーの会話履歴を取得する (時系列順、オプションで件数制限)"""
-    history = []
     query = '''
         SELECT role, content
         FROM conversation_history
         WHERE user_id = ?
-        ORDER BY timestamp ASC
+        ORDER BY timestamp ASC, message_id ASC
     '''
     params = (user_id,)
 
@@ -165,12 +500,12 @@ async def get_conversation_history(user_id: int, limit: int | None = None, db_pa
         # -> やはりSQLで最新N件を取得するのが効率的なので、ORDER BY timestamp DESC LIMIT ? を使う
         query = '''
             SELECT role, content FROM (
-                SELECT role, content, timestamp
+                SELECT role, content, timestamp, message_id
                 FROM conversation_history
                 WHERE user_id = ?
-                ORDER BY timestamp DESC
+                ORDER BY timestamp DESC, message_id DESC
                 LIMIT ?
-            ) ORDER BY timestamp ASC
+            ) ORDER BY timestamp ASC, message_id ASC
         '''
         params = (user_id, limit)
         # logger.debug(f"Retrieving last {limit} messages for user {user_id}")
@@ -178,30 +513,100 @@ async def get_conversation_history(user_id: int, limit: int | None = None, db_pa
         # logger.debug(f"Retrieving all messages for user {user_id}")
 
 
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            async with db.execute(query, params) as cursor:
-                async for row in cursor:
-                    history.append({'role': row[0], 'content': row[1]})
-            logger.debug(f"Retrieved {len(history)} conversation messages for user {user_id} (limit={limit})")
-            return history
-        except Exception as e:
-            logger.error(f"Error getting conversation history for user {user_id}: {e}")
-            return [] # エラー時は空リストを返す
+    try:
+        # バッファに残っている書き込みを先に反映して、直前に追加したメッセージも読めるようにする
+        buffer = _conversation_buffers.get(os.path.abspath(db_path))
+        if buffer is not None:
+            await buffer.flush()
+        rows = await get_database_pool(db_path).fetchall(query, params)
+        history = [{'role': row[0], 'content': row[1]} for row in rows]
+        logger.debug(f"Retrieved {len(history)} conversation messages for user {user_id} (limit={limit})")
+        return history
+    except Exception as e:
+        logger.error(f"Error getting conversation history for user {user_id}: {e}")
+        return [] # エラー時は空リストを返す
+
+async def get_conversation_history_within_budget(
+    user_id: int, max_tokens: int, per_message_tokens: int = 0, db_path: str = DATABASE
+) -> list[dict]:
+    """
+    トークン数の合計が max_tokens に収まる最新のメッセージを時系列順に取得する
+    per_message_tokens はチャットテンプレートでメッセージごとに増えるトークン数
+    token_count がない古い行は文字数で見積もる (日本語ではトークン数より多めになる)
+    """
+    if max_tokens <= 0:
+        return []
+    # 1件あたり少なくとも1トークンは使うので、(user_id, timestamp) のインデックスを新しい順にこの件数だけ読めば足りる
+    max_rows = max_tokens // max(per_message_tokens + 1, 1) + 1
+    query = '''
+        SELECT message_id, role, content, token_count FROM (
+            SELECT message_id, role, content, token_count, timestamp,
+                SUM(COALESCE(token_count, length(content)) + ?) OVER (
+                    ORDER BY timestamp DESC, message_id DESC ROWS UNBOUNDED PRECEDING
+                ) AS running_tokens
+            FROM (
+                SELECT * FROM conversation_history
+                WHERE user_id = ?
+                ORDER BY timestamp DESC, message_id DESC
+                LIMIT ?
+            )
+        ) WHERE running_tokens <= ?
+        ORDER BY timestamp ASC, message_id ASC
+    '''
+    try:
+        buffer = _conversation_buffers.get(os.path.abspath(db_path))
+        if buffer is not None:
+            await buffer.flush()
+        rows = await get_database_pool(db_path).fetchall(query, (per_message_tokens, user_id, max_rows, max_tokens))
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting conversation history within {max_tokens} tokens for user {user_id}: {e}")
+        return []
+
+async def update_conversation_token_counts(token_counts: dict[int, int], db_path: str = DATABASE) -> bool:
+    """token_count がない古い行に、数えたトークン数を書き込む ({message_id: token_count})"""
+    if not token_counts:
+        return True
+    try:
+        await get_database_pool(db_path).executemany(
+            'UPDATE conversation_history SET token_count = ? WHERE message_id = ?',
+            [(count, message_id) for message_id, count in token_counts.items()]
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error updating token counts for {len(token_counts)} messages: {e}")
+        return False
+
+async def get_conversation_messages(user_id: int, db_path: str = DATABASE) -> list[dict]:
+    """特定のユーザーの会話履歴をmessage_idとtimestamp付きで時系列順に取得する"""
+    try:
+        await get_conversation_buffer(db_path).flush()
+        rows = await get_database_pool(db_path).fetchall('''
+            SELECT message_id, role, content, timestamp
+            FROM conversation_history
+            WHERE user_id = ?
+            ORDER BY timestamp ASC, message_id ASC
+        ''', (user_id,))
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting conversation messages for user {user_id}: {e}")
+        return []
 
 async def delete_conversation_history(user_id: int, db_path: str = DATABASE):
     """特定のユーザーの会話履歴をすべて削除する"""
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            await db.execute('DELETE FROM conversation_history WHERE user_id = ?', (user_id,))
-            await db.commit()
-            # 削除された行数を取得（オプション）
-            changes = db.total_changes
-            logger.info(f"Deleted conversation history for user {user_id}. Rows affected: {changes}")
-            return True
-        except Exception as e:
-            logger.error(f"Error deleting conversation history for user {user_id}: {e}")
-            return False
+    try:
+        # 削除より前に追加されたメッセージを取りこぼさないように先に書き込む
+        buffer = _conversation_buffers.get(os.path.abspath(db_path))
+        if buffer is not None:
+            await buffer.flush()
+        _, changes = await get_database_pool(db_path).execute(
+            'DELETE FROM conversation_history WHERE user_id = ?', (user_id,)
+        )
+        logger.info(f"Deleted conversation history for user {user_id}. Rows affected: {changes}")
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting conversation history for user {user_id}: {e}")
+        return False
 
 # 注意: get_specific_user_history 関数は削除しました。
 # 特定のメッセージが必要な場合は、get_conversation_history で全件取得するか、
@@ -211,38 +616,34 @@ async def delete_conversation_history(user_id: int, db_path: str = DATABASE):
 
 async def add_episode(user_id: int, text_content: str, author: str, db_path: str = DATABASE, **kwargs):
     """エピソードを追加する"""
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            fields = ['user_id', 'text_content', 'author']
-            values = [user_id, text_content, author]
-            optional_fields = [
-                'content_type', 'emotion_analysis_json', 'keywords_json',
-                'topics_json', 'named_entities_json', 'summarization_json',
-                'is_trauma_event', 'sensitivity_level', 'user_importance_rating',
-                'user_labels_json', 'user_notes', 'collected_info_json', 'completeness'
-            ]
-            for field in optional_fields:
-                if field in kwargs:
-                    fields.append(field)
-                    values.append(kwargs[field])
-            placeholders = ', '.join(['?' for _ in fields])
-            field_names = ', '.join(fields)
-            query = f'''
-                INSERT INTO episodes ({field_names})
-                VALUES ({placeholders})
-            '''
-            cursor = await db.execute(query, values)
-            await db.commit()
-            episode_id = cursor.lastrowid
-            logger.info(f"Added episode for user {user_id} (episode_id={episode_id})")
-            return episode_id
-        except Exception as e:
-            logger.error(f"Error adding episode for user {user_id}: {e}")
-            return None
+    try:
+        fields = ['user_id', 'text_content', 'author']
+        values = [user_id, text_content, author]
+        optional_fields = [
+            'content_type', 'emotion_analysis_json', 'keywords_json',
+            'topics_json', 'named_entities_json', 'summarization_json',
+            'is_trauma_event', 'sensitivity_level', 'user_importance_rating',
+            'user_labels_json', 'user_notes', 'collected_info_json', 'completeness'
+        ]
+        for field in optional_fields:
+            if field in kwargs:
+                fields.append(field)
+                values.append(kwargs[field])
+        placeholders = ', '.join(['?' for _ in fields])
+        field_names = ', '.join(fields)
+        query = f'''
+            INSERT INTO episodes ({field_names})
+            VALUES ({placeholders})
+        '''
+        episode_id, _ = await get_database_pool(db_path).execute(query, values)
+        logger.info(f"Added episode for user {user_id} (episode_id={episode_id})")
+        return episode_id
+    except Exception as e:
+        logger.error(f"Error adding episode for user {user_id}: {e}")
+        return None
 
 async def get_episodes(user_id: int, limit: int | None = None, db_path: str = DATABASE) -> list[dict]:
     """特定のユーザーのエピソードを取得する"""
-    episodes = []
     query = '''
         SELECT *
         FROM episodes
@@ -250,68 +651,226 @@ async def get_episodes(user_id: int, limit: int | None = None, db_path: str = DA
         ORDER BY timestamp DESC
     '''
     params = (user_id,)
-    
+
     if limit is not None and limit > 0:
         query += ' LIMIT ?'
         params = (user_id, limit)
-    
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            async with db.execute(query, params) as cursor:
-                columns = [description[0] for description in cursor.description]
-                async for row in cursor:
-                    episode = dict(zip(columns, row))
-                    episodes.append(episode)
-            return episodes
-        except Exception as e:
-            logger.error(f"Error getting episodes for user {user_id}: {e}")
-            return []
+
+    try:
+        rows = await get_database_pool(db_path).fetchall(query, params)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting episodes for user {user_id}: {e}")
+        return []
+
+async def get_episodes_by_ids(user_id: int, episode_ids: list[int], db_path: str = DATABASE) -> list[dict]:
+    """特定のユーザーのエピソードをIDで取得する (渡したIDの順に並べ、存在しないものは除く)"""
+    if not episode_ids:
+        return []
+    placeholders = ', '.join(['?' for _ in episode_ids])
+    try:
+        rows = await get_database_pool(db_path).fetchall(
+            f'SELECT * FROM episodes WHERE user_id = ? AND episode_id IN ({placeholders})',
+            (user_id, *episode_ids)
+        )
+        by_id = {row['episode_id']: dict(row) for row in rows}
+        return [by_id[episode_id] for episode_id in episode_ids if episode_id in by_id]
+    except Exception as e:
+        logger.error(f"Error getting episodes {episode_ids} for user {user_id}: {e}")
+        return []
 
 async def update_episode(episode_id: int, db_path: str = DATABASE, **kwargs):
     """エピソードを更新する"""
     if not kwargs:
         return False
-        
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            set_clause = ', '.join([f"{field} = ?" for field in kwargs.keys()])
-            values = list(kwargs.values())
-            values.append(episode_id)
-            
-            query = f'''
-                UPDATE episodes
-                SET {set_clause}
-                WHERE episode_id = ?
-            '''
-            
-            cursor = await db.execute(query, values)
-            await db.commit()
-            
-            # 更新された行数を確認
-            if cursor.rowcount == 0:
-                logger.info(f"Episode {episode_id} not found")
-                return False
-                
-            logger.info(f"Updated episode {episode_id}")
-            return True
-        except Exception as e:
-            logger.error(f"Error updating episode {episode_id}: {e}")
+
+    try:
+        set_clause = ', '.join([f"{field} = ?" for field in kwargs.keys()])
+        values = list(kwargs.values())
+        values.append(episode_id)
+
+        query = f'''
+            UPDATE episodes
+            SET {set_clause}
+            WHERE episode_id = ?
+        '''
+
+        _, rowcount = await get_database_pool(db_path).execute(query, values)
+
+        # 更新された行数を確認
+        if rowcount == 0:
+            logger.info(f"Episode {episode_id} not found")
             return False
 
+        logger.info(f"Updated episode {episode_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error updating episode {episode_id}: {e}")
+        return False
+
 async def delete_episode(episode_id: int, db_path: str = DATABASE):
     """エピソードを削除する"""
-    async with aiosqlite.connect(db_path) as db:
-        try:
-            cursor = await db.execute('DELETE FROM episodes WHERE episode_id = ?', (episode_id,))
-            await db.commit()
-            
-            # 削除された行数を確認
-            if cursor.rowcount == 0:
-                logger.info(f"Episode {episode_id} not found")
-                return False
-                
-            logger.info(f"Deleted episode {episode_id}")
-            return True
-        except Exception as e:
-            logger.error(f"Error deleting episode {episode_id}: {e}")
+    try:
+        _, rowcount = await get_database_pool(db_path).execute('DELETE FROM episodes WHERE episode_id = ?', (episode_id,))
+
+        # 削除された行数を確認
+        if rowcount == 0:
+            logger.info(f"Episode {episode_id} not found")
             return False
+
+        logger.info(f"Deleted episode {episode_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting episode {episode_id}: {e}")
+        return False
+
+# --- Active Episode Functions ---
+
+async def save_active_episode(user_id: int, episode_json: str, db_path: str = DATABASE):
+    """分析中のエピソードを保存する"""
+    try:
+        await get_database_pool(db_path).execute('''
+            INSERT INTO active_episodes (user_id, episode_json, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET episode_json = excluded.episode_json, updated_at = excluded.updated_at
+        ''', (user_id, episode_json))
+        return True
+    except Exception as e:
+        logger.error(f"Error saving active episode for user {user_id}: {e}")
+        return False
+
+async def get_active_episode(user_id: int, db_path: str = DATABASE) -> str | None:
+    """分析中のエピソードを取得する"""
+    try:
+        row = await get_database_pool(db_path).fetchone(
+            'SELECT episode_json FROM active_episodes WHERE user_id = ?', (user_id,)
+        )
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Error getting active episode for user {user_id}: {e}")
+        return None
+
+async def delete_active_episode(user_id: int, db_path: str = DATABASE):
+    """分析中のエピソードを削除する"""
+    try:
+        await get_database_pool(db_path).execute('DELETE FROM active_episodes WHERE user_id = ?', (user_id,))
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting active episode for user {user_id}: {e}")
+        return False
+
+# --- Relation Weight Functions ---
+
+async def replace_relation_weights(user_id: int, weight_types: list[str], rows: list[tuple], db_path: str = DATABASE) -> bool:
+    """
+    ユーザーの関連の重みを1トランザクションで置き換える (指定した種類の古い重みは消す)
+    rows: (message_id, related_message_id, weight_type, weight_score, confidence_score, metadata) のリスト
+    """
+    placeholders = ', '.join(['?' for _ in weight_types])
+
+    def _replace(db: sqlite3.Connection) -> None:
+        db.execute(
+            f'DELETE FROM relation_weights WHERE user_id = ? AND weight_type IN ({placeholders})',
+            (user_id, *weight_types)
+        )
+        db.executemany('''
+            INSERT INTO relation_weights (
+                message_id, related_message_id, weight_type, user_id, weight_score, confidence_score, metadata
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(message_id, weight_type, related_message_id) DO UPDATE SET
+                weight_score = excluded.weight_score,
+                confidence_score = excluded.confidence_score,
+                metadata = excluded.metadata,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [(message_id, related_id, weight_type, user_id, score, confidence, metadata)
+              for message_id, related_id, weight_type, score, confidence, metadata in rows])
+
+    try:
+        await get_database_pool(db_path).run_write(_replace)
+        logger.info(f"Replaced {len(rows)} relation weights for user {user_id} (types={weight_types})")
+        return True
+    except Exception as e:
+        logger.error(f"Error replacing relation weights for user {user_id}: {e}")
+        return False
+
+async def get_relation_weights(message_id: int, weight_type: str | None = None, limit: int | None = None, db_path: str = DATABASE) -> list[dict]:
+    """メッセージに関連するメッセージを重みの大きい順に取得する"""
+    query = 'SELECT * FROM relation_weights WHERE message_id = ?'
+    params: list = [message_id]
+    if weight_type is not None:
+        query += ' AND weight_type = ?'
+        params.append(weight_type)
+    query += ' ORDER BY weight_score DESC'
+    if limit is not None and limit > 0:
+        query += ' LIMIT ?'
+        params.append(limit)
+    try:
+        rows = await get_database_pool(db_path).fetchall(query, params)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting relation weights for message {message_id}: {e}")
+        return []
+
+# --- Persona Snapshot Functions ---
+
+async def get_persona_source(user_id: int, db_path: str = DATABASE) -> tuple[int, dict]:
+    """ユーザー情報のバージョンと全件を同じ読み取りトランザクションで取得する"""
+    def _read(db: sqlite3.Connection) -> tuple[int, dict]:
+        db.execute('BEGIN')
+        try:
+            row = db.execute('SELECT version FROM persona_versions WHERE user_id = ?', (user_id,)).fetchone()
+            rows = db.execute(
+                'SELECT info_type, content FROM user_info WHERE user_id = ? ORDER BY info_type', (user_id,)
+            ).fetchall()
+        finally:
+            db.execute('COMMIT')
+        return (row['version'] if row else 0), {r['info_type']: r['content'] for r in rows}
+
+    try:
+        return await get_database_pool(db_path).run_read(_read)
+    except Exception as e:
+        logger.error(f"Error getting persona source for user {user_id}: {e}")
+        return 0, {}
+
+async def get_persona_version(user_id: int, db_path: str = DATABASE) -> int:
+    """ユーザー情報のバージョンを取得する (一度も変更されていなければ0)"""
+    try:
+        row = await get_database_pool(db_path).fetchone(
+            'SELECT version FROM persona_versions WHERE user_id = ?', (user_id,)
+        )
+        return row['version'] if row else 0
+    except Exception as e:
+        logger.error(f"Error getting persona version for user {user_id}: {e}")
+        return 0
+
+async def save_persona_snapshot(user_id: int, version: str, sections_json: str, prompt_text: str,
+                                token_ids: bytes | None, token_count: int | None, db_path: str = DATABASE) -> bool:
+    """人格スナップショットを保存または更新する"""
+    try:
+        await get_database_pool(db_path).execute('''
+            INSERT INTO persona_snapshots (user_id, version, sections_json, prompt_text, token_ids, token_count)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                version = excluded.version,
+                sections_json = excluded.sections_json,
+                prompt_text = excluded.prompt_text,
+                token_ids = excluded.token_ids,
+                token_count = excluded.token_count,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (user_id, version, sections_json, prompt_text, token_ids, token_count))
+        logger.info(f"Saved persona snapshot for user {user_id} (version={version}, tokens={token_count})")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving persona snapshot for user {user_id}: {e}")
+        return False
+
+async def get_persona_snapshot(user_id: int, db_path: str = DATABASE) -> dict | None:
+    """保存されている人格スナップショットを取得する"""
+    try:
+        row = await get_database_pool(db_path).fetchone(
+            'SELECT * FROM persona_snapshots WHERE user_id = ?', (user_id,)
+        )
+        return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"Error getting persona snapshot for user {user_id}: {e}")
+        return None
@@ -8,18 +8,22 @@ with open("sample_user.json","r",encoding="utf-8")as f:
     data = json.load(f)
 
 
-async def add_info(info_type: str, content: str):
+async def add_infos(infos: dict):
     global user_id
     print(user_id)
-    success = await db_manager.add_user_info(user_id=user_id, info_type=info_type.lower(),content=content)
+    # 1件ずつコミットせず、まとめて1トランザクションで登録する
+    success = await db_manager.add_user_info_many(user_id=user_id, infos=infos)
     if success:
-        print(f"情報タイプ `{info_type}` を登録/更新しました。")
+        for info_type in infos:
+            print(f"情報タイプ `{info_type}` を登録/更新しました。")
     else:
         print("情報の登録中にエラーが発生しました。")
+    await db_manager.close_database_pools()
         
 
 print(data)
 
+infos = {}
 for key,value in data.items():
     # print(f"{key}:{value}")
     
@@ -28,4 +32,6 @@ for key,value in data.items():
         print(f"[ERROR]NULL\n{key}:{value}")
         continue
 
-    asyncio.run(add_info(info_type=key,content=value))
+    infos[key.lower()] = value
+
+asyncio.run(add_infos(infos))
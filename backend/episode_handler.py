@@ -1,18 +1,54 @@
 import json
 import logging
-from typing import Dict, List, Optional, Union, Set
+from typing import Dict, List, Optional, Union, Set, TYPE_CHECKING
 import db_manager
 from datetime import datetime
 from question_agent.llm_analyzer import LLMAnalyzer
+from job_queue import JobQueue, JobContext
 import asyncio
 
+if TYPE_CHECKING:
+    from runtime.core.vector_index import EpisodeVectorStore
+
 logger = logging.getLogger('discord')
 
+EPISODE_FIELDS = ['when', 'where', 'who', 'what', 'how']
+
+# 5W1Hの項目を1回の生成で出力させるためのJSONスキーマ (見つからない項目はnull)
+EPISODE_INFO_SCHEMA = {
+    'type': 'object',
+    'properties': {field: {'type': ['string', 'null']} for field in EPISODE_FIELDS},
+    'required': EPISODE_FIELDS
+}
+
+# ジョブキューで実行するジョブの種類と優先度 (メッセージの分析を保存・追加分析より先に処理する)
+ANALYZE_MESSAGE_JOB = 'episode.analyze_message'
+SAVE_EPISODE_JOB = 'episode.save'
+ANALYZE_MESSAGE_PRIORITY = 10
+SAVE_EPISODE_PRIORITY = 0
+
 class EpisodeHandler:
-    def __init__(self, llm_analyzer: LLMAnalyzer):
+    def __init__(
+        self,
+        llm_analyzer: LLMAnalyzer,
+        batched_analysis: bool = True,
+        job_queue: Optional[JobQueue] = None,
+        vector_store: Optional["EpisodeVectorStore"] = None
+    ):
         self.llm_analyzer = llm_analyzer
+        # Trueなら各項目の抽出・追加分析をそれぞれ1回のLLM呼び出しにまとめる
+        self.batched_analysis = batched_analysis
+        # 指定されていれば分析をジョブキューに回し、メッセージの処理では待たない
+        self.job_queue = job_queue
+        if job_queue is not None:
+            job_queue.register(ANALYZE_MESSAGE_JOB, self._run_analyze_message_job)
+            job_queue.register(SAVE_EPISODE_JOB, self._run_save_episode_job)
+        # 指定されていれば保存したエピソードを埋め込みインデックスにも追加し、関連エピソードを検索できるようにする
+        self.vector_store = vector_store
         # 進行中のエピソードを追跡
         self.active_episodes: Dict[int, Dict] = {}  # user_id -> active_episode
+        # ユーザーごとのエピソード更新の排他 (ジョブキュー使用時)
+        self._episode_locks: Dict[int, asyncio.Lock] = {}
         # エピソードの完了に必要な情報
         self.required_info: Set[str] = {'when', 'where', 'who', 'what', 'how'}
 
@@ -81,6 +117,9 @@ class EpisodeHandler:
             if not self._should_process_as_episode(content):
                 return True
 
+            if self.job_queue is not None:
+                return await self.enqueue_conversation_message(user_id, role, content) is not None
+
             # 現在のエピソードを取得または新規作成
             current_episode = self._get_or_create_episode(user_id, role, content)
 
@@ -107,6 +146,132 @@ class EpisodeHandler:
             logger.error(f"Error processing conversation message: {e}")
             return False
 
+    async def enqueue_conversation_message(self, user_id: int, role: str, content: str) -> Optional[str]:
+        """
+        メッセージをエピソードに追加して保存し、分析ジョブを登録してjob_idを返す
+        分析の完了は待たない。短い相槌などで処理しない場合と失敗した場合はNone
+        """
+        if self.job_queue is None:
+            raise RuntimeError("job_queue is not configured")
+        if not self._should_process_as_episode(content):
+            return None
+        try:
+            async with self._episode_lock(user_id):
+                current_episode = await self._load_active_episode(user_id)
+                if current_episode is None:
+                    current_episode = self._get_or_create_episode(user_id, role, content)
+                current_episode['messages'].append({
+                    'role': role,
+                    'content': content,
+                    'timestamp': datetime.now().isoformat()
+                })
+                await self._store_active_episode(current_episode)
+                message_index = len(current_episode['messages']) - 1
+                start_time = current_episode['start_time']
+
+            return await self.job_queue.enqueue(
+                ANALYZE_MESSAGE_JOB,
+                {'user_id': user_id, 'start_time': start_time, 'message_index': message_index},
+                priority=ANALYZE_MESSAGE_PRIORITY,
+                idempotency_key=f"{ANALYZE_MESSAGE_JOB}:{user_id}:{start_time}:{message_index}"
+            )
+        except Exception as e:
+            logger.error(f"Error enqueueing conversation message: {e}")
+            return None
+
+    def _episode_lock(self, user_id: int) -> asyncio.Lock:
+        if user_id not in self._episode_locks:
+            self._episode_locks[user_id] = asyncio.Lock()
+        return self._episode_locks[user_id]
+
+    @staticmethod
+    def _serialize_episode(episode: Dict) -> str:
+        return json.dumps({**episode, 'collected_info': sorted(episode['collected_info'])}, ensure_ascii=False)
+
+    @staticmethod
+    def _deserialize_episode(episode_json: str) -> Dict:
+        episode = json.loads(episode_json)
+        episode['collected_info'] = set(episode['collected_info'])
+        return episode
+
+    async def _load_active_episode(self, user_id: int) -> Optional[Dict]:
+        """進行中のエピソードを返す。メモリになければ (再起動後など) DBから読み込む"""
+        if user_id not in self.active_episodes:
+            episode_json = await db_manager.get_active_episode(user_id)
+            if episode_json is None:
+                return None
+            self.active_episodes[user_id] = self._deserialize_episode(episode_json)
+        return self.active_episodes[user_id]
+
+    async def _store_active_episode(self, episode: Dict) -> None:
+        self.active_episodes[episode['user_id']] = episode
+        if not await db_manager.save_active_episode(episode['user_id'], self._serialize_episode(episode)):
+            raise RuntimeError(f"Failed to persist active episode for user {episode['user_id']}")
+
+    async def _drop_active_episode(self, user_id: int) -> None:
+        self.active_episodes.pop(user_id, None)
+        await db_manager.delete_active_episode(user_id)
+
+    async def _run_analyze_message_job(self, ctx: JobContext) -> Dict:
+        """1メッセージ分の5W1H抽出ジョブ。エピソードが揃ったら保存ジョブを登録する"""
+        user_id = ctx.payload['user_id']
+        message_index = ctx.payload['message_index']
+        async with self._episode_lock(user_id):
+            episode = await self._load_active_episode(user_id)
+            if episode is None or episode['start_time'] != ctx.payload['start_time']:
+                # 既に保存済みのエピソード
+                return {'skipped': True}
+            if message_index in episode.get('analyzed_messages', []):
+                return {'skipped': True}
+            text = episode['messages'][message_index]['content']
+
+        # LLM呼び出しの間はロックを持たない (その間も同じユーザーのメッセージを受け付ける)
+        await ctx.report_progress(0.1, 'extracting')
+        extracted = await self._extract_episode_info(text)
+        await ctx.report_progress(0.8, 'extracted')
+
+        async with self._episode_lock(user_id):
+            episode = await self._load_active_episode(user_id)
+            if episode is None or episode['start_time'] != ctx.payload['start_time']:
+                return {'skipped': True}
+            self._apply_episode_info(episode, extracted)
+            episode.setdefault('analyzed_messages', []).append(message_index)
+
+            if not self._is_episode_complete(episode):
+                await self._store_active_episode(episode)
+                return {'collected_info': sorted(episode['collected_info']), 'completed': False}
+
+            # 保存ジョブを先に登録してからアクティブなエピソードを消す (間で落ちてもこのジョブのリトライで登録し直せる)
+            save_job_id = await self.job_queue.enqueue(
+                SAVE_EPISODE_JOB,
+                {'episode': self._serialize_episode(episode)},
+                priority=SAVE_EPISODE_PRIORITY,
+                idempotency_key=f"{SAVE_EPISODE_JOB}:{user_id}:{episode['start_time']}"
+            )
+            await self._drop_active_episode(user_id)
+            return {'collected_info': sorted(episode['collected_info']), 'completed': True, 'save_job_id': save_job_id}
+
+    async def _run_save_episode_job(self, ctx: JobContext) -> Dict:
+        """完了したエピソードの保存と追加分析のジョブ"""
+        episode = self._deserialize_episode(ctx.payload['episode'])
+        episode_data = self._build_episode_data(episode)
+
+        # リトライ時に同じエピソードを二重に保存しない
+        episode_id = ctx.state.get('episode_id')
+        if episode_id is None:
+            episode_id = await db_manager.add_episode(**episode_data)
+            if not episode_id:
+                raise RuntimeError(f"Failed to save episode for user {episode['user_id']}")
+            await ctx.save_state(episode_id=episode_id)
+        episode_data['episode_id'] = episode_id
+        if not ctx.state.get('indexed'):
+            await self._index_episode(episode_data)
+            await ctx.save_state(indexed=True)
+        await ctx.report_progress(0.5, 'saved')
+
+        await self._perform_additional_analysis(episode_data)
+        return {'episode_id': episode_id}
+
     def _get_or_create_episode(self, user_id: int, role: str, content: str) -> Dict:
         """現在のエピソードを取得または新規作成する"""
         if user_id not in self.active_episodes:
@@ -124,27 +289,73 @@ class EpisodeHandler:
         """エピソードの情報を分析し、必要な情報を抽出する"""
         # 最新のメッセージを取得
         latest_message = episode['messages'][-1]['content']
-
-        # 情報の抽出を試みる
-        info_tasks = [
-            self._extract_when(latest_message),
-            self._extract_where(latest_message),
-            self._extract_who(latest_message),
-            self._extract_what(latest_message),
-            self._extract_how(latest_message)
-        ]
-
-        # 並行して情報を抽出
-        results = await asyncio.gather(*info_tasks, return_exceptions=True)
-
+        extracted = await self._extract_episode_info(latest_message)
+        self._apply_episode_info(episode, extracted)
+
+    async def _extract_episode_info(self, latest_message: str) -> Dict[str, Union[str, None, Exception]]:
+        """メッセージから5W1Hの各項目を抽出する"""
+        extracted: Dict[str, Optional[str]] = {}
+        if self.batched_analysis:
+            extracted = await self._extract_all(latest_message)
+
+        # まとめて抽出できなかった項目は個別に抽出する
+        extractors = {
+            'when': self._extract_when,
+            'where': self._extract_where,
+            'who': self._extract_who,
+            'what': self._extract_what,
+            'how': self._extract_how
+        }
+        missing = [field for field in EPISODE_FIELDS if field not in extracted]
+        if missing:
+            # 並行して情報を抽出
+            results = await asyncio.gather(*[extractors[field](latest_message) for field in missing], return_exceptions=True)
+            extracted.update(zip(missing, results))
+        return extracted
+
+    def _apply_episode_info(self, episode: Dict, extracted: Dict[str, Union[str, None, Exception]]) -> None:
         # 成功した抽出結果を記録
-        for info_type, result in zip(['when', 'where', 'who', 'what', 'how'], results):
+        for info_type in EPISODE_FIELDS:
+            result = extracted[info_type]
             if not isinstance(result, Exception) and result:
                 episode['collected_info'].add(info_type)
                 if info_type not in episode:
                     episode[info_type] = []
                 episode[info_type].append(result)
 
+    async def _extract_all(self, text: str) -> Dict[str, Optional[str]]:
+        """
+        5W1Hの項目を1回のJSONスキーマ制約付き生成で抽出する
+        値が文字列かnullの項目だけを返し、それ以外 (欠落・型違い・失敗) は呼び出し側で個別に抽出する
+        """
+        prompt = f"""
+        以下のテキストから、出来事について次の項目を抽出し、JSON形式で出力してください。
+        テキストに含まれない項目は null にしてください。
+        - when: 時間や時期（日付、曜日、時間、季節、昨日・先週などの相対的な表現）
+        - where: 場所（地名、施設名、近所・家の近くなどの相対的な位置表現）
+        - who: 関わった人物（人名、役割、友達・家族などの関係性）
+        - what: 何が起きたのか（行動、イベント、状態変化）
+        - how: どのように起きたのか（手段、方法、状況、感情）
+
+        テキスト：{text}
+
+        JSON出力：
+        """
+        try:
+            result = await self.llm_analyzer._call_llm_json(prompt, EPISODE_INFO_SCHEMA)
+        except Exception as e:
+            logger.warning(f"Batched episode extraction failed, falling back to per-field extraction: {e}")
+            return {}
+
+        extracted = {}
+        for field in EPISODE_FIELDS:
+            value = result.get(field)
+            if value is None and field in result:
+                extracted[field] = None
+            elif isinstance(value, str):
+                extracted[field] = value.strip() or None
+        return extracted
+
     async def _extract_when(self, text: str) -> Optional[str]:
         """テキストから時間情報を抽出する"""
         prompt = f"""
@@ -262,30 +473,36 @@ class EpisodeHandler:
 
         return any(indicator in last_message for indicator in end_indicators)
 
+    def _build_episode_data(self, episode: Dict) -> Dict:
+        """エピソードの基本情報を作成する"""
+        return {
+            'user_id': episode['user_id'],
+            'text_content': self._combine_messages(episode['messages']),
+            'author': 'user',  # 主にユーザーの発言からなるエピソード
+            'timestamp': episode['start_time'],
+            'collected_info_json': json.dumps({
+                'when': episode.get('when', []),
+                'where': episode.get('where', []),
+                'who': episode.get('who', []),
+                'what': episode.get('what', []),
+                'how': episode.get('how', [])
+            }),
+            'completeness': len(episode['collected_info']) / len(self.required_info)
+        }
+
     async def _save_episode(self, episode: Dict) -> bool:
         """エピソードをデータベースに保存する"""
         try:
             # エピソードの基本情報を作成
-            episode_data = {
-                'user_id': episode['user_id'],
-                'text_content': self._combine_messages(episode['messages']),
-                'author': 'user',  # 主にユーザーの発言からなるエピソード
-                'timestamp': episode['start_time'],
-                'collected_info_json': json.dumps({
-                    'when': episode.get('when', []),
-                    'where': episode.get('where', []),
-                    'who': episode.get('who', []),
-                    'what': episode.get('what', []),
-                    'how': episode.get('how', [])
-                }),
-                'completeness': len(episode['collected_info']) / len(self.required_info)
-            }
+            episode_data = self._build_episode_data(episode)
 
             # エピソードを保存
-            success = await db_manager.add_episode(**episode_data)
-            if not success:
+            episode_id = await db_manager.add_episode(**episode_data)
+            if not episode_id:
                 logger.error(f"Failed to save episode for user {episode['user_id']}")
                 return False
+            episode_data['episode_id'] = episode_id
+            await self._index_episode(episode_data)
 
             # 追加の分析を実行
             await self._perform_additional_analysis(episode_data)
@@ -295,6 +512,17 @@ class EpisodeHandler:
             logger.error(f"Error saving episode: {e}")
             return False
 
+    async def _index_episode(self, episode_data: Dict) -> None:
+        """保存したエピソードを埋め込みインデックスに追加する (失敗しても保存自体は成功として扱う)"""
+        if self.vector_store is None:
+            return
+        try:
+            await self.vector_store.add_episode(
+                episode_data['user_id'], episode_data['episode_id'], episode_data['text_content']
+            )
+        except Exception as e:
+            logger.error(f"Error indexing episode {episode_data['episode_id']}: {e}")
+
     def _combine_messages(self, messages: List[Dict]) -> str:
         """メッセージを結合して1つのテキストにする"""
         return "\n".join([
@@ -305,6 +533,23 @@ class EpisodeHandler:
     async def _perform_additional_analysis(self, episode_data: Dict) -> None:
         """エピソードに対して追加の分析を実行する"""
         try:
+            if self.batched_analysis:
+                try:
+                    # 6項目を1回の呼び出しで分析 (検証に失敗した項目だけ個別に分析し直す)
+                    result = await self.llm_analyzer.analyze_all(episode_data['text_content'])
+                    analysis_data = {
+                        'content_type': result['content_type'],
+                        'emotion_analysis_json': json.dumps(result['emotions']),
+                        'keywords_json': json.dumps(result['keywords']),
+                        'topics_json': json.dumps(result['topics']),
+                        'named_entities_json': json.dumps(result['named_entities']),
+                        'sensitivity_level': result['sensitivity']
+                    }
+                    await db_manager.update_episode(episode_data['episode_id'], **analysis_data)
+                    return
+                except Exception as e:
+                    logger.warning(f"Batched additional analysis failed, falling back to individual calls: {e}")
+
             # 非同期で追加の分析を実行
             analysis_tasks = [
                 self.llm_analyzer.analyze_content_type(episode_data['text_content']),
@@ -363,6 +608,21 @@ class EpisodeHandler:
             logger.error(f"Error getting user episodes: {e}")
             return []
 
+    async def get_related_episodes(self, user_id: int, text: str, limit: int = 5) -> List[Dict]:
+        """テキストと意味の近いエピソードを類似度の高い順に取得する (各エピソードに'similarity'を付ける)"""
+        if self.vector_store is None:
+            return []
+        try:
+            related = await self.vector_store.related_episodes(user_id, text, k=limit)
+            episodes = await db_manager.get_episodes_by_ids(user_id, [episode_id for episode_id, _ in related])
+            scores = dict(related)
+            for episode in episodes:
+                episode['similarity'] = scores[episode['episode_id']]
+            return episodes
+        except Exception as e:
+            logger.error(f"Error getting related episodes: {e}")
+            return []
+
     async def update_episode_metadata(self, episode_id: int, metadata: Dict) -> bool:
         """エピソードのメタデータを更新する"""
         try:
@@ -0,0 +1,317 @@
+# job_queue.py
+import aiosqlite
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger('discord')
+
+JOB_COLUMNS = (
+    'job_id', 'job_type', 'payload_json', 'priority', 'status', 'attempts', 'max_attempts',
+    'idempotency_key', 'progress', 'progress_message', 'state_json', 'result_json',
+    'last_error', 'run_after', 'created_at', 'updated_at', 'finished_at'
+)
+
+
+class JobContext:
+    """ジョブのハンドラーに渡す実行情報。進捗の報告とリトライをまたぐ途中状態の保存ができる"""
+
+    def __init__(self, queue: "JobQueue", job: Dict[str, Any]):
+        self._queue = queue
+        self.job_id: str = job['job_id']
+        self.job_type: str = job['job_type']
+        self.payload: Dict[str, Any] = job['payload']
+        self.attempt: int = job['attempts']
+        # 前回の試行で保存した途中状態 (二重書き込みを避けるために使う)
+        self.state: Dict[str, Any] = job['state']
+
+    async def report_progress(self, progress: float, message: str = '') -> None:
+        """進捗 (0.0-1.0) を記録する。/jobs/{id} から参照できる"""
+        await self._queue._update(self.job_id, progress=max(0.0, min(1.0, progress)), progress_message=message)
+
+    async def save_state(self, **values: Any) -> None:
+        """途中状態を保存する。失敗してリトライされたときもctx.stateに残っている"""
+        self.state.update(values)
+        await self._queue._update(self.job_id, state_json=json.dumps(self.state, ensure_ascii=False))
+
+
+JobHandler = Callable[[JobContext], Awaitable[Optional[Dict[str, Any]]]]
+
+
+class JobQueue:
+    """
+    SQLiteに永続化するバックグラウンドジョブキュー
+    enqueueは書き込みだけしてすぐに返り、ワーカーが優先度の高い順に実行する
+    失敗したジョブはジッター付き指数バックオフでリトライし、max_attemptsを超えたらdead_letter_jobsに移す
+    実行中にプロセスが落ちたジョブは次の起動時にキューへ戻す
+    """
+
+    def __init__(
+        self,
+        db_path: str = 'data/jobs.db',
+        num_workers: int = 2,
+        max_attempts: int = 3,
+        backoff_base: float = 2.0,
+        backoff_max: float = 300.0,
+        poll_interval: float = 1.0
+    ):
+        self.db_path = db_path
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, JobHandler] = {}
+        self._workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._initialized = False
+
+    def register(self, job_type: str, handler: JobHandler) -> None:
+        """job_typeのジョブを実行するハンドラーを登録する"""
+        self._handlers[job_type] = handler
+
+    # region 永続化
+    async def initialize(self) -> None:
+        """テーブルを作成し、前回実行中のまま終わったジョブをキューに戻す"""
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    job_type TEXT NOT NULL,
+                    payload_json TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL CHECK(status IN ('queued', 'running', 'succeeded', 'dead')),
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    idempotency_key TEXT UNIQUE,
+                    progress REAL NOT NULL DEFAULT 0.0,
+                    progress_message TEXT,
+                    state_json TEXT,
+                    result_json TEXT,
+                    last_error TEXT,
+                    run_after REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            ''')
+            # 取り出し (status='queued' を優先度順) 用のインデックス
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_jobs_status_priority
+                ON jobs (status, priority DESC, created_at)
+            ''')
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS dead_letter_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    job_type TEXT NOT NULL,
+                    payload_json TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    last_error TEXT,
+                    failed_at REAL NOT NULL
+                )
+            ''')
+            cursor = await db.execute(
+                "UPDATE jobs SET status = 'queued', run_after = ?, updated_at = ? WHERE status = 'running'",
+                (time.time(), time.time())
+            )
+            await db.commit()
+            if cursor.rowcount:
+                logger.warning(f"Requeued {cursor.rowcount} jobs that were running when the process stopped")
+        self._initialized = True
+
+    async def _update(self, job_id: str, **columns: Any) -> None:
+        columns['updated_at'] = time.time()
+        assignments = ', '.join(f"{column} = ?" for column in columns)
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*columns.values(), job_id))
+            await db.commit()
+
+    @staticmethod
+    def _row_to_job(row) -> Dict[str, Any]:
+        job = dict(zip(JOB_COLUMNS, row))
+        job['payload'] = json.loads(job.pop('payload_json'))
+        job['state'] = json.loads(job.pop('state_json') or '{}')
+        result_json = job.pop('result_json')
+        job['result'] = json.loads(result_json) if result_json else None
+        return job
+    # endregion
+
+    async def enqueue(
+        self,
+        job_type: str,
+        payload: Dict[str, Any],
+        priority: int = 0,
+        idempotency_key: Optional[str] = None,
+        max_attempts: Optional[int] = None,
+        delay: float = 0.0
+    ) -> str:
+        """
+        ジョブを登録してjob_idを返す (実行は待たない)
+        同じidempotency_keyのジョブが既にあれば新しく作らず、そのjob_idを返す
+        """
+        if not self._initialized:
+            await self.initialize()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute('''
+                INSERT INTO jobs (job_id, job_type, payload_json, priority, status, max_attempts,
+                                  idempotency_key, run_after, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?)
+                ON CONFLICT(idempotency_key) DO NOTHING
+            ''', (job_id, job_type, json.dumps(payload, ensure_ascii=False), priority,
+                  max_attempts or self.max_attempts, idempotency_key, now + delay, now, now))
+            await db.commit()
+            if cursor.rowcount == 0:
+                async with db.execute('SELECT job_id FROM jobs WHERE idempotency_key = ?', (idempotency_key,)) as existing:
+                    row = await existing.fetchone()
+                logger.debug(f"Job with idempotency key {idempotency_key} already exists: {row[0]}")
+                return row[0]
+        logger.debug(f"Enqueued job {job_id} ({job_type}, priority={priority})")
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """ジョブの状態・進捗・結果を返す。存在しなければNone"""
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)) as cursor:
+                row = await cursor.fetchone()
+        return self._row_to_job(row) if row else None
+
+    async def get_dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """リトライ上限に達したジョブを新しい順に返す"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute('SELECT * FROM dead_letter_jobs ORDER BY failed_at DESC LIMIT ?', (limit,)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_stats(self) -> Dict[str, Any]:
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status') as cursor:
+                counts = {status: count for status, count in await cursor.fetchall()}
+        return {'workers': len(self._workers), 'jobs': counts}
+
+    # region ワーカー
+    async def start(self) -> None:
+        """ワーカーを起動する (FastAPIのstartupで呼ぶ)"""
+        if self._workers:
+            return
+        await self.initialize()
+        self._wakeup = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._worker_loop(index), name=f"job-worker-{index}")
+            for index in range(self.num_workers)
+        ]
+        logger.info(f"Job queue started with {self.num_workers} workers (db_path={self.db_path})")
+
+    async def stop(self) -> None:
+        """ワーカーを止める。実行中だったジョブはキューに戻る"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        """
+        実行可能なジョブのうち優先度が最も高いものを1件取り出してrunningにする
+        ハンドラーが登録されていない種類のジョブは取り出さずにキューに残す (登録されたら実行される)
+        """
+        job_types = list(self._handlers)
+        if not job_types:
+            return None
+        now = time.time()
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(f'''
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+                WHERE job_id = (
+                    SELECT job_id FROM jobs
+                    WHERE status = 'queued' AND run_after <= ? AND job_type IN ({', '.join('?' * len(job_types))})
+                    ORDER BY priority DESC, created_at
+                    LIMIT 1
+                )
+                RETURNING {', '.join(JOB_COLUMNS)}
+            ''', (now, now, *job_types)) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+        return self._row_to_job(row) if row else None
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: 0 〜 min(上限, base * 2^attempt) の一様乱数
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _worker_loop(self, index: int) -> None:
+        while True:
+            try:
+                self._wakeup.clear()
+                job = await self._claim()
+                if job is None:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker {index} error: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job['job_id']
+        handler = self._handlers.get(job['job_type'])
+        if handler is None:
+            # 取り出した後に登録が外れた場合も失敗として数えずにキューへ戻す
+            logger.warning(f"No handler registered for job type '{job['job_type']}', leaving job {job_id} queued")
+            await self._update(job_id, status='queued', attempts=job['attempts'] - 1,
+                               run_after=time.time() + self.poll_interval)
+            return
+        try:
+            result = await handler(JobContext(self, job))
+        except asyncio.CancelledError:
+            # 停止による中断は失敗として数えずにキューへ戻す
+            await asyncio.shield(self._update(job_id, status='queued', attempts=job['attempts'] - 1))
+            raise
+        except Exception as e:
+            await self._fail(job, f"{type(e).__name__}: {e}")
+            return
+        await self._update(
+            job_id,
+            status='succeeded',
+            progress=1.0,
+            result_json=json.dumps(result, ensure_ascii=False) if result is not None else None,
+            last_error=None,
+            finished_at=time.time()
+        )
+        logger.info(f"Job {job_id} ({job['job_type']}) succeeded after {job['attempts']} attempt(s)")
+
+    async def _fail(self, job: Dict[str, Any], error: str, retryable: bool = True) -> None:
+        job_id = job['job_id']
+        if retryable and job['attempts'] < job['max_attempts']:
+            delay = self._backoff(job['attempts'])
+            await self._update(job_id, status='queued', last_error=error, run_after=time.time() + delay)
+            logger.warning(f"Job {job_id} ({job['job_type']}) failed (attempt {job['attempts']}), retrying in {delay:.1f}s: {error}")
+            return
+
+        now = time.time()
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                "UPDATE jobs SET status = 'dead', last_error = ?, updated_at = ?, finished_at = ? WHERE job_id = ?",
+                (error, now, now, job_id)
+            )
+            await db.execute('''
+                INSERT OR REPLACE INTO dead_letter_jobs (job_id, job_type, payload_json, attempts, last_error, failed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (job_id, job['job_type'], json.dumps(job['payload'], ensure_ascii=False), job['attempts'], error, now))
+            await db.commit()
+        logger.error(f"Job {job_id} ({job['job_type']}) moved to dead letter after {job['attempts']} attempt(s): {error}")
+    # endregion
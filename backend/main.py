@@ -1,4 +1,4 @@
-from fastapi import FastAPI, APIRouter, Request
+from fastapi import FastAPI, APIRouter, Request, HTTPException
 from fastapi.responses import StreamingResponse
 from runtime.runtime import Runtime
 import asyncio
@@ -14,10 +14,18 @@ from OAth.google_auth import auth_router
 # from OAth.google_auth import outh_router
 
 #DB関連
-from db.db_database import async_engine
-from db.models import Base
+from db.db_database import async_engine, AsyncSessionLocal
+from db.models import Base, create_missing_indexes, create_person_data_version_triggers
+from db.search import create_search_index
 
 from utils.get_sys_permanse import get_system_info_dict
+from utils.http_client import start_http_pool, close_http_pool, get_http_pool
+from utils.streaming import cancel_on_disconnect, coalesce, sse_frame
+from runtime.core.cancellation import CancellationToken
+from job_queue import JobQueue
+import db_manager
+from episode_handler import EpisodeHandler
+from question_agent.llm_analyzer import LLMAnalyzer
 
 # 設定
 app = FastAPI()
@@ -58,8 +66,45 @@ async def startup_database_initialize():
     """
     async with async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_missing_indexes)
+        await conn.run_sync(create_search_index)
+        await conn.run_sync(create_person_data_version_triggers)
     print("Database tables checked/created.")
 
+@app.on_event("startup")
+async def startup_http_pool():
+    """
+    外部/内部API呼び出しで共有するHTTPコネクションプールを作る
+    """
+    await start_http_pool(**runtime.config_loader.http_client_config)
+
+@app.on_event("shutdown")
+async def shutdown_http_pool():
+    await close_http_pool()
+
+@app.on_event("startup")
+async def startup_job_queue():
+    """
+    エピソード分析などのバックグラウンドジョブのワーカーを起動する
+    前回実行中のまま止まったジョブはここでキューに戻る
+    """
+    await job_queue.start()
+
+@app.on_event("shutdown")
+async def shutdown_job_queue():
+    await job_queue.stop()
+
+@app.on_event("shutdown")
+async def shutdown_episode_vectors():
+    # 学習中のIVFを待ってからベクトルを書き出す
+    if runtime.episode_vectors is not None:
+        await runtime.episode_vectors.close()
+
+@app.on_event("shutdown")
+async def shutdown_database_pools():
+    # 会話履歴の書き込みバッファにたまっている行を書き込んでから接続を閉じる (ジョブキューの停止後に実行する)
+    await db_manager.close_database_pools()
+
 
 
 # ルーディングの設定
@@ -87,7 +132,22 @@ ai_question_router = APIRouter(
 
 
 # AIを動かす用のruntime
-runtime = Runtime(config_path="config.yaml")
+runtime = Runtime(config_path="config.yaml", person_data_session_factory=AsyncSessionLocal)
+
+# 会話とは別に実行するバックグラウンドジョブのキュー
+job_queue = JobQueue(**runtime.config_loader.job_queue_config)
+
+# エピソード分析はジョブキューで実行する (ここでジョブの種類を登録するので、startupで戻ったジョブもそのまま実行される)
+# 分析には外部のLLMサーバー (episode_analysis.api_url) が必要なので、episode_analysis.enabled のときだけ登録する
+episode_analysis_config = runtime.config_loader.episode_analysis_config
+episode_analysis_enabled = episode_analysis_config['enabled']
+episode_handler = EpisodeHandler(
+    LLMAnalyzer(episode_analysis_config['api_url'], episode_analysis_config['api_key']),
+    batched_analysis=episode_analysis_config['batched_analysis'],
+    job_queue=job_queue if episode_analysis_enabled else None,
+    # 保存したエピソードを関連エピソード検索のインデックスにも追加する (vectors.enabledがfalseならNone)
+    vector_store=runtime.episode_vectors
+)
 
 
 
@@ -99,6 +159,58 @@ def get_ai_status():
     
     return runtimeConfig
 
+@ai_router.get("/cache")
+def get_cache_stats():
+    """
+    プレフィックスKVキャッシュ (メモリ/ディスク)・応答キャッシュ・トークン化キャッシュのヒット率と使用量
+    """
+    return {
+        "prefix_kv": runtime.llama.prefix_cache.stats(),
+        "tokens": runtime.llama.token_cache.stats(),
+        "response": runtime.response_cache.get_stats() if runtime.response_cache is not None else None,
+    }
+
+@ai_router.get("/speculative")
+def get_speculative_stats():
+    """
+    投機的デコーディングの採択率 (無効な場合はenabled: False)
+    """
+    if runtime.llama.speculative is None:
+        return {"enabled": False}
+    return {"enabled": True, **runtime.llama.speculative.get_stats()}
+
+@ai_router.get("/scheduler")
+def get_scheduler_stats():
+    """
+    連続バッチングスケジューラの統計 (優先度の高いリクエストのためにプリエンプトした回数を含む)
+    """
+    return runtime.scheduler.get_stats()
+
+@ai_router.get("/cancellation")
+def get_cancellation_stats():
+    """
+    切断などで途中キャンセルされた生成の件数と、打ち切りで生成せずに済んだトークン数
+    """
+    scheduler_stats = runtime.scheduler.get_stats()
+    return {
+        "scheduler": {key: scheduler_stats[key] for key in ("cancelled", "saved_tokens")},
+        "llama": runtime.llama.cancellation_stats.get_stats(),
+    }
+
+@ai_router.get("/http")
+def get_http_pool_stats():
+    """
+    共有HTTPコネクションプールの利用状況
+    """
+    return get_http_pool().get_stats()
+
+@ai_router.get("/episodes/related")
+async def get_related_episodes(user_id: int, text: str, limit: int = 5):
+    """
+    テキストと意味の近いエピソードを類似度の高い順に返す (vectors.enabledがfalseなら空)
+    """
+    return {"episodes": await episode_handler.get_related_episodes(user_id, text, limit=min(limit, 50))}
+
 @ai_router.get("/user_help")
 def get_user_help():
     """
@@ -208,13 +320,8 @@ class qu_t(BaseModel):
     user_id:int
     need_theme:str = "Not Found Theme"
 
-@ai_question_router.post("/make")
-async def question_make(contextHello:qu_t,request:Request):
-    if contextHello.need_theme == "Not Found Theme":
-        return {"state":"error","context":"Not Found Theme"}
-    
-    base_url = get_server_host_data(request=request)
-    internal_api_headers = {"Content-Type": "application/json"}
+def build_question_make_prompts(contextHello: qu_t) -> list[tuple[str, str]]:
+    """テーマと観点ごとの質問生成プロンプトを (観点, プロンプト) のリストで返す"""
     # # 　make スレッド
     # need_items = ["what","when","how"]
 
@@ -227,33 +334,64 @@ async def question_make(contextHello:qu_t,request:Request):
     if system_init == False: 
         need_items.append("いつ")
         need_items.append("なぜ")
-    
-    addList:list[str] = []
 
+    prompts = []
     for q_item in need_items:
         # 質問情報
         prompt = f"""
 あなたは質問のプロフェッショナルです。
 {contextHello.need_theme}について{q_item}の観点から質問を考えてください。
-"""     
-        # url = f"{base_url}/ai/question/ask"
-        # print(base_url)
-        # シンプル質問
-        async with httpx.AsyncClient() as client:
-            answer = await call_internal_api(
-                client=client,
-                base_url=base_url,
-                json_payload={"question":prompt,"user_id":contextHello.user_id},
-                method="POST",
-                endpoint="/ai/question/ask",
-                headers=internal_api_headers
-            )    
-        
-        print(f"answer:{answer}")
-        addList.append(answer["answer"]) # {"answer":"answer_context"}だから
+"""
+        prompts.append((q_item, prompt))
+    return prompts
+
+@ai_question_router.post("/make")
+async def question_make(contextHello:qu_t,request:Request):
+    if contextHello.need_theme == "Not Found Theme":
+        return {"state":"error","context":"Not Found Theme"}
+
+    prompts = build_question_make_prompts(contextHello)
+
+    # 観点ごとの生成はランタイムを直接呼び、スケジューラ上で同時にデコードさせる
+    # (以前は観点ごとに/ai/question/askへ順番にHTTPで投げていた)
+    # 質問生成はチャットの応答より後回しにする (near_real_time レーン)
+    addList: list[str] = list(await asyncio.gather(*[
+        runtime.process_message(user_id=contextHello.user_id, message=prompt, lane="near_real_time")
+        for _, prompt in prompts
+    ]))
+    print(f"answer:{addList}")
 
     return {"questions":addList}
 
+@ai_question_router.post("/make/stream")
+async def question_make_stream(contextHello:qu_t):
+    """観点ごとの質問を生成が終わった順にSSEで返す"""
+    if contextHello.need_theme == "Not Found Theme":
+        return {"state":"error","context":"Not Found Theme"}
+
+    prompts = build_question_make_prompts(contextHello)
+
+    async def generate_stream():
+        async for index, question in runtime.process_messages_as_completed(
+            user_id=contextHello.user_id,
+            messages=[prompt for _, prompt in prompts],
+            lane="near_real_time"
+        ):
+            data = {
+                "index": index,
+                "aspect": prompts[index][0],
+                "question": question,
+                "is_complete": False
+            }
+            yield sse_frame(data)
+        yield sse_frame({'is_complete': True})
+
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+    )
+
 class Question_tiket_answer_check(BaseModel):
     question:str = "<<<<<$o__o$>>>>>"
     answer:str = ">S_^_5<"
@@ -272,7 +410,7 @@ async def get_question_answer_check(ticket:Question_tiket_answer_check):
 説明等の他の要素は回答を禁止します。
 """ 
     
-    answer = await runtime.process_message(user_id=ticket.user_id, message=prompt)
+    answer = await runtime.process_message(user_id=ticket.user_id, message=prompt, lane="near_real_time")
     
     if answer in "False":
         return {"state":True}
@@ -412,60 +550,70 @@ def ask_question():
 #         message=f"Question generation for theme '{context_hello.need_theme}' for user {context_hello.user_id} has been initiated."
 #     )
 
-api_concurrecy_limiter = asyncio.Semaphore(4)
 @ai_question_router.post("/ask")
 async def ask_reply(ticket:question_ticket_go):
-    async with api_concurrecy_limiter:
-        """
-        AIがユーザーに対する質問を投げるエンドポイント
-        現在セットされている質問の中から順番に選ぶ
-        内部的にはindexで質問として利用したものをnumberとリストで管理している
-        @pram user_id: ユーザーのID
-        @pram message: ユーザーからのメッセージ(質問)
-        """
-        print(f"ユーザーID: {ticket.user_id}, 質問: {ticket.question}")
-        answer = await runtime.process_message(user_id=ticket.user_id, message=ticket.question)
-        return {"answer": answer}
+    """
+    AIがユーザーに対する質問を投げるエンドポイント
+    現在セットされている質問の中から順番に選ぶ
+    内部的にはindexで質問として利用したものをnumberとリストで管理している
+    同時実行数はスケジューラ (max_sequences) とモデルプールが制御する
+    プロンプトは会話履歴と人格を含めて n_ctx に収まるように組み立てる (履歴ごとに変わるので応答キャッシュは使わない)
+    @pram user_id: ユーザーのID
+    @pram message: ユーザーからのメッセージ(質問)
+    """
+    print(f"ユーザーID: {ticket.user_id}, 質問: {ticket.question}")
+    # エピソード分析はジョブを登録するだけで、応答は分析を待たない
+    if episode_analysis_enabled:
+        await episode_handler.process_conversation_message(ticket.user_id, 'user', ticket.question)
+    answer = await runtime.process_conversation(user_id=ticket.user_id, message=ticket.question)
+    return {"answer": answer}
 
 @ai_question_router.post("/ask/stream")
-async def ask_reply_stream(ticket: question_ticket_go):
+async def ask_reply_stream(ticket: question_ticket_go, request: Request):
     """ストリーミング対応の質問応答エンドポイント"""
+    # クライアントが切断したら、EOSまで回さずに次のデコードステップで生成を打ち切る
+    cancel_token = CancellationToken()
+
     async def generate_stream():
+        watcher = asyncio.create_task(cancel_on_disconnect(request, cancel_token))
         try:
             print(f"[ストリーミング] ユーザーID: {ticket.user_id}, 質問: {ticket.question}")
+            if episode_analysis_enabled:
+                await episode_handler.process_conversation_message(ticket.user_id, 'user', ticket.question)
             
-            # ストリーミング処理を直接実行
-            for chunk in runtime.llama.llm.create_chat_completion(
-                messages=[{"role": "user", "content": ticket.question}],
-                stream=True
-            ):
-                if 'choices' in chunk and len(chunk['choices']) > 0:
-                    delta = chunk['choices'][0].get('delta', {})
-                    if 'content' in delta:
-                        content = delta['content']
-                        data = {
-                            "content": content,
-                            "is_complete": False,
-                            "user_id": ticket.user_id
-                        }
-                        yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            # 推論はワーカースレッド側で進み、ここではテキスト片をawaitするだけ
+            # トークンごとに1イベント送らず、20msか16片ごとにまとめて1イベントにする
+            # 会話履歴と人格を含めたプロンプトで応答し、最後まで送れた応答だけを履歴に保存する
+            async for content in coalesce(runtime.stream_conversation(
+                user_id=ticket.user_id, message=ticket.question, cancel_token=cancel_token
+            )):
+                yield sse_frame({
+                    "content": content,
+                    "is_complete": False,
+                    "user_id": ticket.user_id
+                })
             
+            if cancel_token.cancelled:
+                return
+
             # 完了シグナル
-            final_data = {
+            yield sse_frame({
                 "content": "",
                 "is_complete": True,
                 "user_id": ticket.user_id
-            }
-            yield f"data: {json.dumps(final_data, ensure_ascii=False)}\n\n"
+            })
             
         except Exception as e:
-            error_data = {
+            yield sse_frame({
                 "content": f"エラー: {str(e)}",
                 "is_complete": True,
                 "error": True,
                 "user_id": ticket.user_id
-            }
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+            })
+        finally:
+            # 途中で閉じられた場合 (切断・サーバー停止) も生成を止める
+            cancel_token.cancel("stream closed")
+            watcher.cancel()
     
     return StreamingResponse(
         generate_stream(),
@@ -536,6 +684,30 @@ def set_flow():
 
 
 
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """
+    バックグラウンドジョブの状態と進捗
+    status: queued / running / succeeded / dead (リトライ上限に達した)
+    """
+    job = await job_queue.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return {
+        "job_id": job["job_id"],
+        "job_type": job["job_type"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "progress_message": job["progress_message"],
+        "attempts": job["attempts"],
+        "max_attempts": job["max_attempts"],
+        "last_error": job["last_error"],
+        "result": job["result"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "finished_at": job["finished_at"],
+    }
+
 @app.get("/items/{item_id}")
 def read_item(item_id: int, q: str = None):
     return {"item_id": item_id, "q": q}
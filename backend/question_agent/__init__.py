@@ -1,3 +1 @@
 # from .agent import ai_runtime
-from .agent import test
-test()
\ No newline at end of file
@@ -1,15 +1,82 @@
 import json
 import logging
 from typing import Dict, List, Optional, Union
-import aiohttp
 import asyncio
+from utils.http_client import HttpClientPool, get_http_pool
 
 logger = logging.getLogger('discord')
 
+CONTENT_TYPES = ['事実の記述', '意見の表明', '感情の吐露', '過去の出来事の回想', '価値観の表明', '目標設定', '質問', 'その他']
+SENSITIVITY_LEVELS = ['低', '中', '高', '非常に高い', '極めて高い']
+POLARITIES = ['positive', 'negative', 'neutral', 'mixed']
+
+# 追加分析の全項目を1回の生成で出力させるためのJSONスキーマ (llama.cppのgrammarに変換される)
+ANALYSIS_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'content_type': {'type': 'string', 'enum': CONTENT_TYPES},
+        'emotions': {
+            'type': 'object',
+            'properties': {
+                'emotions': {'type': 'object', 'additionalProperties': {'type': 'number'}},
+                'polarity': {'type': 'string', 'enum': POLARITIES}
+            },
+            'required': ['emotions', 'polarity']
+        },
+        'keywords': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': 5},
+        'topics': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': 2},
+        'named_entities': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {'text': {'type': 'string'}, 'type': {'type': 'string'}},
+                'required': ['text', 'type']
+            }
+        },
+        'sensitivity': {'type': 'string', 'enum': SENSITIVITY_LEVELS}
+    },
+    'required': ['content_type', 'emotions', 'keywords', 'topics', 'named_entities', 'sensitivity']
+}
+
+
+def _is_str_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+# 項目ごとの検証。検証に通らなかった項目だけ個別の分析にフォールバックする
+ANALYSIS_VALIDATORS = {
+    'content_type': lambda v: v in CONTENT_TYPES,
+    'emotions': lambda v: (
+        isinstance(v, dict) and isinstance(v.get('emotions'), dict)
+        and all(isinstance(x, (int, float)) for x in v['emotions'].values())
+        and v.get('polarity') in POLARITIES
+    ),
+    'keywords': _is_str_list,
+    'topics': _is_str_list,
+    'named_entities': lambda v: isinstance(v, list) and all(
+        isinstance(e, dict) and isinstance(e.get('text'), str) and isinstance(e.get('type'), str) for e in v
+    ),
+    'sensitivity': lambda v: v in SENSITIVITY_LEVELS,
+}
+
+
+def parse_json_object(text: str) -> Dict:
+    """生成結果からJSONオブジェクトを取り出す (コードブロックや前後の文章は無視する)"""
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end <= start:
+        raise ValueError(f"No JSON object in response: {text[:100]!r}")
+    value = json.loads(text[start:end + 1])
+    if not isinstance(value, dict):
+        raise ValueError("Response JSON is not an object")
+    return value
+
 class LLMAnalyzer:
-    def __init__(self, api_url: str, api_key: str):
+    def __init__(self, api_url: str, api_key: str, http_client: Optional[HttpClientPool] = None):
         self.api_url = api_url
         self.api_key = api_key
+        # Noneならアプリ共有のコネクションプールを使う
+        self.http_client = http_client
         self.headers = {
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
@@ -138,27 +205,77 @@ class LLMAnalyzer:
             logger.error(f"Error assessing sensitivity: {e}")
             return "低"
 
-    async def _call_llm_api(self, prompt: str) -> str:
+    async def analyze_all(self, text: str) -> Dict:
+        """
+        追加分析の6項目を1回のJSONスキーマ制約付き生成でまとめて求める
+        検証に失敗した項目だけ個別の分析メソッドで求め直す
+        """
+        prompt = f"""
+        以下のテキストを分析し、次の項目をJSON形式で出力してください。
+        - content_type: 内容の種類（{'、'.join(CONTENT_TYPES)}から一つ）
+        - emotions: 主要な感情とその強度（0.0-1.0）のオブジェクト emotions と、全体的な感情の極性 polarity（{', '.join(POLARITIES)}）
+        - keywords: 主要なキーワード（5つ以内）
+        - topics: 主に扱っているトピックの短いフレーズ（2つ以内）
+        - named_entities: 人名、地名、組織名、日付、出来事などの固有表現（text と type）のリスト
+        - sensitivity: プライバシーの観点からの機微性（{'、'.join(SENSITIVITY_LEVELS)}から一つ）
+
+        テキスト：{text}
+
+        JSON出力：
+        """
+        try:
+            result = await self._call_llm_json(prompt, ANALYSIS_SCHEMA, max_tokens=400)
+        except Exception as e:
+            logger.warning(f"Batched analysis failed, falling back to per-field analysis: {e}")
+            result = {}
+
+        fallbacks = {
+            'content_type': self.analyze_content_type,
+            'emotions': self.analyze_emotions,
+            'keywords': self.extract_keywords,
+            'topics': self.identify_topics,
+            'named_entities': self.extract_named_entities,
+            'sensitivity': self.assess_sensitivity,
+        }
+        invalid = [field for field, is_valid in ANALYSIS_VALIDATORS.items() if not is_valid(result.get(field))]
+        if invalid:
+            logger.info(f"Re-analyzing fields individually: {invalid}")
+            values = await asyncio.gather(*[fallbacks[field](text) for field in invalid])
+            result.update(zip(invalid, values))
+
+        result['keywords'] = result['keywords'][:5]
+        result['topics'] = result['topics'][:2]
+        return {field: result[field] for field in ANALYSIS_VALIDATORS}
+
+    async def _call_llm_json(self, prompt: str, schema: Dict, max_tokens: int = 300) -> Dict:
+        """JSONスキーマで出力を制約して呼び出し、JSONオブジェクトとして返す"""
+        response = await self._call_llm_api(prompt, max_tokens=max_tokens, json_schema=schema)
+        return parse_json_object(response)
+
+    async def _call_llm_api(self, prompt: str, max_tokens: int = 150, json_schema: Optional[Dict] = None) -> str:
         """LLM APIを呼び出す"""
-        async with aiohttp.ClientSession() as session:
-            try:
-                payload = {
-                    'prompt': prompt,
-                    'max_tokens': 150,
-                    'temperature': 0.7
-                }
-                
-                async with session.post(
-                    self.api_url,
-                    headers=self.headers,
-                    json=payload
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result['choices'][0]['text'].strip()
-                    else:
-                        error_text = await response.text()
-                        raise Exception(f"API call failed with status {response.status}: {error_text}")
-            except Exception as e:
-                logger.error(f"Error calling LLM API: {e}")
-                raise 
\ No newline at end of file
+        client = self.http_client or get_http_pool()
+        try:
+            payload = {
+                'prompt': prompt,
+                'max_tokens': max_tokens,
+                'temperature': 0.7
+            }
+            if json_schema is not None:
+                # llama.cppサーバーはresponse_formatのスキーマをgrammarに変換して出力を制約する
+                payload['temperature'] = 0.2
+                payload['response_format'] = {'type': 'json_object', 'schema': json_schema}
+            
+            response = await client.post(
+                self.api_url,
+                headers=self.headers,
+                json=payload
+            )
+            if response.status_code == 200:
+                result = response.json()
+                return result['choices'][0]['text'].strip()
+            else:
+                raise Exception(f"API call failed with status {response.status_code}: {response.text}")
+        except Exception as e:
+            logger.error(f"Error calling LLM API: {e}")
+            raise 
\ No newline at end of file
@@ -5,19 +5,19 @@
 import asyncio
 import json
 import time
-from typing import Dict, Any
-from llama_cpp import Llama
+from typing import Dict, Any, Optional
+from runtime.core.model_pool import ModelPool
 
 class AnswerEvaluator:
-    def __init__(self, model_path: str):
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=4096,
-            n_threads=8,
-            verbose=False,
-            use_mmap=True,
-            use_mlock=False
-        )
+    def __init__(self, model_path: str, llama_config: Optional[Dict[str, Any]] = None):
+        # 同じモデルを使う他のサブシステムと重みを共有する
+        # llama_config (Config.llama_handler_config) を渡すとランタイムと同じプールを使う
+        # (n_gpu_layers が違うと重みが別にロードされる)
+        config = dict(llama_config or {})
+        config['model_path'] = model_path
+        config.setdefault('n_ctx', 4096)
+        config.setdefault('n_threads', 8)
+        self.pool = ModelPool.from_config(config)
         
         # 初期化質問用のテンプレート
         # 注: 実際の質問はデータベースの `InitializationQuestion` テーブルに網羅的に定義され、
@@ -83,23 +83,26 @@ class AnswerEvaluator:
             prompt = self._build_standard_evaluation_prompt(question, answer, context)
         
         try:
-            # ストリーミング推論実行
-            response_stream = self.llm(
-                prompt,
-                max_tokens=800,
-                temperature=0.2,
-                stream=True,
-                stop=["</evaluation>", "\n\n---"],
-                top_p=0.9,
-                repeat_penalty=1.1
-            )
-            
             full_response = ""
-            async for chunk in self._async_stream_wrapper(response_stream):
-                if chunk and 'choices' in chunk and chunk['choices']:
-                    token = chunk['choices'][0].get('text', '')
-                    if token:
-                        full_response += token
+            # 回答の評価はチャットの応答に順番を譲る
+            async with self.pool.checkout(lane="near_real_time") as slot:
+                # ストリーミング推論実行 (ワーカースレッドからチャンクを受け取る)
+                response_stream = slot.executor.stream(
+                    slot.llm,
+                    prompt,
+                    max_tokens=800,
+                    temperature=0.2,
+                    stream=True,
+                    stop=["</evaluation>", "\n\n---"],
+                    top_p=0.9,
+                    repeat_penalty=1.1
+                )
+
+                async for chunk in response_stream:
+                    if chunk and 'choices' in chunk and chunk['choices']:
+                        token = chunk['choices'][0].get('text', '')
+                        if token:
+                            full_response += token
             
             # レスポンス解析
             evaluation = self._parse_evaluation_response(full_response)
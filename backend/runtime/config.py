@@ -64,7 +64,71 @@ class Config:
             else:
                  config_for_handler['model_path'] = str(absolute_model_path.resolve())
 
+            # 投機的デコーディング用のドラフトモデルも同じ基準でパスを解決する
+            speculative_config = dict(config_for_handler.get('speculative') or {})
+            if speculative_config.get('draft_model_path'):
+                draft_path = base_dir / Path(speculative_config['draft_model_path'])
+                if not draft_path.is_file():
+                    draft_path = Path(speculative_config['draft_model_path'])
+                speculative_config['draft_model_path'] = str(draft_path.resolve())
+                config_for_handler['speculative'] = speculative_config
+
             return config_for_handler
         except KeyError as e:
             print(f"ERROR: 'llama.runtime_config' or a part of it not found in config YAML. Error: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    @property
+    def scheduler_config(self) -> Dict[str, Any]:
+        # 連続バッチングスケジューラの設定 (llama.scheduler) 。未設定ならデフォルト値を使う
+        scheduler_config = dict(self._config_data.get('llama', {}).get('scheduler') or {})
+        scheduler_config.setdefault('n_batch', self._config_data['llama']['runtime_config'].get('n_batch', 512))
+        return scheduler_config
+
+    @property
+    def response_cache_config(self) -> Dict[str, Any]:
+        # 応答キャッシュの設定 (cache.response) 。類似度キャッシュの埋め込みモデルは未指定なら本体モデルを使う
+        response_config = dict((self._config_data.get('cache') or {}).get('response') or {})
+        semantic_config = dict(response_config.get('semantic') or {})
+        if semantic_config.get('enabled'):
+            runtime_config = self._config_data['llama']['runtime_config']
+            model_path = semantic_config.get('embedding_model_path') or runtime_config['model_path']
+            resolved = self.config_path.parent / Path(model_path)
+            semantic_config['model_path'] = str((resolved if resolved.is_file() else Path(model_path)).resolve())
+            semantic_config.setdefault('n_threads', runtime_config.get('n_threads', 4))
+            semantic_config.setdefault('n_gpu_layers', runtime_config.get('n_gpu_layers', 0))
+        response_config['semantic'] = semantic_config
+        return response_config
+
+    @property
+    def http_client_config(self) -> Dict[str, Any]:
+        # 共有HTTPコネクションプールの設定 (http) 。未設定ならHttpClientPoolのデフォルト値を使う
+        return dict(self._config_data.get('http') or {})
+
+    @property
+    def episode_vectors_config(self) -> Dict[str, Any]:
+        # エピソードの埋め込みインデックスの設定 (vectors) 。埋め込みモデルは未指定なら本体モデルを使う
+        vectors_config = dict(self._config_data.get('vectors') or {})
+        if vectors_config.get('enabled'):
+            runtime_config = self._config_data['llama']['runtime_config']
+            model_path = vectors_config.get('embedding_model_path') or runtime_config['model_path']
+            resolved = self.config_path.parent / Path(model_path)
+            vectors_config['model_path'] = str((resolved if resolved.is_file() else Path(model_path)).resolve())
+            vectors_config.setdefault('n_threads', runtime_config.get('n_threads', 4))
+            vectors_config.setdefault('n_gpu_layers', runtime_config.get('n_gpu_layers', 0))
+        return vectors_config
+
+    @property
+    def episode_analysis_config(self) -> Dict[str, Any]:
+        # エピソード分析に使うLLM APIの設定 (episode_analysis) 。外部のLLMサーバーが必要なのでデフォルトは無効
+        analysis_config = dict(self._config_data.get('episode_analysis') or {})
+        analysis_config.setdefault('enabled', False)
+        analysis_config.setdefault('api_url', 'http://localhost:8080/v1/completions')
+        analysis_config.setdefault('api_key', '')
+        analysis_config.setdefault('batched_analysis', True)
+        return analysis_config
+
+    @property
+    def job_queue_config(self) -> Dict[str, Any]:
+        # バックグラウンドジョブキューの設定 (jobs) 。未設定ならJobQueueのデフォルト値を使う
+        return dict(self._config_data.get('jobs') or {})
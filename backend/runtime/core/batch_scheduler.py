@@ -0,0 +1,721 @@
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+
+from utils.streaming import IncrementalTokenDecoder
+from .cancellation import CancellationToken
+from .prefix_cache import PrefixKVCache, copy_seq_state, set_seq_state
+from .priority import DEFAULT_LANE, FairQueue, lane_rank
+from .speculative import SpeculativeDecoder
+
+
+def _deliver(items: List[Tuple[asyncio.Queue, str]]) -> None:
+    for queue, piece in items:
+        queue.put_nowait(piece)
+
+
+@dataclass
+class GenerationRequest:
+    """スケジューラに投入される1件分の生成リクエスト"""
+    prompt_tokens: List[int]
+    max_tokens: int
+    temperature: float
+    top_p: float
+    top_k: int
+    repeat_penalty: float
+    loop: asyncio.AbstractEventLoop
+    future: asyncio.Future
+    stream_queue: Optional[asyncio.Queue] = None
+    cancel_token: CancellationToken = field(default_factory=CancellationToken)
+    lane: str = DEFAULT_LANE
+    user_id: Any = None
+    # prompt_tokens の先頭のうち、KVスナップショットを共有できる長さ (システムプロンプト + 人格)
+    prefix_len: int = 0
+
+    # 以下はスケジューラ内部の状態
+    # KVに載せるトークン列。プリエンプトされたら プロンプト + 生成済み で作り直す
+    input_tokens: List[int] = field(default_factory=list)
+    seq_id: int = -1
+    n_past: int = 0
+    prefill_pos: int = 0
+    generated: List[int] = field(default_factory=list)
+    text_parts: List[str] = field(default_factory=list)
+    sampler: Optional[internals.LlamaSampler] = None
+    decoder: Any = None
+    last_token: Optional[int] = None
+    # プレフィックスのKVがキャッシュになかったので、プリフィルがprefix_lenに達したら保存する
+    capture_prefix: bool = False
+    # ドラフトモデル側のKVに載っているトークン数 (投機的デコーディング)
+    draft_past: int = 0
+
+    def __post_init__(self):
+        if not self.input_tokens:
+            self.input_tokens = list(self.prompt_tokens)
+
+    @property
+    def rank(self) -> int:
+        return lane_rank(self.lane)
+
+    @property
+    def is_prefilling(self) -> bool:
+        return self.prefill_pos < len(self.input_tokens)
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.cancel_token.cancelled or self.future.cancelled()
+
+
+class ScheduledGeneration:
+    """リクエストごとのハンドル。完了待ち用のfutureとストリーミング用のキューを持つ"""
+
+    def __init__(self, request: GenerationRequest):
+        self._request = request
+
+    @property
+    def future(self) -> asyncio.Future:
+        return self._request.future
+
+    @property
+    def cancel_token(self) -> CancellationToken:
+        return self._request.cancel_token
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """次のデコードステップの前にシーケンス枠を解放させる (それまでの生成結果でfutureが完了する)"""
+        self._request.cancel_token.cancel(reason)
+
+    async def result(self) -> str:
+        return await self._request.future
+
+    async def stream(self) -> AsyncIterator[str]:
+        queue = self._request.stream_queue
+        if queue is None:
+            raise RuntimeError("このリクエストはストリーミング無しで投入されています")
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                yield chunk
+            # 例外で終了した場合はここで送出する
+            await self._request.future
+        finally:
+            # 読み手が途中で抜けた (切断・タスクのキャンセル) ら残りは生成しない
+            if not self._request.future.done():
+                self.cancel("consumer closed")
+
+
+class BatchScheduler:
+    """
+    llama.cppのバッチAPIを使った連続バッチング推論スケジューラ
+    同時に届いたリクエストを別々のシーケンスとして1つのコンテキストに載せ、
+    1回のllama_decodeで全シーケンスを1ステップずつ進める
+
+    待機中のリクエストは優先度レーン (interactive > near_real_time > batch) の順に、
+    同じレーン内はユーザーごとの重みつき公平共有で枠に割り当てる。
+    枠が埋まっているときに優先度の高いリクエストが来たら、プリエンプト可能なレーンのシーケンスを
+    ステップの境目で外し (KVは捨て、再開時に プロンプト + 生成済み を計算し直す) 枠を譲る
+
+    prefix_cache を渡すと、prefix_len つきのリクエストは共有プレフィックスのKVスナップショットを
+    シーケンスに書き戻してからプリフィルを始める (なければ評価し終えた時点で保存する)
+
+    speculative を渡すと、デコード中の各シーケンスの続きをドラフトモデルが数トークン予測し
+    (全シーケンスを1回のデコードにまとめる) 、本体モデルは [直前のトークン] + ドラフト を同じバッチで検証する
+    """
+
+    def __init__(
+        self,
+        llm: Llama,
+        config: Optional[Dict[str, Any]] = None,
+        prefix_cache: Optional[PrefixKVCache] = None,
+        speculative: Optional[SpeculativeDecoder] = None
+    ):
+        config = config or {}
+        self.logger = logging.getLogger(__name__)
+        self.llm = llm
+        self.model = llm._model
+        self.prefix_cache = prefix_cache
+        self.speculative = speculative
+        self.max_sequences: int = int(config.get('max_sequences', 4))
+        self.n_batch: int = int(config.get('n_batch', llm.n_batch))
+        self.default_max_tokens: int = int(config.get('max_tokens', 512))
+        # 優先度の高いリクエストに枠を譲るレーン (質問生成・回答評価も、チャットの応答が来たら枠を譲る)
+        self.preemptible_ranks = {
+            lane_rank(lane) for lane in config.get('preemptible_lanes', ['near_real_time', 'batch'])
+        }
+
+        # シーケンスごとのコンテキスト長は元のLlamaと同じにし、全体をシーケンス数倍に確保する
+        self.n_ctx_per_seq: int = int(config.get('n_ctx_per_seq', llm.n_ctx()))
+        params = type(llm.context_params).from_buffer_copy(llm.context_params)
+        params.n_ctx = self.n_ctx_per_seq * self.max_sequences
+        params.n_seq_max = self.max_sequences
+        params.n_batch = self.n_batch
+        params.n_ubatch = min(self.n_batch, params.n_ubatch)
+        # 重みはLlamaインスタンスとmmap共有し、KVキャッシュだけを別に持つ
+        self._ctx = internals.LlamaContext(model=self.model, params=params, verbose=llm.verbose)
+        self._batch = internals.LlamaBatch(
+            n_tokens=self.n_batch, embd=0, n_seq_max=self.max_sequences, verbose=llm.verbose
+        )
+        # ドラフトモデルも重みは共有し、シーケンス数分のKVを持つコンテキストを別に作る
+        self._draft_ctx: Optional[internals.LlamaContext] = None
+        self._draft_batch: Optional[internals.LlamaBatch] = None
+        if speculative is not None:
+            draft = speculative.draft
+            draft_params = type(draft.context_params).from_buffer_copy(draft.context_params)
+            draft_params.n_ctx = self.n_ctx_per_seq * self.max_sequences
+            draft_params.n_seq_max = self.max_sequences
+            draft_params.n_batch = self.n_batch
+            draft_params.n_ubatch = min(self.n_batch, draft_params.n_ubatch)
+            self._draft_ctx = internals.LlamaContext(model=draft._model, params=draft_params, verbose=llm.verbose)
+            self._draft_batch = internals.LlamaBatch(
+                n_tokens=self.n_batch, embd=0, n_seq_max=self.max_sequences, verbose=llm.verbose
+            )
+
+        self._pending: FairQueue[GenerationRequest] = FairQueue(config.get('user_weights'))
+        self._active: Dict[int, GenerationRequest] = {}
+        # 1ステップ分のストリーミング出力 (ステップの最後にイベントループごとにまとめて渡す)
+        self._outbox: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue, str]] = []
+        self._free_seq_ids: List[int] = list(range(self.max_sequences))
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+        # 統計情報
+        self.stats: Dict[str, int] = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            # 途中でキャンセルされた件数と、打ち切りで生成せずに済んだトークン数 (max_tokens までの残り)
+            'cancelled': 0,
+            'saved_tokens': 0,
+            'decode_steps': 0,
+            'prompt_tokens': 0,
+            'generated_tokens': 0,
+            'max_batch_sequences': 0,
+            'preempted': 0,
+            # KVスナップショットを書き戻してプリフィルを省いた回数とトークン数
+            'prefix_hits': 0,
+            'prefix_reused_tokens': 0,
+        }
+
+    # region 公開API
+    def start(self) -> None:
+        """デコードループ用のワーカースレッドを起動する"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run_loop, name="llama-batch-scheduler", daemon=True)
+        self._thread.start()
+        self.logger.info(
+            f"BatchScheduler started (max_sequences={self.max_sequences}, n_ctx_per_seq={self.n_ctx_per_seq})"
+        )
+
+    def close(self) -> None:
+        """ループを停止し、未完了のリクエストをキャンセルする"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for request in list(self._pending) + list(self._active.values()):
+            self._finish(request, error=RuntimeError("BatchScheduler was closed"))
+        self._pending.clear()
+        self._active.clear()
+        self._batch.close()
+        self._ctx.close()
+        if self._draft_ctx is not None:
+            self._draft_batch.close()
+            self._draft_ctx.close()
+
+    def submit(
+        self,
+        prompt_tokens: List[int],
+        max_tokens: Optional[int] = None,
+        temperature: float = 0.7,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        repeat_penalty: float = 1.1,
+        stream: bool = False,
+        cancel_token: Optional[CancellationToken] = None,
+        lane: str = DEFAULT_LANE,
+        user_id: Any = None,
+        prefix_len: int = 0,
+    ) -> ScheduledGeneration:
+        """
+        トークン列を投入し、完了/ストリーミング用のハンドルを返す (イベントループ上から呼ぶ)
+        cancel_token がキャンセルされると、デコードの合間にシーケンス枠を解放してそこまでの結果で完了する
+        lane は優先度レーン (runtime.core.priority.LANES) 、user_id はレーン内の公平共有の単位
+        prefix_len は prompt_tokens の先頭のうちKVスナップショットを再利用できる長さ (0なら使わない)
+        """
+        if not prompt_tokens:
+            raise ValueError("prompt_tokens must not be empty")
+        lane_rank(lane)
+        max_tokens = max_tokens or self.default_max_tokens
+        if len(prompt_tokens) + 1 > self.n_ctx_per_seq:
+            raise ValueError(
+                f"Prompt is too long ({len(prompt_tokens)} tokens, n_ctx_per_seq={self.n_ctx_per_seq})"
+            )
+
+        loop = asyncio.get_running_loop()
+        request = GenerationRequest(
+            prompt_tokens=list(prompt_tokens),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            repeat_penalty=repeat_penalty,
+            loop=loop,
+            future=loop.create_future(),
+            stream_queue=asyncio.Queue() if stream else None,
+            cancel_token=cancel_token or CancellationToken(),
+            lane=lane,
+            user_id=user_id,
+            # 最後のトークンのlogitsが要るので、プロンプト全体はプレフィックスにしない
+            prefix_len=prefix_len if self.prefix_cache is not None and 0 < prefix_len < len(prompt_tokens) else 0,
+        )
+        if not self._running:
+            self.start()
+        with self._cond:
+            self._pending.push(request, lane, user_id)
+            self.stats['submitted'] += 1
+            self._cond.notify()
+        return ScheduledGeneration(request)
+
+    async def generate(self, prompt_tokens: List[int], **kwargs) -> str:
+        """投入して完了まで待つ"""
+        return await self.submit(prompt_tokens, **kwargs).result()
+
+    async def stream(self, prompt_tokens: List[int], **kwargs) -> AsyncIterator[str]:
+        """投入して生成されたテキスト片を順に返す"""
+        handle = self.submit(prompt_tokens, stream=True, **kwargs)
+        try:
+            async for chunk in handle.stream():
+                yield chunk
+        finally:
+            if not handle.future.done():
+                handle.cancel("consumer closed")
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                **self.stats,
+                'pending': len(self._pending),
+                'active': len(self._active),
+            }
+    # endregion
+
+    # region ワーカースレッド側
+    def _run_loop(self) -> None:
+        while True:
+            with self._cond:
+                while self._running and not self._pending and not self._active:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                self._admit_pending()
+            try:
+                self._step()
+            except Exception as e:
+                # デコード失敗時は載っている全シーケンスを失敗させてKVを空にする
+                self.logger.error(f"Batch decode error: {e}", exc_info=True)
+                for request in list(self._active.values()):
+                    self._release(request, error=e)
+
+    def _admit_pending(self) -> None:
+        """空いているシーケンス枠に待機中のリクエストを割り当てる (ロック保持中に呼ぶ)"""
+        while self._pending:
+            if not self._free_seq_ids and not self._preempt_for(self._pending.peek_rank()):
+                break
+            request = self._pending.pop()
+            if request.is_cancelled:
+                self._finish(request, cancelled=True)
+                continue
+            request.seq_id = self._free_seq_ids.pop(0)
+            if request.sampler is None:
+                request.sampler = self._build_sampler(request)
+                request.decoder = IncrementalTokenDecoder(self.model.detokenize)
+                self.stats['prompt_tokens'] += len(request.prompt_tokens)
+                if self.speculative is not None:
+                    self.speculative.stats['generations'] += 1
+            self._clear_kv(request.seq_id)
+            self._active[request.seq_id] = request
+        self.stats['max_batch_sequences'] = max(self.stats['max_batch_sequences'], len(self._active))
+
+    def _preempt_for(self, rank: int) -> bool:
+        """
+        優先度rankのリクエストのために、それより低い優先度でプリエンプト可能なシーケンスを1つ外す (ロック保持中に呼ぶ)
+        外すのは最も優先度が低く、その中で生成済みが最も少ない (計算し直しが少ない) もの
+        """
+        victims = [r for r in self._active.values() if r.rank > rank and r.rank in self.preemptible_ranks]
+        if not victims:
+            return False
+        victim = max(victims, key=lambda r: (r.rank, -len(r.generated)))
+        self._active.pop(victim.seq_id)
+        self._clear_kv(victim.seq_id)
+        self._free_seq_ids.append(victim.seq_id)
+        self._free_seq_ids.sort()
+        # サンプラーとデコーダの状態は持ち越し、KVだけを次に枠を得たときに計算し直す
+        victim.input_tokens = victim.prompt_tokens + victim.generated
+        victim.seq_id = -1
+        victim.n_past = 0
+        victim.prefill_pos = 0
+        victim.draft_past = 0
+        self._pending.push(victim, victim.lane, victim.user_id, front=True)
+        self.stats['preempted'] += 1
+        return True
+
+    def _clear_kv(self, seq_id: int) -> None:
+        self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        if self._draft_ctx is not None:
+            self._draft_ctx.kv_cache_seq_rm(seq_id, -1, -1)
+
+    def _restore_prefix(self, request: GenerationRequest) -> None:
+        """
+        共有プレフィックスのKVスナップショットをシーケンスに書き戻し、プリフィルをその続きから始める
+        なければプリフィルがプレフィックスの終わりに達した時点で保存する
+        """
+        prefix = request.prompt_tokens[:request.prefix_len]
+        snapshot = self.prefix_cache.get(prefix)
+        if snapshot is None:
+            request.capture_prefix = True
+            return
+        try:
+            set_seq_state(self._ctx.ctx, snapshot.data, request.seq_id)
+        except RuntimeError as e:
+            self.logger.warning(f"Prefix KV restore failed, re-evaluating: {e}")
+            self._ctx.kv_cache_seq_rm(request.seq_id, -1, -1)
+            # 評価し直したKVで壊れたスナップショットを上書きする
+            request.capture_prefix = True
+            return
+        request.n_past = request.prefill_pos = request.prefix_len
+        self.stats['prefix_hits'] += 1
+        self.stats['prefix_reused_tokens'] += request.prefix_len
+
+    def _capture_prefix(self, request: GenerationRequest) -> None:
+        request.capture_prefix = False
+        try:
+            data = copy_seq_state(self._ctx.ctx, request.seq_id)
+            self.prefix_cache.put(request.prompt_tokens[:request.prefix_len], data, user_id=request.user_id)
+        except RuntimeError as e:
+            self.logger.warning(f"Prefix KV snapshot failed: {e}")
+
+    def _build_sampler(self, request: GenerationRequest) -> internals.LlamaSampler:
+        sampler = internals.LlamaSampler()
+        sampler.add_penalties(
+            penalty_last_n=64,
+            penalty_repeat=request.repeat_penalty,
+            penalty_freq=0.0,
+            penalty_present=0.0,
+        )
+        if request.temperature <= 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(request.top_k)
+            sampler.add_top_p(request.top_p, 1)
+            sampler.add_temp(request.temperature)
+            sampler.add_dist(self.llm._seed)
+        return sampler
+
+    def _step(self) -> None:
+        """全アクティブシーケンスを1ステップ進める (デコード1回)"""
+        # キャンセルされたシーケンスは次のデコードに載せず、枠を待機中のリクエストに譲る
+        for request in [r for r in self._active.values() if r.is_cancelled]:
+            self._release(request, cancelled=True)
+        if not self._active:
+            self._flush_outbox()
+            return
+        # 枠を得たばかり (またはプリエンプトから再開した) リクエストは共有プレフィックスのKVを書き戻す
+        for request in self._active.values():
+            if request.prefix_len and request.prefill_pos == 0 and not request.capture_prefix:
+                self._restore_prefix(request)
+
+        proposals: Dict[int, List[int]] = {}
+        if self._draft_ctx is not None:
+            proposals = self._propose([r for r in self._active.values() if not r.is_prefilling])
+
+        batch = self._batch.batch
+        batch.n_tokens = 0
+        logits_index: Dict[int, int] = {}
+        budget = self.n_batch
+        usage: Dict[Any, int] = {}
+
+        # デコード中のシーケンスを優先して1トークンずつ (ドラフトがあれば 直前のトークン + ドラフト を) 載せる
+        for request in self._active.values():
+            if request.is_prefilling:
+                continue
+            proposal = proposals.get(request.seq_id, [])[:max(budget - 1, 0)]
+            proposals[request.seq_id] = proposal
+            if self._draft_ctx is not None:
+                # バッチに載せきれなかったドラフトはドラフト側のKVからも外す
+                self._rollback_draft(request, request.n_past + 1 + len(proposal))
+            if budget <= 0:
+                continue
+            logits_index[request.seq_id] = batch.n_tokens
+            self._add_token(request.last_token, request.n_past, request.seq_id, True)
+            for i, token in enumerate(proposal):
+                self._add_token(token, request.n_past + 1 + i, request.seq_id, True)
+            request.n_past += 1
+            budget -= 1 + len(proposal)
+            usage[request.user_id] = usage.get(request.user_id, 0) + 1 + len(proposal)
+
+        # 残りの枠でプロンプトを分割して流し込む (チャンク化プリフィル) 。優先度の高いレーンから流す
+        for request in sorted(self._active.values(), key=lambda r: r.rank):
+            if not request.is_prefilling or budget <= 0:
+                continue
+            end = request.prefill_pos + budget
+            if request.capture_prefix and request.prefill_pos < request.prefix_len:
+                # スナップショットにプレフィックスより後ろを含めないように、境目でチャンクを切る
+                end = min(end, request.prefix_len)
+            chunk = request.input_tokens[request.prefill_pos:end]
+            for i, token in enumerate(chunk):
+                is_last = request.prefill_pos + i == len(request.input_tokens) - 1
+                self._add_token(token, request.n_past, request.seq_id, is_last)
+                request.n_past += 1
+            request.prefill_pos += len(chunk)
+            budget -= len(chunk)
+            usage[request.user_id] = usage.get(request.user_id, 0) + len(chunk)
+            if not request.is_prefilling:
+                logits_index[request.seq_id] = batch.n_tokens - 1
+
+        if batch.n_tokens == 0:
+            return
+        # 公平共有の消費量はバッチに載せたトークン数で数える
+        with self._cond:
+            for user_id, n_tokens in usage.items():
+                self._pending.charge(user_id, n_tokens)
+
+        self._ctx.decode(self._batch)
+        self.stats['decode_steps'] += 1
+        for request in self._active.values():
+            if request.capture_prefix and request.prefill_pos == request.prefix_len:
+                self._capture_prefix(request)
+
+        for seq_id, idx in logits_index.items():
+            request = self._active[seq_id]
+            if proposals.get(seq_id):
+                self._verify(request, idx, proposals[seq_id])
+                continue
+            token = request.sampler.sample(self._ctx, idx)
+            request.sampler.accept(token)
+            self._on_token(request, token)
+        self._flush_outbox()
+
+    def _propose(self, requests: List[GenerationRequest]) -> Dict[int, List[int]]:
+        """
+        デコード中の各シーケンスの続きをドラフトモデルでgreedyに予測する
+        ドラフト側のKVに足りない分 (プロンプトと前のステップで採用されたトークン) を先に評価し、
+        以降は全シーケンスの1トークンずつを1回のデコードにまとめる
+        """
+        n_draft: Dict[int, int] = {}
+        for request in requests:
+            # 残りの生成数と、検証で載せるトークンがコンテキストに収まる数まで
+            n = min(
+                self.speculative.n_draft,
+                request.max_tokens - len(request.generated) - 1,
+                self.n_ctx_per_seq - request.n_past - 2,
+                self.n_batch - 1,
+            )
+            if n > 0:
+                n_draft[request.seq_id] = n
+        if not n_draft:
+            return {}
+        requests = [r for r in requests if r.seq_id in n_draft]
+        proposals: Dict[int, List[int]] = {r.seq_id: [] for r in requests}
+        batch = self._draft_batch.batch
+        n_vocab = self.model.n_vocab()
+
+        def decode_and_pick(last_index: Dict[int, int]) -> None:
+            self._draft_ctx.decode(self._draft_batch)
+            for seq_id, idx in last_index.items():
+                logits = np.ctypeslib.as_array(
+                    llama_cpp.llama_get_logits_ith(self._draft_ctx.ctx, idx), shape=(n_vocab,)
+                )
+                proposals[seq_id].append(int(np.argmax(logits)))
+            batch.n_tokens = 0
+            last_index.clear()
+
+        # ドラフト側のKVを 直前のトークン の位置まで追いつかせる (n_batch ごとに分けて評価する)
+        batch.n_tokens = 0
+        last_index: Dict[int, int] = {}
+        for request in requests:
+            tokens = (request.prompt_tokens + request.generated)[request.draft_past:request.n_past + 1]
+            for i, token in enumerate(tokens):
+                if batch.n_tokens == self.n_batch:
+                    decode_and_pick(last_index)
+                is_last = i == len(tokens) - 1
+                self._add_token(token, request.draft_past + i, request.seq_id, is_last, self._draft_batch)
+                if is_last:
+                    last_index[request.seq_id] = batch.n_tokens - 1
+            request.draft_past = request.n_past + 1
+        if batch.n_tokens:
+            decode_and_pick(last_index)
+
+        # 予測したトークンを1つずつ評価して次を予測する
+        while True:
+            for request in requests:
+                proposal = proposals[request.seq_id]
+                if len(proposal) >= n_draft[request.seq_id] or llama_cpp.llama_vocab_is_eog(self.model.vocab, proposal[-1]):
+                    continue
+                self._add_token(proposal[-1], request.draft_past, request.seq_id, True, self._draft_batch)
+                last_index[request.seq_id] = batch.n_tokens - 1
+                request.draft_past += 1
+            if not batch.n_tokens:
+                break
+            decode_and_pick(last_index)
+
+        self.speculative.stats['drafted_tokens'] += sum(len(p) for p in proposals.values())
+        return proposals
+
+    def _verify(self, request: GenerationRequest, idx: int, proposal: List[int]) -> None:
+        """
+        本体モデルの各位置で通常どおりサンプリングし、ドラフトと一致した分だけ先に進める
+        (出力の分布は本体モデル単独の場合と変わらない)
+        """
+        stats = self.speculative.stats
+        stats['verify_steps'] += 1
+        # request.n_past は 直前のトークン を載せた直後の位置
+        base = request.n_past
+        accepted = 0
+        for i in range(len(proposal) + 1):
+            token = request.sampler.sample(self._ctx, idx + i)
+            request.sampler.accept(token)
+            matched = (
+                i < len(proposal) and token == proposal[i]
+                and not llama_cpp.llama_vocab_is_eog(self.model.vocab, token)
+            )
+            request.n_past = base + i
+            self._on_token(request, token)
+            stats['generated_tokens'] += 1
+            if self._active.get(request.seq_id) is not request:
+                # EOS・max_tokens・キャンセルで枠を解放した
+                stats['accepted_tokens'] += accepted
+                return
+            if not matched:
+                break
+            accepted += 1
+        stats['accepted_tokens'] += accepted
+
+        # 採用されなかったドラフトのKVを捨てる (最後にサンプリングしたトークンは次のステップで載せる)
+        request.n_past = base + accepted
+        self._ctx.kv_cache_seq_rm(request.seq_id, request.n_past, -1)
+        self._rollback_draft(request, request.n_past)
+
+    def _rollback_draft(self, request: GenerationRequest, n_tokens: int) -> None:
+        """ドラフト側のKVを先頭n_tokensまでに縮める"""
+        if request.draft_past > n_tokens:
+            request.draft_past = n_tokens
+            self._draft_ctx.kv_cache_seq_rm(request.seq_id, n_tokens, -1)
+
+    def _emit(self, request: GenerationRequest, piece: str) -> None:
+        if request.stream_queue is not None:
+            self._outbox.append((request.loop, request.stream_queue, piece))
+
+    def _flush_outbox(self) -> None:
+        """
+        このステップで生成したテキスト片を、イベントループごとに1回の call_soon_threadsafe で渡す
+        (トークンごとにイベントループを起こすと、シーケンス数 x トークン数だけ起床の書き込みが発生する)
+        """
+        if not self._outbox:
+            return
+        by_loop: Dict[asyncio.AbstractEventLoop, List[Tuple[asyncio.Queue, str]]] = {}
+        for loop, queue, piece in self._outbox:
+            by_loop.setdefault(loop, []).append((queue, piece))
+        self._outbox = []
+        for loop, items in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_deliver, items)
+            except RuntimeError:
+                # 呼び出し元のイベントループが既に閉じている
+                pass
+
+    def _add_token(
+        self, token: int, pos: int, seq_id: int, logits: bool, llama_batch: Optional[internals.LlamaBatch] = None
+    ) -> None:
+        batch = (llama_batch or self._batch).batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.seq_id[i][0] = seq_id
+        batch.n_seq_id[i] = 1
+        batch.logits[i] = logits
+        batch.n_tokens += 1
+
+    def _on_token(self, request: GenerationRequest, token: int) -> None:
+        if request.is_cancelled:
+            self._release(request, cancelled=True)
+            return
+
+        if llama_cpp.llama_vocab_is_eog(self.model.vocab, token):
+            self._release(request)
+            return
+
+        request.generated.append(token)
+        request.last_token = token
+        self.stats['generated_tokens'] += 1
+
+        # 複数トークンにまたがるマルチバイト文字を壊さないようにインクリメンタルにデコードする
+        piece = request.decoder.decode([token])
+        if piece:
+            request.text_parts.append(piece)
+            self._emit(request, piece)
+
+        if len(request.generated) >= request.max_tokens or request.n_past + 1 >= self.n_ctx_per_seq:
+            self._release(request)
+
+    def _release(
+        self, request: GenerationRequest, error: Optional[Exception] = None, cancelled: bool = False
+    ) -> None:
+        """シーケンス枠とKVキャッシュを解放し、結果を呼び出し元に返す"""
+        self._active.pop(request.seq_id, None)
+        self._clear_kv(request.seq_id)
+        with self._cond:
+            self._free_seq_ids.append(request.seq_id)
+            self._free_seq_ids.sort()
+        self._finish(request, error=error, cancelled=cancelled)
+
+    def _finish(
+        self, request: GenerationRequest, error: Optional[Exception] = None, cancelled: bool = False
+    ) -> None:
+        if request.sampler is not None:
+            # プリエンプトされて待機中に終わったリクエストもサンプラーを持っている
+            request.sampler.close()
+            request.sampler = None
+        if error is None and not cancelled and request.decoder is not None:
+            tail = request.decoder.flush()
+            if tail:
+                request.text_parts.append(tail)
+                self._emit(request, tail)
+        # 完了の通知より前に、ためているテキスト片を渡しておく
+        self._flush_outbox()
+        if error is not None:
+            self.stats['failed'] += 1
+        elif cancelled:
+            self.stats['cancelled'] += 1
+            self.stats['saved_tokens'] += max(request.max_tokens - len(request.generated), 0)
+        else:
+            self.stats['completed'] += 1
+        text = "".join(request.text_parts)
+
+        def _resolve():
+            if not request.future.done():
+                if error is not None:
+                    request.future.set_exception(error)
+                else:
+                    request.future.set_result(text)
+            if request.stream_queue is not None:
+                request.stream_queue.put_nowait(None)
+
+        try:
+            request.loop.call_soon_threadsafe(_resolve)
+        except RuntimeError:
+            # 呼び出し元のイベントループが既に閉じている
+            pass
+    # endregion
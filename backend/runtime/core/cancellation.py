@@ -0,0 +1,40 @@
+import threading
+from typing import Dict, Optional
+
+
+class CancellationToken:
+    """
+    リクエスト単位のキャンセル要求
+    イベントループ側 (切断検知・Ctrl-C) から cancel() し、推論ループ側がデコードの合間に cancelled を見て止まる
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+class CancellationStats:
+    """キャンセルされた生成の件数と、打ち切りで生成せずに済んだトークン数 (max_tokens までの残り)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cancelled = 0
+        self.saved_tokens = 0
+
+    def record(self, max_tokens: int, generated: int) -> None:
+        with self._lock:
+            self.cancelled += 1
+            self.saved_tokens += max(max_tokens - generated, 0)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'cancelled': self.cancelled, 'saved_tokens': self.saved_tokens}
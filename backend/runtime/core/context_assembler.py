@@ -0,0 +1,159 @@
+# runtime/core/context_assembler.py
+# システムプロンプト・人格スナップショット・会話履歴を n_ctx に収まる1つのトークン列にまとめる
+# 履歴は保存時に数えた token_count を使ってSQLで選ぶので、毎ターン全履歴をトークン化し直すことはない
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import db_manager
+
+logger = logging.getLogger(__name__)
+
+# gemma のチャットテンプレート (llama_cpp.llama_chat_format.format_gemma と同じ形)
+TURN_START = "<start_of_turn>{role}\n"
+TURN_END = "<end_of_turn>\n"
+# gemma には system の役割がないので、システムプロンプトは先頭の user のターンに入れる
+TEMPLATE_ROLES = {'system': 'user', 'user': 'user', 'assistant': 'model'}
+
+
+@dataclass
+class AssembledContext:
+    tokens: List[int]
+    # 新しいメッセージのトークン数 (会話履歴に保存するときにそのまま使う)
+    message_token_count: int
+    history_messages: int
+    history_tokens: int
+    persona_version: Optional[str] = None
+    # 先頭の [BOS] [システムプロンプト + 人格] の長さ (ユーザーごとに共有できるKVの範囲)
+    prefix_length: int = 0
+
+
+class ContextAssembler:
+    """
+    [BOS] [システムプロンプト + 人格] [収まるだけの最新の履歴] [新しいメッセージ] [model のターン開始] の順に並べる
+    履歴の予算は n_ctx - max_new_tokens - (履歴以外のトークン数) で、
+    履歴のトークン列は message_id ごとにメモリにキャッシュする
+    """
+
+    def __init__(
+        self,
+        tokenize: Callable[..., List[int]],
+        n_ctx: int,
+        max_new_tokens: int = 512,
+        bos_token: Optional[int] = None,
+        person_data=None,
+        db_path: str = db_manager.DATABASE,
+        cache_size: int = 4096
+    ):
+        self.tokenize = tokenize
+        self.n_ctx = n_ctx
+        self.max_new_tokens = max_new_tokens
+        self.bos = [bos_token] if bos_token is not None else []
+        self.person_data = person_data
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self._turns = {
+            role: (tokenize(TURN_START.format(role=role), special=True), tokenize(TURN_END, special=True))
+            for role in set(TEMPLATE_ROLES.values())
+        }
+        # テンプレートでメッセージ1件ごとに増えるトークン数
+        self.per_message_tokens = max(len(start) + len(end) for start, end in self._turns.values())
+        self._system_tokens: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._message_tokens: "OrderedDict[int, List[int]]" = OrderedDict()
+
+    def _turn(self, role: str, content_tokens: List[int]) -> List[int]:
+        start, end = self._turns[TEMPLATE_ROLES.get(role, 'user')]
+        return start + content_tokens + end
+
+    def _system(self, system_prompt: str) -> List[int]:
+        tokens = self._system_tokens.get(system_prompt)
+        if tokens is None:
+            tokens = self.tokenize(system_prompt)
+            self._system_tokens[system_prompt] = tokens
+            if len(self._system_tokens) > 16:
+                self._system_tokens.popitem(last=False)
+        else:
+            self._system_tokens.move_to_end(system_prompt)
+        return tokens
+
+    async def _history_tokens(self, rows: List[dict]) -> List[List[int]]:
+        """
+        履歴の各メッセージのトークン列 (キャッシュにないものだけトークン化する)
+        キャッシュの参照・更新はイベントループ上で行い、ワーカースレッドにはトークン化だけを渡す
+        """
+        result: List[Optional[List[int]]] = []
+        for row in rows:
+            tokens = self._message_tokens.get(row['message_id'])
+            if tokens is not None:
+                self._message_tokens.move_to_end(row['message_id'])
+            result.append(tokens)
+        misses = [i for i, tokens in enumerate(result) if tokens is None]
+        if misses:
+            tokenized = await asyncio.to_thread(lambda: [self.tokenize(rows[i]['content']) for i in misses])
+            for i, tokens in zip(misses, tokenized):
+                result[i] = tokens
+                self._message_tokens[rows[i]['message_id']] = tokens
+                self._message_tokens.move_to_end(rows[i]['message_id'])
+            while len(self._message_tokens) > self.cache_size:
+                self._message_tokens.popitem(last=False)
+        return result
+
+    async def assemble(self, user_id: int, message: str, system_prompt: str = "") -> AssembledContext:
+        persona_tokens: List[int] = []
+        persona_version = None
+        if self.person_data is not None:
+            snapshot = await self.person_data.get_person_data(user_id)
+            persona_tokens, persona_version = snapshot.token_ids, snapshot.version
+        system_tokens = self._system(system_prompt) if system_prompt else []
+        message_tokens = self.tokenize(message)
+
+        head = system_tokens + persona_tokens
+        tail = self._turn('user', message_tokens) + self._turns['model'][0]
+        budget = self.n_ctx - self.max_new_tokens - len(self.bos) - len(tail)
+        if head:
+            budget -= len(head) + self.per_message_tokens
+        if budget < 0 and persona_tokens:
+            # 人格を入れると新しいメッセージが入らない場合は人格を諦める
+            logger.warning(f"Dropping persona ({len(persona_tokens)} tokens) for user {user_id}: context is too small")
+            head = system_tokens
+            budget += len(persona_tokens) + (0 if head else self.per_message_tokens)
+            persona_version = None
+        if budget < 0:
+            raise ValueError(
+                f"Message is too long ({len(message_tokens)} tokens, n_ctx={self.n_ctx}, max_new_tokens={self.max_new_tokens})"
+            )
+
+        rows = await db_manager.get_conversation_history_within_budget(
+            user_id, budget, per_message_tokens=self.per_message_tokens, db_path=self.db_path
+        )
+        history = await self._history_tokens(rows)
+        # token_count がなかった行 (見積もり) は実際の数を保存し、見積もりより多かった分は古い方から落とす
+        missing = {row['message_id']: len(tokens) for row, tokens in zip(rows, history) if row['token_count'] is None}
+        if missing:
+            await db_manager.update_conversation_token_counts(missing, db_path=self.db_path)
+        history_tokens = sum(len(tokens) + self.per_message_tokens for tokens in history)
+        while history and history_tokens > budget:
+            history_tokens -= len(history[0]) + self.per_message_tokens
+            rows, history = rows[1:], history[1:]
+
+        tokens = list(self.bos)
+        if head:
+            tokens += self._turn('system', head)
+        prefix_length = len(tokens) if head else 0
+        for row, content_tokens in zip(rows, history):
+            tokens += self._turn(row['role'], content_tokens)
+        tokens += tail
+        logger.debug(
+            f"Assembled {len(tokens)} tokens for user {user_id}: "
+            f"{len(rows)} history messages ({history_tokens} tokens), persona={persona_version}"
+        )
+        return AssembledContext(
+            tokens=tokens,
+            message_token_count=len(message_tokens),
+            history_messages=len(rows),
+            history_tokens=history_tokens,
+            persona_version=persona_version,
+            prefix_length=prefix_length,
+        )
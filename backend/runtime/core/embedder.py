@@ -0,0 +1,40 @@
+from typing import Dict, Any, List
+import logging
+
+import numpy as np
+
+from .model_pool import ModelPool
+
+
+class Embedder:
+    """
+    llama.cppで文章の埋め込みベクトルを計算する
+    重みは生成用と同じModelPoolの仕組みで共有し、埋め込み専用のコンテキストだけを追加で作る
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        self.logger = logging.getLogger(__name__)
+        self.pool = ModelPool.get(
+            model_path=str(config['model_path']),
+            size=config.get('size', 1),
+            n_ctx=config.get('n_ctx', 512),
+            n_batch=config.get('n_batch', 512),
+            n_threads=config.get('n_threads', 4),
+            n_gpu_layers=config.get('n_gpu_layers', 0),
+            embedding=True
+        )
+
+    @staticmethod
+    def _embed_sync(llm, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(llm.embed(texts, normalize=True, truncate=True), dtype=np.float32)
+        return vectors
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """テキストごとにL2正規化済みのベクトルを返す (shape: [len(texts), dim])"""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        async with self.pool.checkout() as slot:
+            return await slot.executor.run(self._embed_sync, slot.llm, texts)
+
+    async def embed_one(self, text: str) -> np.ndarray:
+        return (await self.embed([text]))[0]
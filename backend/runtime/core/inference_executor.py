@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import queue
+import threading
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
+
+
+class InferenceQueueFullError(RuntimeError):
+    """推論キューが満杯で新しいジョブを受け付けられない"""
+    pass
+
+
+_STREAM_END = object()
+
+
+class InferenceExecutor:
+    """
+    llama.cppのブロッキング呼び出しを専用ワーカースレッドで実行するエグゼキュータ
+    イベントループはジョブの完了をawaitするだけなので、生成中もDBやOAuthのルートが応答できる
+    """
+
+    def __init__(self, max_queue_size: int = 16, name: str = "llama-inference"):
+        self.logger = logging.getLogger(__name__)
+        self.max_queue_size = max_queue_size
+        self._queue: queue.Queue[Optional[Callable[[], None]]] = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._worker, name=name, daemon=True)
+        self._thread.start()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                # ジョブ側で例外はfutureに詰めているので、ここに来るのは想定外のみ
+                self.logger.error(f"Inference worker error: {e}", exc_info=True)
+
+    def _enqueue(self, job: Callable[[], None]) -> None:
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise InferenceQueueFullError(
+                f"Inference queue is full (max_queue_size={self.max_queue_size})"
+            )
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """fnをワーカースレッドで実行し、その戻り値をawaitする"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _set(setter, value):
+            if not future.done():
+                setter(value)
+
+        def job():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                loop.call_soon_threadsafe(_set, future.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(_set, future.set_result, result)
+
+        self._enqueue(job)
+        return await future
+
+    async def stream(self, fn: Callable[..., Iterable[Any]], *args, **kwargs) -> AsyncIterator[Any]:
+        """
+        fnが返すイテレータをワーカースレッドで回し、要素を順にイベントループへ橋渡しする
+        (トークンブリッジ)
+        """
+        loop = asyncio.get_running_loop()
+        bridge: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def job():
+            try:
+                for item in fn(*args, **kwargs):
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(bridge.put_nowait, item)
+            except BaseException as e:
+                loop.call_soon_threadsafe(bridge.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(bridge.put_nowait, _STREAM_END)
+
+        self._enqueue(job)
+        try:
+            while True:
+                item = await bridge.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # 呼び出し側が途中で抜けたらワーカー側の反復も止める
+            stop.set()
+
+    def shutdown(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,135 @@
+from typing import Dict, Any, Optional, Sequence
+from pathlib import Path
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+
+# ファイル形式: マジック(4) + トークン数(uint32) + トークン列(int32 * n) + シーケンス状態
+_MAGIC = b"KVS1"
+_HEADER = struct.Struct("<4sI")
+
+
+class DiskKVStore:
+    """
+    プレフィックスのKVスナップショットをディスクに保存するコンテンツアドレス型ストア
+    ファイル名はプレフィックスのハッシュで、読み込みはmmap経由で必要なときだけ行う
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 8 * 1024 * 1024 * 1024, namespace: str = "default"):
+        self.directory = Path(directory) / namespace
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(__name__)
+        self.total_bytes = sum(p.stat().st_size for p in self.directory.glob("*.kv"))
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.kv"
+
+    def load(self, key: str, tokens: Sequence[int]) -> Optional[memoryview]:
+        """
+        キーに対応する状態をmmapで開く。トークン列が一致しなければNone
+        ヘッダーが読めないファイル (書きかけ・別形式) はミスとして扱い、次から読まないように削除する
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                # ACCESS_COPYにしておくとctypesからそのままポインタとして渡せる
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except ValueError:
+            # 空のファイルはmmapできない
+            self._discard(path, "empty file")
+            return None
+
+        n_tokens = -1
+        if len(mm) >= _HEADER.size:
+            magic, n_tokens = _HEADER.unpack_from(mm, 0)
+            if magic != _MAGIC:
+                n_tokens = -1
+        offset = _HEADER.size + n_tokens * 4
+        if n_tokens < 0 or offset > len(mm):
+            mm.close()
+            self._discard(path, "corrupt header")
+            return None
+
+        stored = np.frombuffer(mm, dtype=np.int32, count=n_tokens, offset=_HEADER.size)
+        matched = stored.tolist() == list(tokens)
+        del stored
+        if not matched:
+            mm.close()
+            self.misses += 1
+            return None
+
+        # 最近使ったものを残すためにアクセス時刻を更新
+        os.utime(path)
+        self.hits += 1
+        return memoryview(mm)[offset:]
+
+    def _discard(self, path: Path, reason: str) -> None:
+        self.logger.warning(f"Discarding unreadable KV state {path.name}: {reason}")
+        self.misses += 1
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return
+        self.total_bytes -= size
+
+    def save(self, key: str, tokens: Sequence[int], data: bytes) -> None:
+        path = self._path(key)
+        if path.exists():
+            os.utime(path)
+            return
+        header = _HEADER.pack(_MAGIC, len(tokens)) + np.asarray(tokens, dtype=np.int32).tobytes()
+        size = len(header) + len(data)
+        if size > self.max_bytes:
+            self.logger.warning(f"KV state ({size} bytes) exceeds disk budget, not stored")
+            return
+
+        # 書き込み途中のファイルを読まないように一時ファイルからrenameする
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.logger.error(f"Failed to store KV state: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self.total_bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        if self.total_bytes <= self.max_bytes:
+            return
+        # 更新時刻が古いものから削除
+        files = sorted(self.directory.glob("*.kv"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            if self.total_bytes <= self.max_bytes:
+                break
+            size = path.stat().st_size
+            path.unlink(missing_ok=True)
+            self.total_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(list(self.directory.glob("*.kv"))),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
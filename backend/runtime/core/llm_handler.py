@@ -1,73 +1,182 @@
 from llama_cpp import Llama
-from typing import Dict, Any
+from typing import Dict, Any, List, Iterator
 import logging
-from typing import Dict, Any
+from .prefix_cache import PrefixKVCache, capture_sequence_state, restore_sequence_state
+from .kv_store import DiskKVStore
+from .speculative import SpeculativeDecoder
+from .model_pool import ModelPool, PooledModel, clone_context
+from .prompt_template import PromptTemplate, TokenizationCache
+from .cancellation import CancellationStats, CancellationToken
+from utils.streaming import IncrementalTokenDecoder
+from pathlib import Path
+import hashlib
+from typing import Dict, Any, Optional
+
+
+# _build_prompt のテンプレート (固定部分はモデルごとに1回だけトークン化する)
+PROMPT_PREFIX_TEMPLATE = PromptTemplate("""<s>[INST] <<SYS>>
+    You are an AI assistant with access to the user's personal data (token: 
+    """)
+PROMPT_SUFFIX_TEMPLATE = PromptTemplate(""").
+    Use this information to provide personalized responses.
+    <</SYS>>
+
+    {prompt} [/INST]""")
+
+# gemma のチャットテンプレート (llama_cpp.llama_chat_format.format_gemma と同じ形。system のメッセージは使わない)
+GEMMA_ROLES = {'user': 'user', 'assistant': 'model'}
+GEMMA_TURN_TEMPLATES = {
+    role: PromptTemplate(f"<start_of_turn>{role}\n{{content}}<end_of_turn>\n", special=True)
+    for role in GEMMA_ROLES.values()
+}
+GEMMA_TURN_START_TEMPLATES = {role: PromptTemplate(f"<start_of_turn>{role}\n", special=True) for role in GEMMA_ROLES.values()}
 
 
 class LlamaHandler:
     def __init__(self, config: Dict[str, Any]):
         self.config = config
         print(self.config)
-        self.llm = Llama(
-            model_path=str(config['model_path']),
-            n_ctx=config['n_ctx'],
-            n_batch=config['n_batch'],
-            n_threads=config['n_threads'],
-            n_gpu_layers=config.get('n_gpu_layers', 1),
-            # n_gpu_layers=-1,
-            chat_format="gemma",
-            verbose=True
-        )
+        # 重みを共有する複数のコンテキストをプロセス全体のプールから借りる
+        self.pool = ModelPool.from_config(config)
+        # トークナイズやスケジューラ用にはプールの先頭のコンテキストを使う
+        self.llm = self.pool.primary.llm
+        self.executor = self.pool.primary.executor
         self.logger = logging.getLogger(__name__)
+        self.model_fingerprint = self._model_fingerprint(config['model_path'])
+        # 同じ文字列のトークン化を繰り返さないためのキャッシュと、固定部分をトークン化済みのテンプレート
+        self.token_cache = TokenizationCache(
+            lambda text, special: self.llm.tokenize(text.encode('utf-8'), add_bos=False, special=special),
+            max_entries=config.get('token_cache_size', 4096)
+        )
+        self.bos_tokens = self.llm.tokenize(b"", add_bos=True)
+        self.prompt_prefix = PROMPT_PREFIX_TEMPLATE.compile(self.token_cache)
+        self.prompt_suffix = PROMPT_SUFFIX_TEMPLATE.compile(self.token_cache)
+        self.chat_turns = {role: template.compile(self.token_cache) for role, template in GEMMA_TURN_TEMPLATES.items()}
+        self.chat_turn_starts = {role: template.compile(self.token_cache).render() for role, template in GEMMA_TURN_START_TEMPLATES.items()}
+        # 切断などで途中キャンセルされたストリーミング生成の件数
+        self.cancellation_stats = CancellationStats()
+        # システムプロンプト + Person Data の評価済みKVをユーザーごとに再利用する
+        prefix_cache_config = config.get('prefix_cache', {}) or {}
+        disk_store = None
+        if prefix_cache_config.get('disk_dir'):
+            # 再起動後も温まった状態から再開できるようにディスクにも保存する
+            disk_store = DiskKVStore(
+                directory=prefix_cache_config['disk_dir'],
+                max_bytes=prefix_cache_config.get('disk_max_bytes', 8 * 1024 * 1024 * 1024),
+                namespace=self.model_fingerprint
+            )
+        self.prefix_cache = PrefixKVCache(
+            max_bytes=prefix_cache_config.get('max_bytes', 1024 * 1024 * 1024),
+            max_entries_per_user=prefix_cache_config.get('max_entries_per_user', 2),
+            disk_store=disk_store
+        )
+        # 小さいドラフトモデルによる投機的デコーディング (オプトイン)
+        self.speculative = None
+        self.speculative_decoders: Dict[int, SpeculativeDecoder] = {}
+        speculative_config = config.get('speculative', {}) or {}
+        if speculative_config.get('enabled'):
+            draft_llm = Llama(
+                model_path=str(speculative_config['draft_model_path']),
+                n_ctx=config['n_ctx'],
+                n_batch=config['n_batch'],
+                n_threads=config['n_threads'],
+                n_gpu_layers=speculative_config.get('n_gpu_layers', 0),
+                verbose=False
+            )
+            # ドラフトの重みも1回だけロードし、プールのコンテキストごとにドラフト用コンテキストを用意する
+            stats = None
+            for slot in self.pool.slots:
+                draft = draft_llm if slot.index == 0 else clone_context(
+                    draft_llm, config['n_ctx'], config['n_batch'], config['n_threads'], None
+                )
+                decoder = SpeculativeDecoder(slot.llm, draft, n_draft=speculative_config.get('n_draft', 4), stats=stats)
+                stats = decoder.stats
+                self.speculative_decoders[slot.index] = decoder
+            self.speculative = self.speculative_decoders[0]
+
+    @staticmethod
+    def _model_fingerprint(model_path) -> str:
+        """モデルが変わったら別のKVとして扱うための識別子"""
+        path = Path(model_path)
+        return hashlib.sha256(f"{path.name}:{path.stat().st_size}".encode('utf-8')).hexdigest()[:16]
         
     async def generate(
         self,
         prompt: str,
         person_data_token: list,
         max_tokens: int = 512,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        user_id: Optional[str] = None
     ) -> str:
+        async with self.pool.checkout() as slot:
+            return await slot.executor.run(self._generate_sync, slot, prompt, person_data_token, max_tokens, temperature, user_id)
+
+    def _generate_sync(
+        self,
+        slot: PooledModel,
+        prompt: str,
+        person_data_token: list,
+        max_tokens: int = 512,
+        temperature: float = 0.7,
+        user_id: Optional[str] = None
+    ) -> str:
+        llm = slot.llm
+        speculative = self.speculative_decoders.get(slot.index)
         try:
             # トークン化されたPerson Dataを含むプロンプトを構築
-            full_prompt = self._build_prompt(prompt, person_data_token)
+            prefix_tokens = self._build_prompt_prefix(person_data_token)
+            suffix_tokens = self._build_prompt_suffix(prompt)
+            full_prompt = prefix_tokens + suffix_tokens
             print(f"full_prpmpt:{full_prompt}")#test
             # これなんか知らないけどデコードの処理がうまくいってない?
-            print(f"==== TEST =====\n\nHelllifieo;jf;oawjfeio;jfo;:{self.llm.detokenize(full_prompt).decode('utf-8', errors='replace')}\n\n ==== =====")
+            print(f"==== TEST =====\n\nHelllifieo;jf;oawjfeio;jfo;:{llm.detokenize(full_prompt).decode('utf-8', errors='replace')}\n\n ==== =====")
 
             # 絶対にここでToken化して処理を行うように整理していないからだろ
             print(f"プロンプトトークンを評価中...")
-            self.llm.eval(full_prompt)
+            self._load_prefix(llm, prefix_tokens, user_id)
+            llm.eval(suffix_tokens)
             print(f"プロンプトトークンの評価完了。")
 
             # 生成するトークンの最大数
             max_new_tokens = 512
             generated_tokens = []
 
-            print(f"epos-token:{self.llm.token_eos()}")
-            print(f"aa:{self.llm.detokenize([106]).decode('utf-8', errors='replace')}")
+            print(f"epos-token:{llm.token_eos()}")
+            print(f"aa:{llm.detokenize([106]).decode('utf-8', errors='replace')}")
             print(f"\n次の{max_new_tokens}個のトークンを生成します:")
-            
-            for i in range(max_new_tokens):
-                # 次のトークンをサンプリング (最も基本的なサンプリング)
-                # temperatureなどのサンプリングパラメータは Llama オブジェクト初期化時や、
-                # より高度なサンプリングメソッド (llm.sample_*) で指定できます。
-                # ここでは、Llamaオブジェクトに設定されたデフォルトのサンプリング設定が使われます。
-                # (明示的に設定したい場合は、Llamaインスタンス作成時に temp, top_k, top_p などを指定するか、
-                #  llama_cpp.llama_sample* 関数群を直接利用します)
-                next_token = self.llm.sample(temp=0.7) # 例: 温度を0.7に設定してサンプリング
-
-                # EOS (End of Sequence) トークンが出たら生成を終了
-                if next_token == self.llm.token_eos() or next_token == 106:
-                    print("  EOSトークンが生成されたため、終了します。")
+
+            if speculative is not None:
+                generated_tokens = list(speculative.generate(
+                    full_prompt,
+                    max_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=self.config.get('top_p', 0.95),
+                    top_k=self.config.get('top_k', 40),
+                    repeat_penalty=self.config.get('repeat_penalty', 1.1)
+                ))
+                self.logger.info(f"Speculative decoding stats: {speculative.get_stats()}")
+            else:
+                for i in range(max_new_tokens):
+                    # 次のトークンをサンプリング (最も基本的なサンプリング)
+                    # temperatureなどのサンプリングパラメータは Llama オブジェクト初期化時や、
+                    # より高度なサンプリングメソッド (llm.sample_*) で指定できます。
+                    # ここでは、Llamaオブジェクトに設定されたデフォルトのサンプリング設定が使われます。
+                    # (明示的に設定したい場合は、Llamaインスタンス作成時に temp, top_k, top_p などを指定するか、
+                    #  llama_cpp.llama_sample* 関数群を直接利用します)
+                    next_token = llm.sample(temp=0.7) # 例: 温度を0.7に設定してサンプリング
+
+                    # EOS (End of Sequence) トークンが出たら生成を終了
+                    if next_token == llm.token_eos() or next_token == 106:
+                        print("  EOSトークンが生成されたため、終了します。")
                     
-                    break
+                        break
 
-                generated_tokens.append(next_token)
-                print(f"  生成されたトークンID [{i+1}]: {next_token}")
+                    generated_tokens.append(next_token)
+                    print(f"  生成されたトークンID [{i+1}]: {next_token}")
 
-                # 新しく生成されたトークンをモデルに評価させる (次の予測のため)
-                # 1トークンずつ評価する場合は、[next_token] のようにリストで渡します
-                self.llm.eval([next_token])
+                    # 新しく生成されたトークンをモデルに評価させる (次の予測のため)
+                    # 1トークンずつ評価する場合は、[next_token] のようにリストで渡します
+                    llm.eval([next_token])
 
             print(f"\n生成されたトークンIDのシーケンス: {generated_tokens}")
 
@@ -77,7 +186,7 @@ class LlamaHandler:
             if generated_tokens:
                 # detokenizeメソッドはバイト列を返すので、.decode('utf-8') が必要
                 # errors='replace' はデコードできない文字があった場合に代替文字に置き換えます
-                decoded_text = self.llm.detokenize(generated_tokens).decode('utf-8', errors='replace')
+                decoded_text = llm.detokenize(generated_tokens).decode('utf-8', errors='replace')
                 print(f"デコードされたテキスト: {decoded_text}")
             else:
                 print("デコードするトークンがありません。")
@@ -98,7 +207,8 @@ class LlamaHandler:
             chat_history = [
                 {"role": "user", "content": prompt}
             ]
-            output = self.llm.create_chat_completion(messages=chat_history)
+            async with self.pool.checkout() as slot:
+                output = await slot.executor.run(slot.llm.create_chat_completion, messages=chat_history)
             return output['choices'][0]['message']['content']
             
         except Exception as e:
@@ -110,39 +220,51 @@ class LlamaHandler:
         prompt: str,
         max_tokens: int = 200,
         temperature: float = 0.7,
-        callback=None
+        callback=None,
+        cancel_token: Optional[CancellationToken] = None
     ):
-        """ストリーミング生成 - トークンごとにコールバックを呼び出す"""
+        """
+        ストリーミング生成 - トークンごとにコールバックを呼び出す
+        cancel_token がキャンセルされたらそこで打ち切り、スロットを次のリクエストに返す
+        """
         try:
             chat_history = [
                 {"role": "user", "content": prompt}
             ]
             
-            # ストリーミング対応のchat completion
-            stream = self.llm.create_chat_completion(
-                messages=chat_history,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                stream=True
-            )
-            
-            full_response = ""
-            for chunk in stream:
-                if 'choices' in chunk and len(chunk['choices']) > 0:
-                    delta = chunk['choices'][0].get('delta', {})
-                    if 'content' in delta:
-                        content = delta['content']
-                        full_response += content
-                        
-                        # コールバック関数があれば呼び出し
-                        if callback:
-                            await callback(content, False)  # False = まだ完了していない
+            parts = []
+            async with self.pool.checkout() as slot:
+                # ストリーミング対応のchat completion (ワーカースレッドからチャンクを受け取る)
+                stream = slot.executor.stream(
+                    slot.llm.create_chat_completion,
+                    messages=chat_history,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    stream=True
+                )
+
+                n_chunks = 0
+                async for chunk in stream:
+                    if cancel_token is not None and cancel_token.cancelled:
+                        # ループを抜けるとワーカー側の反復も止まる
+                        self.cancellation_stats.record(max_tokens, n_chunks)
+                        break
+                    n_chunks += 1
+                    if 'choices' in chunk and len(chunk['choices']) > 0:
+                        delta = chunk['choices'][0].get('delta', {})
+                        if 'content' in delta:
+                            content = delta['content']
+                            parts.append(content)
+
+                            # コールバック関数があれば呼び出し
+                            if callback:
+                                await callback(content, False)  # False = まだ完了していない
             
             # 完了時のコールバック
             if callback:
                 await callback("", True)  # True = 完了
             
-            return full_response
+            return "".join(parts)
             
         except Exception as e:
             self.logger.error(f"Streaming generation error: {e}", exc_info=True)
@@ -153,65 +275,120 @@ class LlamaHandler:
         prompt: str,
         max_tokens: int = 200,
         temperature: float = 0.7,
-        callback=None
+        callback=None,
+        cancel_token: Optional[CancellationToken] = None
     ):
-        """手動ストリーミング生成 - より細かい制御"""
+        """手動ストリーミング生成 - より細かい制御 (cancel_token はデコードの合間に確認する)"""
         try:
-            # プロンプトをトークン化
-            prompt_tokens = self.llm.tokenize(prompt.encode('utf-8'), add_bos=True)
-            
-            # プロンプトを評価
-            self.llm.eval(prompt_tokens)
-            
-            generated_tokens = []
-            full_response = ""
-            
-            for i in range(max_tokens):
-                # 次のトークンをサンプリング
-                next_token = self.llm.sample(temp=temperature)
-                
-                # EOSトークンチェック
-                if next_token == self.llm.token_eos():
-                    break
-                
-                generated_tokens.append(next_token)
-                
-                # トークンをテキストに変換
-                token_text = self.llm.detokenize([next_token]).decode('utf-8', errors='replace')
-                full_response += token_text
-                
-                # コールバック呼び出し
-                if callback:
-                    await callback(token_text, False)
-                
-                # 次の予測のためにトークンを評価
-                self.llm.eval([next_token])
+            parts = []
+            async with self.pool.checkout() as slot:
+                async for token_text in slot.executor.stream(
+                    self._manual_token_iter, slot.llm, prompt, max_tokens, temperature, cancel_token
+                ):
+                    parts.append(token_text)
+
+                    # コールバック呼び出し
+                    if callback:
+                        await callback(token_text, False)
             
             # 完了時のコールバック
             if callback:
                 await callback("", True)
             
-            return full_response
+            return "".join(parts)
             
         except Exception as e:
             self.logger.error(f"Manual streaming generation error: {e}", exc_info=True)
             raise
+
+    def _manual_token_iter(
+        self, llm: Llama, prompt: str, max_tokens: int, temperature: float,
+        cancel_token: Optional[CancellationToken] = None
+    ) -> Iterator[str]:
+        """ワーカースレッド上でトークンを1つずつ生成してテキスト片を返す"""
+        # プロンプトをトークン化
+        prompt_tokens = llm.tokenize(prompt.encode('utf-8'), add_bos=True)
+        
+        # プロンプトを評価
+        llm.eval(prompt_tokens)
+        # 複数トークンにまたがるマルチバイト文字を壊さないようにインクリメンタルにデコードする
+        decoder = IncrementalTokenDecoder(llm.detokenize)
+        
+        for i in range(max_tokens):
+            if cancel_token is not None and cancel_token.cancelled:
+                self.cancellation_stats.record(max_tokens, i)
+                return
+            # 次のトークンをサンプリング
+            next_token = llm.sample(temp=temperature)
+            
+            # EOSトークンチェック
+            if next_token == llm.token_eos():
+                break
+            
+            # トークンをテキストに変換 (文字の途中なら次のトークンまで持ち越す)
+            piece = decoder.decode([next_token])
+            if piece:
+                yield piece
             
+            # 次の予測のためにトークンを評価
+            llm.eval([next_token])
+        tail = decoder.flush()
+        if tail:
+            yield tail
+
+    def _load_prefix(self, llm: Llama, prefix_tokens: list, user_id: Optional[str]) -> None:
+        """共有プレフィックスのKVを復元する。キャッシュになければ評価してスナップショットを保存する"""
+        snapshot = self.prefix_cache.get(prefix_tokens)
+        if snapshot is not None:
+            try:
+                restore_sequence_state(llm, snapshot.tokens, snapshot.data)
+                return
+            except RuntimeError as e:
+                self.logger.warning(f"Prefix KV restore failed, re-evaluating: {e}")
+
+        llm.reset()
+        llm.eval(prefix_tokens)
+        try:
+            self.prefix_cache.put(prefix_tokens, capture_sequence_state(llm), user_id=user_id)
+        except RuntimeError as e:
+            self.logger.warning(f"Prefix KV snapshot failed: {e}")
+
+    def build_chat_tokens(self, messages: List[Dict[str, str]]) -> List[int]:
+        """
+        チャット形式のメッセージをgemmaのテンプレートに整形してトークン化する
+        テンプレートの制御トークンはトークン化済みのものを使い、メッセージの本文だけを (special=False で) トークン化する
+        ターンの境目は制御トークンなので、ターンごとにトークン化してつないでも全体をトークン化した結果と同じになる
+        """
+        turns = [(GEMMA_ROLES[m['role']], m.get('content')) for m in messages if m['role'] in GEMMA_ROLES]
+        tokens = list(self.bos_tokens)
+        for role, content in turns:
+            tokens.extend(self.chat_turns[role].render(content=content) if content else self.chat_turn_starts[role])
+        tokens.extend(self.chat_turn_starts['model'])
+        return tokens
+
+    def tokenize(self, text: str, special: bool = False) -> List[int]:
+        """
+        BOSなしでトークン化する (人格スナップショットなど、プロンプトの途中に入れるテキスト用)
+        special=True でチャットテンプレートの制御トークン (<start_of_turn> など) を解釈する
+        結果はキャッシュするので、同じ文字列を何度渡してもトークン化は1回だけ
+        """
+        return self.token_cache.tokenize(text, special)
+
     def _decode_prompt(self, text: str,ADD_bos:bool) -> list:
-        return self.llm.tokenize(text.encode('utf-8'), add_bos=ADD_bos)
+        # 毎回違うプロンプト全体なので、人格やシステムプロンプトを覚えているキャッシュには入れない
+        return (list(self.bos_tokens) if ADD_bos else []) + self.token_cache.tokenize_uncached(text)
 
 
     def _build_prompt(self, prompt: str, person_data_token: list) -> list:
-        prompt_tokens = self._decode_prompt(text= f"""<s>[INST] <<SYS>>
-    You are an AI assistant with access to the user's personal data (token: 
-    """,ADD_bos=True)
+        return self._build_prompt_prefix(person_data_token) + self._build_prompt_suffix(prompt)
+
+    def _build_prompt_prefix(self, person_data_token: list) -> list:
+        """ユーザーごとに共通な部分 (システムプロンプト + Person Data)"""
+        prompt_tokens = list(self.bos_tokens) + self.prompt_prefix.render()
         prompt_tokens.extend(person_data_token)
-        # prompt_tokens = self.llm.tokenize(user_question.encode('utf-8'), add_bos=True)
-        prompt_tokens.extend(
-            self._decode_prompt(text=f""").
-    Use this information to provide personalized responses.
-    <</SYS>>
+        return prompt_tokens
 
-    {prompt} [/INST]""",ADD_bos=False)
-        )
-        return prompt_tokens
\ No newline at end of file
+    def _build_prompt_suffix(self, prompt: str) -> list:
+        """リクエストごとに変わる部分"""
+        # prompt_tokens = self.llm.tokenize(user_question.encode('utf-8'), add_bos=True)
+        return self.prompt_suffix.render(prompt=prompt)
\ No newline at end of file
@@ -0,0 +1,241 @@
+from typing import Dict, Any, List, Optional, Tuple, AsyncIterator
+from contextlib import asynccontextmanager
+from pathlib import Path
+import asyncio
+import contextlib
+import ctypes
+import logging
+import threading
+
+from llama_cpp import Llama
+import llama_cpp
+import llama_cpp._internals as internals
+import numpy as np
+
+from .inference_executor import InferenceExecutor
+from .priority import DEFAULT_LANE, LANES, lane_rank
+
+
+class PooledModel:
+    """プール内の1コンテキスト (Llama + 専用ワーカースレッド)"""
+
+    def __init__(self, index: int, llm: Llama, executor: InferenceExecutor):
+        self.index = index
+        self.llm = llm
+        self.executor = executor
+        # チェックアウト中の数 (least-loaded の判定に使う)
+        self.in_flight = 0
+        self.completed = 0
+
+
+def clone_context(
+    base: Llama,
+    n_ctx: int,
+    n_batch: int,
+    n_threads: int,
+    chat_format: Optional[str],
+    embedding: bool = False
+) -> Llama:
+    """
+    baseの重み (LlamaModel) を共有したまま、別のコンテキストを持つLlamaを作る
+    Llama()を呼ぶとモデルを再ロードしてしまうため、属性を引き継いでコンテキスト周りだけ差し替える
+    """
+    clone = object.__new__(Llama)
+    clone.__dict__.update(base.__dict__)
+    # コンテキストの解放はクローン側、モデルの解放はbase側が担当する
+    clone._stack = contextlib.ExitStack()
+    n_batch = min(n_ctx, n_batch)
+    params = type(base.context_params).from_buffer_copy(base.context_params)
+    params.n_ctx = n_ctx
+    params.n_batch = n_batch
+    params.n_ubatch = min(n_batch, params.n_ubatch)
+    params.n_threads = n_threads
+    params.n_threads_batch = n_threads
+    params.embeddings = embedding
+    if embedding:
+        params.pooling_type = llama_cpp.LLAMA_POOLING_TYPE_MEAN
+    clone.context_params = params
+    clone.n_batch = n_batch
+    clone.n_threads = n_threads
+    clone.n_threads_batch = n_threads
+    clone._ctx = clone._stack.enter_context(
+        contextlib.closing(internals.LlamaContext(model=base._model, params=params, verbose=base.verbose))
+    )
+    clone._batch = clone._stack.enter_context(
+        contextlib.closing(internals.LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=n_ctx, verbose=base.verbose))
+    )
+    clone.chat_format = chat_format
+    clone.chat_handler = None
+    clone._chat_handlers = {}
+    clone.cache = None
+    clone._sampler = None
+    clone._n_ctx = clone.n_ctx()
+    clone._candidates = internals.LlamaTokenDataArray(n_vocab=clone._n_vocab)
+    clone._mirostat_mu = ctypes.c_float(2.0 * 5.0)
+    clone.n_tokens = 0
+    clone.input_ids = np.ndarray((n_ctx,), dtype=np.intc)
+    clone.scores = np.ndarray((n_ctx if clone._logits_all else n_batch, clone._n_vocab), dtype=np.single)
+    return clone
+
+
+class ModelPool:
+    """
+    同じモデルファイルを1回だけロードし、その重みを共有する複数のコンテキストを貸し出すプール
+    チェックアウトは使用中の数が最も少ないコンテキストに割り当てる (least-loaded)
+
+    プールはモデルパスと設定をキーにプロセス全体で共有されるので、
+    Runtime・QuestionAgent・AnswerEvaluatorがそれぞれモデルをロードすることはない
+    """
+
+    _models: Dict[Tuple[str, int], Llama] = {}
+    _pools: Dict[Tuple, "ModelPool"] = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "ModelPool":
+        """
+        llama.runtime_config と同じ形の設定からプールを得る
+        同じ設定を渡したサブシステム同士はコンテキストも共有し、GPUレイヤー数が同じなら重みも共有する
+        """
+        pool_config = config.get('pool', {}) or {}
+        return cls.get(
+            model_path=str(config['model_path']),
+            size=pool_config.get('size', 1),
+            n_ctx=config['n_ctx'],
+            n_batch=config.get('n_batch', 512),
+            n_threads=config['n_threads'],
+            n_gpu_layers=config.get('n_gpu_layers', 1),
+            chat_format=config.get('chat_format', 'gemma'),
+            max_in_flight=pool_config.get('max_in_flight', 1),
+            executor_queue_size=config.get('executor_queue_size', 16)
+        )
+
+    @classmethod
+    def get(
+        cls,
+        model_path: str,
+        size: int = 1,
+        n_ctx: int = 4096,
+        n_batch: int = 512,
+        n_threads: int = 4,
+        n_gpu_layers: int = 0,
+        chat_format: Optional[str] = None,
+        max_in_flight: int = 1,
+        executor_queue_size: int = 16,
+        embedding: bool = False
+    ) -> "ModelPool":
+        """設定が同じプールがあればそれを返し、なければ作る"""
+        model_path = str(Path(model_path).resolve())
+        key = (model_path, size, n_ctx, n_batch, n_threads, n_gpu_layers, chat_format, max_in_flight, embedding)
+        with cls._registry_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls(model_path, size, n_ctx, n_batch, n_threads, n_gpu_layers, chat_format,
+                           max_in_flight, executor_queue_size, embedding)
+                cls._pools[key] = pool
+            return pool
+
+    def __init__(
+        self,
+        model_path: str,
+        size: int,
+        n_ctx: int,
+        n_batch: int,
+        n_threads: int,
+        n_gpu_layers: int,
+        chat_format: Optional[str],
+        max_in_flight: int,
+        executor_queue_size: int,
+        embedding: bool = False
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.model_path = model_path
+        self.max_in_flight = max_in_flight
+        self.slots: List[PooledModel] = []
+
+        # 重みはモデルパスとGPUオフロード設定ごとに1回だけロードする
+        model_key = (model_path, n_gpu_layers)
+        base = self._models.get(model_key)
+        for index in range(max(1, size)):
+            if base is None:
+                base = Llama(
+                    model_path=model_path,
+                    n_ctx=n_ctx,
+                    n_batch=n_batch,
+                    n_threads=n_threads,
+                    n_gpu_layers=n_gpu_layers,
+                    chat_format=chat_format,
+                    embedding=embedding,
+                    pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN if embedding else llama_cpp.LLAMA_POOLING_TYPE_UNSPECIFIED,
+                    use_mmap=True,
+                    verbose=False
+                )
+                self._models[model_key] = base
+                llm = base
+            else:
+                llm = clone_context(base, n_ctx, n_batch, n_threads, chat_format, embedding)
+            executor = InferenceExecutor(max_queue_size=executor_queue_size, name=f"llama-pool-{index}")
+            self.slots.append(PooledModel(index, llm, executor))
+
+        self._condition: Optional[asyncio.Condition] = None
+        # レーンごとの待機数 (優先度の高いレーンが待っている間は低いレーンに貸さない)
+        self._waiting: List[int] = [0] * len(LANES)
+        self.logger.info(f"ModelPool ready: {Path(model_path).name} x {len(self.slots)} contexts")
+
+    @property
+    def primary(self) -> PooledModel:
+        return self.slots[0]
+
+    def _select(self) -> Optional[PooledModel]:
+        candidates = [slot for slot in self.slots if slot.in_flight < self.max_in_flight]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda slot: (slot.in_flight, slot.completed))
+
+    @asynccontextmanager
+    async def checkout(self, lane: str = DEFAULT_LANE) -> AsyncIterator[PooledModel]:
+        """
+        空いているコンテキストのうち最も負荷の低いものを借りる。全て埋まっていれば空くまで待つ
+        待っている間は優先度レーン (runtime.core.priority.LANES) の高い方から先に貸す
+        """
+        rank = lane_rank(lane)
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            self._waiting[rank] += 1
+            try:
+                slot = self._select()
+                while slot is None or any(self._waiting[:rank]):
+                    await self._condition.wait()
+                    slot = self._select()
+            finally:
+                self._waiting[rank] -= 1
+                if any(self._waiting):
+                    # 自分が待ちから抜けたので、止めていた低いレーンにも空きを確かめさせる
+                    self._condition.notify_all()
+            slot.in_flight += 1
+        try:
+            yield slot
+        finally:
+            async with self._condition:
+                slot.in_flight -= 1
+                slot.completed += 1
+                # 優先度の高い待機者が先に取れるように全員を起こす
+                self._condition.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'model_path': self.model_path,
+            'size': len(self.slots),
+            'max_in_flight': self.max_in_flight,
+            'waiting': dict(zip(LANES, self._waiting)),
+            'slots': [
+                {
+                    'index': slot.index,
+                    'in_flight': slot.in_flight,
+                    'completed': slot.completed,
+                    'queue_size': slot.executor.queue_size,
+                }
+                for slot in self.slots
+            ],
+        }
@@ -1,31 +1,196 @@
-from typing import Dict, Any, Optional
+# runtime/core/person_data_manager.py
+# ユーザーごとの人格スナップショット (描画済みのプロンプト・トークン列・トークン数) を管理する
+# user_info / PersonDataEntry が変わるとトリガーでバージョンが進むので、バージョンが同じ間はDBの組み立てもトークン化もしない
+import array
 import asyncio
-from .token_manager import TokenManager
+import json
+import logging
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import db_manager
+from db import crud
 from .cache_manager import CacheManager
 
+logger = logging.getLogger(__name__)
+
+PERSONA_HEADER = "\n--- 関連ユーザー情報 ---\n"
+PERSONA_FOOTER = "--- ここまで ---\n"
+# 人格スナップショットの保存形式 (変えたら古いスナップショットは作り直す)
+SNAPSHOT_FORMAT = 1
+
+
+def render_line(key: str, value: Any) -> str:
+    """1件の情報をプロンプトの1行にする (think_handler のシステムプロンプトと同じ形式)"""
+    return f"- {key}: {value}\n"
+
+
+def entry_text(entry_content: Any) -> str:
+    """PersonDataEntry.entry_content から本文を取り出す (descriptionがなければJSONのまま)"""
+    if isinstance(entry_content, dict) and entry_content.get("description"):
+        return str(entry_content["description"])
+    return json.dumps(entry_content, ensure_ascii=False)
+
+
+@dataclass
+class PersonaSnapshot:
+    user_id: Any
+    version: str
+    # user_info の info_type -> content
+    values: Dict[str, str] = field(default_factory=dict)
+    # 情報ごとの描画済みの行 (user_info は info_type、PersonDataEntry は "person_data:<id>" がキー)
+    sections: Dict[str, str] = field(default_factory=dict)
+    section_tokens: Dict[str, List[int]] = field(default_factory=dict)
+    prompt_text: str = ""
+    token_ids: List[int] = field(default_factory=list)
+
+    @property
+    def token_count(self) -> int:
+        return len(self.token_ids)
+
+    def render(self, keys: List[str]) -> str:
+        """指定した情報の行だけを描画済みの文字列から組み立てる"""
+        return "".join(self.sections[key] for key in keys if key in self.sections)
+
+
 class PersonDataManager:
-    def __init__(self, cache_size: int = 1000):
-        self.token_manager = TokenManager()
+    """
+    get_person_data(user_id) は現在のバージョンのスナップショットを 1.メモリ 2.DB 3.作り直し の順に探して返す
+    作り直すときは前のスナップショットと行を比べ、変わった行だけをトークン化する
+    session_factory (db.db_database.AsyncSessionLocal) を渡したときだけ PersonDataEntry も含める
+    """
+
+    def __init__(
+        self,
+        tokenize: Optional[Callable[[str], List[int]]] = None,
+        tokenizer_id: str = "",
+        session_factory=None,
+        db_path: str = db_manager.DATABASE,
+        cache_size: int = 1000
+    ):
+        self.tokenize = tokenize
+        self.tokenizer_id = tokenizer_id
+        self.session_factory = session_factory
+        self.db_path = db_path
         self.cache = CacheManager(max_size=cache_size)
-        
-    async def get_person_data(self, user_id: str) -> str:
-        # キャッシュをチェック
-        cached_token = self.cache.get(user_id)
-        if cached_token:
-            return cached_token
-            
-        # データベースから取得
-        person_data = await self._fetch_from_db(user_id)
-        
-        # トークン化
-        token = self.token_manager.encode(person_data)
-        
-        # キャッシュに保存
-        self.cache.put(user_id, token)
-        
-        return token
-        
-    async def _fetch_from_db(self, user_id: str) -> Dict[str, Any]:
-        # データベースからの取得処理
-        # 実際の実装では、DBクライアントを使用
-        pass
\ No newline at end of file
+        # 同じユーザーのスナップショットを同時に何度も作らないためのロック
+        self._locks: "weakref.WeakValueDictionary[Any, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._fixed_tokens: Optional[tuple] = None
+
+    async def get_person_data(self, user_id: Any) -> PersonaSnapshot:
+        version = await self._current_version(user_id)
+        cached = self.cache.get(user_id)
+        if cached is not None and cached.version == version:
+            return cached
+
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        async with lock:
+            cached = self.cache.get(user_id)
+            if cached is not None and cached.version == version:
+                return cached
+            stored = await self._fetch_from_db(user_id)
+            if stored is not None and stored.version == version:
+                snapshot = stored
+            else:
+                snapshot = await self._rebuild(user_id, previous=cached or stored)
+            self.cache.put(user_id, snapshot)
+            return snapshot
+
+    async def _current_version(self, user_id: Any) -> str:
+        user_info_version = await db_manager.get_persona_version(user_id, db_path=self.db_path)
+        person_data_version = 0
+        if self.session_factory is not None:
+            async with self.session_factory() as db:
+                person_data_version = await crud.get_person_data_version(db, str(user_id))
+        return self._version(user_info_version, person_data_version)
+
+    def _version(self, user_info_version: int, person_data_version: int) -> str:
+        return f"{SNAPSHOT_FORMAT}:{user_info_version}:{person_data_version}@{self.tokenizer_id}"
+
+    async def _fetch_from_db(self, user_id: Any) -> Optional[PersonaSnapshot]:
+        """保存されているスナップショットを読む (バージョンが古くても作り直しの材料にする)"""
+        row = await db_manager.get_persona_snapshot(user_id, db_path=self.db_path)
+        if row is None:
+            return None
+        try:
+            data = json.loads(row['sections_json'])
+            token_ids = array.array('i')
+            if row['token_ids']:
+                token_ids.frombytes(row['token_ids'])
+            return PersonaSnapshot(
+                user_id=user_id,
+                version=row['version'],
+                values=data['values'],
+                sections={key: section['text'] for key, section in data['sections'].items()},
+                section_tokens={key: section['tokens'] for key, section in data['sections'].items()
+                                if section.get('tokens') is not None},
+                prompt_text=row['prompt_text'],
+                token_ids=token_ids.tolist(),
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Discarding unreadable persona snapshot for user {user_id}: {e}")
+            return None
+
+    async def _rebuild(self, user_id: Any, previous: Optional[PersonaSnapshot]) -> PersonaSnapshot:
+        # バージョンと中身は同じトランザクションで読むので、途中で変更されても古い中身に新しいバージョンが付くことはない
+        user_info_version, values = await db_manager.get_persona_source(user_id, db_path=self.db_path)
+        person_data_version, entries = 0, []
+        if self.session_factory is not None:
+            async with self.session_factory() as db:
+                person_data_version, entries = await crud.get_person_data_source(db, str(user_id))
+
+        sections = {info_type: render_line(info_type, content) for info_type, content in values.items()}
+        for entry in entries:
+            sections[f"person_data:{entry.id}"] = render_line(entry.tag_name, entry_text(entry.entry_content))
+
+        snapshot = PersonaSnapshot(
+            user_id=user_id,
+            version=self._version(user_info_version, person_data_version),
+            values=values,
+            sections=sections,
+            prompt_text=PERSONA_HEADER + "".join(sections.values()) + PERSONA_FOOTER if sections else "",
+        )
+        if self.tokenize is not None and sections:
+            # トークナイザが同じなら、前回から変わっていない行のトークン列はそのまま使う
+            reusable = previous is not None and previous.version.endswith(f"@{self.tokenizer_id}")
+            snapshot.section_tokens, snapshot.token_ids, tokenized = await asyncio.to_thread(
+                self._tokenize_sections, sections, previous if reusable else None
+            )
+            logger.info(f"Tokenized {tokenized}/{len(sections)} persona sections for user {user_id}")
+
+        sections_json = json.dumps({
+            'values': values,
+            'sections': {key: {'text': text, 'tokens': snapshot.section_tokens.get(key)} for key, text in sections.items()},
+        }, ensure_ascii=False)
+        token_bytes = array.array('i', snapshot.token_ids).tobytes() if self.tokenize is not None else None
+        await db_manager.save_persona_snapshot(
+            user_id, snapshot.version, sections_json, snapshot.prompt_text, token_bytes,
+            snapshot.token_count if self.tokenize is not None else None, db_path=self.db_path
+        )
+        return snapshot
+
+    def _tokenize_sections(self, sections: Dict[str, str], previous: Optional[PersonaSnapshot]):
+        if self._fixed_tokens is None:
+            self._fixed_tokens = (self.tokenize(PERSONA_HEADER), self.tokenize(PERSONA_FOOTER))
+        header, footer = self._fixed_tokens
+        section_tokens: Dict[str, List[int]] = {}
+        tokenized = 0
+        for key, text in sections.items():
+            if previous is not None and previous.sections.get(key) == text and key in previous.section_tokens:
+                section_tokens[key] = previous.section_tokens[key]
+            else:
+                section_tokens[key] = list(self.tokenize(text))
+                tokenized += 1
+        token_ids = list(header)
+        for tokens in section_tokens.values():
+            token_ids.extend(tokens)
+        token_ids.extend(footer)
+        return section_tokens, token_ids, tokenized
+
+    def invalidate(self, user_id: Any) -> None:
+        """メモリ上のスナップショットを捨てる (次の取得でバージョンを確認し直す)"""
+        self.cache.cache.pop(user_id, None)
+        self.cache.access_count.pop(user_id, None)
@@ -0,0 +1,167 @@
+from typing import Dict, Any, Optional, List, Sequence, Union
+from collections import OrderedDict
+from dataclasses import dataclass
+import ctypes
+import hashlib
+import logging
+import threading
+
+import llama_cpp
+import numpy as np
+
+from .kv_store import DiskKVStore
+
+
+@dataclass
+class KVSnapshot:
+    """共有プレフィックスを評価し終えた時点のシーケンス0のKVキャッシュ"""
+    key: str
+    tokens: List[int]
+    data: Union[bytes, memoryview]
+    user_id: Optional[str] = None
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+
+def prefix_key(tokens: Sequence[int]) -> str:
+    """トークン列のハッシュ (キャッシュのキー)"""
+    return hashlib.sha256(np.asarray(tokens, dtype=np.int32).tobytes()).hexdigest()
+
+
+def copy_seq_state(ctx, seq_id: int) -> bytes:
+    """llama_context (ctypesのポインタ) の指定シーケンスのKV状態をバイト列として取り出す"""
+    size = llama_cpp.llama_state_seq_get_size(ctx, seq_id)
+    buffer = (ctypes.c_uint8 * size)()
+    n_bytes = llama_cpp.llama_state_seq_get_data(ctx, buffer, size, seq_id)
+    if n_bytes == 0:
+        raise RuntimeError("Failed to copy sequence state")
+    return bytes(buffer[:n_bytes])
+
+
+def set_seq_state(ctx, data: Union[bytes, memoryview], seq_id: int) -> None:
+    """KV状態を指定シーケンスに書き込む (別のシーケンスから取り出した状態でもよい)"""
+    view = memoryview(data)
+    if view.readonly:
+        buffer = (ctypes.c_uint8 * len(view)).from_buffer_copy(view)
+    else:
+        # mmapされたスナップショットはコピーせずにそのまま渡す
+        buffer = (ctypes.c_uint8 * len(view)).from_buffer(view)
+    if llama_cpp.llama_state_seq_set_data(ctx, buffer, len(view), seq_id) == 0:
+        raise RuntimeError("Failed to restore sequence state")
+
+
+def capture_sequence_state(llm: llama_cpp.Llama, seq_id: int = 0) -> bytes:
+    """指定シーケンスのKV状態をバイト列として取り出す"""
+    return copy_seq_state(llm._ctx.ctx, seq_id)
+
+
+def restore_sequence_state(llm: llama_cpp.Llama, tokens: Sequence[int], data: Union[bytes, memoryview], seq_id: int = 0) -> None:
+    """KV状態を書き戻し、Llama側のトークン位置をプレフィックスの直後に合わせる"""
+    llm._ctx.kv_cache_clear()
+    set_seq_state(llm._ctx.ctx, data, seq_id)
+    n_tokens = len(tokens)
+    llm.input_ids[:n_tokens] = tokens
+    llm.n_tokens = n_tokens
+
+
+class PrefixKVCache:
+    """
+    共有プレフィックス (システムプロンプト + Person Data) のKVスナップショットを保持するLRUキャッシュ
+    全体のバイト数とユーザーごとの件数で上限を設ける
+    disk_storeを渡すとディスクにも書き込み、メモリにない場合はそこから読み込む
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 1024 * 1024 * 1024,
+        max_entries_per_user: int = 2,
+        disk_store: Optional[DiskKVStore] = None
+    ):
+        self.disk_store = disk_store
+        self.max_bytes = max_bytes
+        self.max_entries_per_user = max_entries_per_user
+        self.entries: "OrderedDict[str, KVSnapshot]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(__name__)
+        # プールの複数のワーカースレッドから参照される
+        self._lock = threading.Lock()
+
+    def get(self, tokens: Sequence[int]) -> Optional[KVSnapshot]:
+        with self._lock:
+            return self._get(tokens)
+
+    def _get(self, tokens: Sequence[int]) -> Optional[KVSnapshot]:
+        key = prefix_key(tokens)
+        snapshot = self.entries.get(key)
+        # ハッシュ衝突に備えてトークン列そのものも比較する
+        if snapshot is None or snapshot.tokens != list(tokens):
+            snapshot = self._load_from_disk(key, tokens)
+            if snapshot is None:
+                self.misses += 1
+                return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return snapshot
+
+    def _load_from_disk(self, key: str, tokens: Sequence[int]) -> Optional[KVSnapshot]:
+        if self.disk_store is None:
+            return None
+        data = self.disk_store.load(key, tokens)
+        if data is None:
+            return None
+        self._remove(key)
+        snapshot = KVSnapshot(key=key, tokens=list(tokens), data=data)
+        self.entries[key] = snapshot
+        self.total_bytes += snapshot.nbytes
+        self._evict(None)
+        return snapshot
+
+    def put(self, tokens: Sequence[int], data: bytes, user_id: Optional[str] = None) -> Optional[KVSnapshot]:
+        with self._lock:
+            return self._put(tokens, data, user_id)
+
+    def _put(self, tokens: Sequence[int], data: bytes, user_id: Optional[str] = None) -> Optional[KVSnapshot]:
+        if len(data) > self.max_bytes:
+            self.logger.warning(f"KV snapshot ({len(data)} bytes) exceeds cache budget, not cached")
+            return None
+        key = prefix_key(tokens)
+        self._remove(key)
+        snapshot = KVSnapshot(key=key, tokens=list(tokens), data=data, user_id=user_id)
+        self.entries[key] = snapshot
+        self.total_bytes += snapshot.nbytes
+        self._evict(user_id)
+        if self.disk_store is not None:
+            self.disk_store.save(key, snapshot.tokens, data)
+        return snapshot
+
+    def _remove(self, key: str) -> None:
+        snapshot = self.entries.pop(key, None)
+        if snapshot is not None:
+            self.total_bytes -= snapshot.nbytes
+
+    def _evict(self, user_id: Optional[str]) -> None:
+        # 同じユーザーのスナップショットが多すぎる場合は古いものから削除
+        if user_id is not None:
+            user_keys = [k for k, s in self.entries.items() if s.user_id == user_id]
+            for key in user_keys[:max(0, len(user_keys) - self.max_entries_per_user)]:
+                self._remove(key)
+        # メモリ予算を超えている間は最も使われていないものから削除
+        while self.total_bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self._remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'disk': self.disk_store.stats() if self.disk_store is not None else None,
+        }
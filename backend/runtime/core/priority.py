@@ -0,0 +1,92 @@
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Generic, Hashable, Iterator, List, Optional, TypeVar
+
+# 優先度の高い順。interactive: チャットの応答, near_real_time: 質問生成や回答の評価, batch: バックフィルなどの後回しにできる処理
+LANES = ('interactive', 'near_real_time', 'batch')
+DEFAULT_LANE = 'interactive'
+
+T = TypeVar('T')
+
+
+def lane_rank(lane: str) -> int:
+    """レーン名を優先度 (0が最優先) にする"""
+    try:
+        return LANES.index(lane)
+    except ValueError:
+        raise ValueError(f"Unknown priority lane: {lane} (expected one of {LANES})")
+
+
+class FairQueue(Generic[T]):
+    """
+    優先度レーンつきの待ち行列
+    レーン間は優先度の高い方から取り出し、同じレーン内ではユーザーごとの消費量 (charge した量 / 重み) が
+    最も少ないユーザーから取り出す (重みつき公平共有)。同じユーザーの要求は投入順
+    スレッドセーフではないので、呼び出し側のロックの中で使う
+    """
+
+    def __init__(self, user_weights: Optional[Dict[Any, float]] = None):
+        # 設定ファイルからはキーが文字列でも数値でも来るので文字列にそろえる
+        self.user_weights: Dict[str, float] = {str(user): float(weight) for user, weight in (user_weights or {}).items()}
+        self._lanes: List["OrderedDict[Hashable, Deque[T]]"] = [OrderedDict() for _ in LANES]
+        self._usage: Dict[Hashable, float] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[T]:
+        for users in self._lanes:
+            for items in users.values():
+                yield from items
+
+    def _floor(self) -> float:
+        """待っているユーザーの中で最小の消費量"""
+        waiting = [self._usage.get(user, 0.0) for users in self._lanes for user in users]
+        return min(waiting) if waiting else 0.0
+
+    def push(self, item: T, lane: str, user: Any = None, front: bool = False) -> None:
+        """
+        front=True は先頭に戻す (プリエンプトされた要求の再投入用)
+        しばらく待っていなかったユーザーの消費量は待機中の最小値まで引き上げ、貯金で割り込めないようにする
+        """
+        users = self._lanes[lane_rank(lane)]
+        if not any(user in other for other in self._lanes):
+            self._usage[user] = max(self._usage.get(user, 0.0), self._floor())
+        queue = users.setdefault(user, deque())
+        if front:
+            queue.appendleft(item)
+        else:
+            queue.append(item)
+        self._size += 1
+
+    def peek_rank(self) -> Optional[int]:
+        """次に取り出す要求のレーンの優先度 (空ならNone)"""
+        for rank, users in enumerate(self._lanes):
+            if users:
+                return rank
+        return None
+
+    def pop(self) -> Optional[T]:
+        rank = self.peek_rank()
+        if rank is None:
+            return None
+        users = self._lanes[rank]
+        user = min(users, key=lambda u: self._usage.get(u, 0.0))
+        queue = users[user]
+        item = queue.popleft()
+        if not queue:
+            del users[user]
+        self._size -= 1
+        if not self._size and len(self._usage) > 1024:
+            # 誰も待っていなければ消費量の履歴は不要
+            self._usage.clear()
+        return item
+
+    def charge(self, user: Any, amount: float) -> None:
+        """userが資源をamountだけ使ったことを記録する (重みが大きいほど消費量の増え方が小さい)"""
+        self._usage[user] = self._usage.get(user, 0.0) + amount / self.user_weights.get(str(user), 1.0)
+
+    def clear(self) -> None:
+        for users in self._lanes:
+            users.clear()
+        self._size = 0
@@ -0,0 +1,159 @@
+# runtime/core/prompt_template.py
+# プロンプトのトークン化を速くする
+# - TokenizationCache: 同じ文字列 (Person Data やシステムプロンプトなど) のトークン化結果をハッシュをキーにLRUで覚える
+# - PromptTemplate: テンプレートの固定部分をモデルごとに1回だけトークン化し、呼び出し時は {slot} の値だけをトークン化する
+import hashlib
+import re
+import string
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+Tokenize = Callable[[str, bool], List[int]]
+
+# 分けてトークン化しても全体をトークン化した結果と同じになるかを確かめる文字列
+PROBE_TEXT = "確認用 probe"
+# テンプレートの固定部分に書く制御トークン (<start_of_turn>, <|im_start|> など)
+CONTROL_TOKEN = re.compile(r"<\|?[A-Za-z_]+\|?>")
+
+
+class TokenizationCache:
+    """
+    tokenize(text, special) の結果をLRUで保持する (キーは文字列のblake2bハッシュ)
+    モデル (トークナイザ) ごとに1つ作る。ワーカースレッドからも呼ばれるのでロックで保護する
+    """
+
+    def __init__(self, tokenize: Tokenize, max_entries: int = 4096):
+        self._tokenize = tokenize
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[bytes, bool], Tuple[int, ...]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 別々にトークン化した列をつないでも、つないだ文字列をトークン化した結果と同じになるか
+        # (先頭に空白を足すトークナイザでは、つなぎ目に余計な空白が入るので False になる)
+        self.concatenable = (
+            list(tokenize("\n", False)) + list(tokenize(PROBE_TEXT, False)) == list(tokenize("\n" + PROBE_TEXT, False))
+        )
+
+    @staticmethod
+    def _key(text: str, special: bool) -> Tuple[bytes, bool]:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest(), special
+
+    def tokenize(self, text: str, special: bool = False) -> List[int]:
+        key = self._key(text, special)
+        with self._lock:
+            tokens = self._entries.get(key)
+            if tokens is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(tokens)
+        tokens = tuple(self._tokenize(text, special))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = tokens
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return list(tokens)
+
+    def tokenize_uncached(self, text: str, special: bool = False) -> List[int]:
+        """毎回変わる文字列用 (キャッシュに入れない)"""
+        return list(self._tokenize(text, special))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class PromptTemplate:
+    """
+    str.format 形式のテンプレート ("...{prompt}...") を固定部分と {slot} に分けたもの
+    compile() でトークナイザごとの CompiledTemplate を作る
+    cached_slots に入れたslotの値はTokenizationCacheを通す (毎回変わる値はキャッシュを汚さないように直接トークン化する)
+    固定部分と値は別々にトークン化してつなぐので、境目は改行や空白などトークンの切れ目になる位置に置くこと
+    """
+
+    def __init__(self, template: str, cached_slots: Iterable[str] = (), special: bool = False):
+        self.template = template
+        self.cached_slots = frozenset(cached_slots)
+        self.special = special
+        # [(固定部分, slot名 or None), ...]
+        self.parts: List[Tuple[str, Union[str, None]]] = [
+            (literal, field_name) for literal, field_name, _, _ in string.Formatter().parse(template)
+        ]
+        self.slots = [name for _, name in self.parts if name is not None]
+
+    def compile(self, cache: TokenizationCache) -> "CompiledTemplate":
+        return CompiledTemplate(self, cache)
+
+    def format(self, **values: str) -> str:
+        return self.template.format(**values)
+
+
+class CompiledTemplate:
+    """
+    固定部分をトークン化済みで持つテンプレート。render() は値をトークン化してつなぐだけ
+    先頭に空白を足すトークナイザ (add_space_prefix) などで結果が変わる場合は、全体をトークン化する方法に戻す
+    (special=True のときは固定部分の制御トークンの位置だけで区切り、間の文字列は値も含めて special=False でトークン化する。
+    値の中の "<end_of_turn>" などが制御トークンにならないようにするため)
+    """
+
+    def __init__(self, template: PromptTemplate, cache: TokenizationCache):
+        self.template = template
+        self.cache = cache
+        self.segments: List[Tuple[List[int], Union[str, None]]] = [
+            (cache.tokenize(literal, template.special) if literal else [], name) for literal, name in template.parts
+        ]
+        probe = {name: PROBE_TEXT for name in template.slots}
+        self.exact = cache.concatenable and (
+            self._render_segments(probe) == cache.tokenize_uncached(template.format(**probe), template.special)
+        )
+        # 全体をトークン化する場合の並び: [(制御トークンのトークン列 or None, 文字列 or None, slot名 or None), ...]
+        self.fragments: List[Tuple[Union[List[int], None], Union[str, None], Union[str, None]]] = []
+        for literal, name in template.parts:
+            pieces = re.split(f"({CONTROL_TOKEN.pattern})", literal) if template.special else [literal]
+            for i, piece in enumerate(pieces):
+                if i % 2:
+                    self.fragments.append((cache.tokenize(piece, True), None, None))
+                elif piece:
+                    self.fragments.append((None, piece, None))
+            if name is not None:
+                self.fragments.append((None, None, name))
+
+    def render(self, **values: str) -> List[int]:
+        if not self.exact:
+            return self._render_fragments(values)
+        return self._render_segments(values)
+
+    def _render_fragments(self, values: Dict[str, str]) -> List[int]:
+        # 値を含む文字列はキャッシュを汚さないように直接トークン化する (cached_slotsがあるテンプレートは覚える)
+        tokenize = (
+            self.cache.tokenize if self.template.cached_slots or not self.template.slots else self.cache.tokenize_uncached
+        )
+        tokens: List[int] = []
+        text = ""
+        for control_tokens, literal, name in self.fragments:
+            if control_tokens is None:
+                text += literal if name is None else values[name]
+                continue
+            if text:
+                tokens.extend(tokenize(text, False))
+                text = ""
+            tokens.extend(control_tokens)
+        if text:
+            tokens.extend(tokenize(text, False))
+        return tokens
+
+    def _render_segments(self, values: Dict[str, str]) -> List[int]:
+        tokens: List[int] = []
+        for static_tokens, name in self.segments:
+            tokens.extend(static_tokens)
+            if name is None:
+                continue
+            value = values[name]
+            if value:
+                if name in self.template.cached_slots:
+                    tokens.extend(self.cache.tokenize(value))
+                else:
+                    tokens.extend(self.cache.tokenize_uncached(value))
+        return tokens
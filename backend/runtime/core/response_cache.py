@@ -0,0 +1,211 @@
+from typing import Dict, Any, Optional, Callable, Awaitable, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import unicodedata
+
+import aiosqlite
+import numpy as np
+
+from .embedder import Embedder
+
+
+@dataclass
+class CachedResponse:
+    namespace: str
+    prompt: str
+    response: str
+    created_at: float
+    embedding: Optional[np.ndarray] = None
+
+
+def normalize_prompt(prompt: str) -> str:
+    """全角/半角や空白・改行の違いでキャッシュが外れないように正規化する"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def response_key(namespace: str, normalized_prompt: str) -> str:
+    return hashlib.sha256(f"{namespace}\0{normalized_prompt}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    LLMの応答キャッシュ
+    1段目: 正規化したプロンプトのハッシュで完全一致
+    2段目 (任意): 埋め込みベクトルのコサイン類似度がしきい値以上なら同じ質問とみなす
+    TTLとLRUで古いものを捨て、sqlite_pathを指定すると再起動後も保持する
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: float = 3600,
+        sqlite_path: Optional[str] = None,
+        embedder: Optional[Embedder] = None,
+        similarity_threshold: float = 0.95
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self.entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.logger = logging.getLogger(__name__)
+        self.stats = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._loaded = sqlite_path is None
+        self._load_lock = asyncio.Lock()
+
+    # region 永続化
+    async def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            directory = os.path.dirname(self.sqlite_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            async with aiosqlite.connect(self.sqlite_path) as db:
+                await db.execute('''
+                    CREATE TABLE IF NOT EXISTS response_cache (
+                        key TEXT PRIMARY KEY,
+                        namespace TEXT NOT NULL,
+                        prompt TEXT NOT NULL,
+                        response TEXT NOT NULL,
+                        embedding BLOB,
+                        created_at REAL NOT NULL
+                    )
+                ''')
+                await db.execute('DELETE FROM response_cache WHERE created_at < ?', (time.time() - self.ttl,))
+                await db.commit()
+                async with db.execute(
+                    'SELECT key, namespace, prompt, response, embedding, created_at FROM response_cache '
+                    'ORDER BY created_at DESC LIMIT ?', (self.max_size,)
+                ) as cursor:
+                    rows = await cursor.fetchall()
+            # 古い順に入れてLRUの順序を作る
+            for key, namespace, prompt, response, embedding, created_at in reversed(rows):
+                vector = np.frombuffer(embedding, dtype=np.float32) if embedding is not None else None
+                self.entries[key] = CachedResponse(namespace, prompt, response, created_at, vector)
+            self._loaded = True
+            self.logger.info(f"Loaded {len(rows)} cached responses from {self.sqlite_path}")
+
+    async def _persist(self, key: str, entry: CachedResponse) -> None:
+        if self.sqlite_path is None:
+            return
+        embedding = entry.embedding.astype(np.float32).tobytes() if entry.embedding is not None else None
+        async with aiosqlite.connect(self.sqlite_path) as db:
+            await db.execute(
+                'INSERT OR REPLACE INTO response_cache (key, namespace, prompt, response, embedding, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, entry.namespace, entry.prompt, entry.response, embedding, entry.created_at)
+            )
+            await db.commit()
+
+    async def _delete_persisted(self, keys) -> None:
+        if self.sqlite_path is None or not keys:
+            return
+        async with aiosqlite.connect(self.sqlite_path) as db:
+            await db.executemany('DELETE FROM response_cache WHERE key = ?', [(k,) for k in keys])
+            await db.commit()
+    # endregion
+
+    def _expired(self, entry: CachedResponse) -> bool:
+        return time.time() - entry.created_at > self.ttl
+
+    def _semantic_lookup(self, namespace: str, embedding: np.ndarray) -> Optional[Tuple[str, CachedResponse]]:
+        candidates = [
+            (key, entry) for key, entry in self.entries.items()
+            if entry.namespace == namespace and entry.embedding is not None
+            and entry.embedding.shape == embedding.shape and not self._expired(entry)
+        ]
+        if not candidates:
+            return None
+        # ベクトルは正規化済みなので内積がコサイン類似度になる
+        matrix = np.stack([entry.embedding for _, entry in candidates])
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        return candidates[best]
+
+    async def lookup(self, prompt: str, namespace: str = "default") -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """(キャッシュされた応答, 計算した埋め込み) を返す。埋め込みはstore時に再利用する"""
+        await self._ensure_loaded()
+        normalized = normalize_prompt(prompt)
+        key = response_key(namespace, normalized)
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            if not self._expired(entry):
+                self.entries.move_to_end(key)
+                self.stats['exact_hits'] += 1
+                return entry.response, entry.embedding
+            del self.entries[key]
+            await self._delete_persisted([key])
+
+        embedding = None
+        if self.embedder is not None:
+            embedding = await self.embedder.embed_one(normalized)
+            hit = self._semantic_lookup(namespace, embedding)
+            if hit is not None:
+                self.entries.move_to_end(hit[0])
+                self.stats['semantic_hits'] += 1
+                return hit[1].response, embedding
+
+        self.stats['misses'] += 1
+        return None, embedding
+
+    async def store(self, prompt: str, response: str, namespace: str = "default", embedding: Optional[np.ndarray] = None) -> None:
+        await self._ensure_loaded()
+        normalized = normalize_prompt(prompt)
+        key = response_key(namespace, normalized)
+        if embedding is None and self.embedder is not None:
+            embedding = await self.embedder.embed_one(normalized)
+        entry = CachedResponse(namespace, normalized, response, time.time(), embedding)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.stats['stores'] += 1
+
+        evicted = []
+        while len(self.entries) > self.max_size:
+            evicted_key, _ = self.entries.popitem(last=False)
+            evicted.append(evicted_key)
+        self.stats['evictions'] += len(evicted)
+        await self._delete_persisted(evicted)
+        await self._persist(key, entry)
+
+    async def get_or_generate(
+        self,
+        prompt: str,
+        generate: Callable[[], Awaitable[str]],
+        namespace: str = "default",
+        use_cache: bool = True,
+        refresh: bool = False
+    ) -> str:
+        """
+        キャッシュにあればそれを返し、なければgenerate()の結果を保存して返す
+        use_cache=False: キャッシュを一切使わない / refresh=True: 読まずに生成し直して上書きする
+        """
+        if not use_cache:
+            return await generate()
+        embedding = None
+        if not refresh:
+            cached, embedding = await self.lookup(prompt, namespace)
+            if cached is not None:
+                return cached
+        response = await generate()
+        await self.store(prompt, response, namespace, embedding)
+        return response
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        lookups = stats['exact_hits'] + stats['semantic_hits'] + stats['misses']
+        stats['entries'] = len(self.entries)
+        stats['hit_rate'] = (stats['exact_hits'] + stats['semantic_hits']) / lookups if lookups else 0.0
+        stats['semantic_enabled'] = self.embedder is not None
+        return stats
@@ -0,0 +1,161 @@
+from typing import Dict, Any, List, Iterator, Optional
+import logging
+
+from llama_cpp import Llama
+import llama_cpp
+import llama_cpp._internals as internals
+import numpy as np
+
+
+class SpeculativeDecoder:
+    """
+    小さいドラフトモデル (例: gemma-3-1b) が数トークン先まで予測し、
+    本体モデル (例: gemma-3-12b) がそれらを1回のバッチ評価でまとめて検証する投機的デコーディング
+
+    本体モデルの各位置で通常どおりサンプリングし、ドラフトと一致した分だけ先に進むので
+    出力の分布は本体モデル単独の場合と変わらない
+    """
+
+    def __init__(self, target: Llama, draft: Llama, n_draft: int = 4, stats: Optional[Dict[str, int]] = None):
+        if target.n_vocab() != draft.n_vocab():
+            raise ValueError(
+                f"Draft model vocabulary ({draft.n_vocab()}) does not match target ({target.n_vocab()})"
+            )
+        self.target = target
+        self.draft = draft
+        self.n_draft = n_draft
+        self.logger = logging.getLogger(__name__)
+        # [直前のトークン] + ドラフト を一度に評価するためのバッチ
+        self._batch = internals.LlamaBatch(n_tokens=n_draft + 1, embd=0, n_seq_max=1)
+        # プールの各コンテキストのデコーダで集計を共有できるように外から渡せる
+        self.stats = stats if stats is not None else {
+            'generations': 0,
+            'drafted_tokens': 0,
+            'accepted_tokens': 0,
+            'generated_tokens': 0,
+            'verify_steps': 0,
+        }
+
+    def _build_sampler(self, temperature: float, top_p: float, top_k: int, repeat_penalty: float) -> internals.LlamaSampler:
+        sampler = internals.LlamaSampler()
+        sampler.add_penalties(
+            penalty_last_n=64,
+            penalty_repeat=repeat_penalty,
+            penalty_freq=0.0,
+            penalty_present=0.0,
+        )
+        if temperature <= 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(top_k)
+            sampler.add_top_p(top_p, 1)
+            sampler.add_temp(temperature)
+            sampler.add_dist(self.target._seed)
+        return sampler
+
+    def _propose(self, context: List[int], n_draft: int) -> List[int]:
+        """ドラフトモデルでcontextの続きをgreedyにn_draftトークン予測する"""
+        # ドラフト側のKVと共通する部分は再評価しない (最低1トークンは評価してlogitsを得る)
+        common = 0
+        limit = min(self.draft.n_tokens, len(context) - 1)
+        cached = self.draft.input_ids
+        while common < limit and cached[common] == context[common]:
+            common += 1
+        self.draft.n_tokens = common
+        self.draft.eval(context[common:])
+
+        n_vocab = self.draft.n_vocab()
+        proposal: List[int] = []
+        for i in range(n_draft):
+            logits = np.ctypeslib.as_array(
+                llama_cpp.llama_get_logits_ith(self.draft._ctx.ctx, -1), shape=(n_vocab,)
+            )
+            token = int(np.argmax(logits))
+            proposal.append(token)
+            if self._is_eog(token) or i == n_draft - 1:
+                break
+            self.draft.eval([token])
+        return proposal
+
+    def _is_eog(self, token: int) -> bool:
+        return bool(llama_cpp.llama_vocab_is_eog(self.target._model.vocab, token))
+
+    def generate(
+        self,
+        prompt_tokens: List[int],
+        max_tokens: int = 512,
+        temperature: float = 0.7,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        repeat_penalty: float = 1.1
+    ) -> Iterator[int]:
+        """
+        prompt_tokensが評価済みの本体モデルから生成したトークンIDを順に返す
+        (target.n_tokens == len(prompt_tokens) を前提とする)
+        """
+        target = self.target
+        ctx = target._ctx
+        n_ctx = target.n_ctx()
+        sampler = self._build_sampler(temperature, top_p, top_k, repeat_penalty)
+        context = list(prompt_tokens)
+        n_past = target.n_tokens
+        generated = 0
+        self.stats['generations'] += 1
+
+        try:
+            # 最初のトークンはプロンプト評価時のlogitsからサンプリング
+            token = sampler.sample(ctx, -1)
+            sampler.accept(token)
+            while True:
+                if self._is_eog(token):
+                    return
+                yield token
+                generated += 1
+                context.append(token)
+                if generated >= max_tokens or n_past + 1 >= n_ctx:
+                    return
+
+                n_draft = min(self.n_draft, max_tokens - generated, n_ctx - n_past - 1)
+                proposal = self._propose(context, n_draft) if n_draft > 0 else []
+                self.stats['drafted_tokens'] += len(proposal)
+
+                # 直前のトークンとドラフトを1回のdecodeで検証する
+                candidates = [token] + proposal
+                self._batch.set_batch(batch=candidates, n_past=n_past, logits_all=True)
+                ctx.decode(self._batch)
+                self.stats['verify_steps'] += 1
+
+                accepted = 0
+                for i in range(len(candidates)):
+                    token = sampler.sample(ctx, i)
+                    sampler.accept(token)
+                    if i < len(proposal) and token == proposal[i] and not self._is_eog(token):
+                        accepted += 1
+                        yield token
+                        generated += 1
+                        context.append(token)
+                        if generated >= max_tokens:
+                            break
+                        continue
+                    break
+                self.stats['accepted_tokens'] += accepted
+
+                # 採用された位置までをKVに残し、それ以降は捨てる
+                n_past += 1 + accepted
+                ctx.kv_cache_seq_rm(-1, n_past, -1)
+                target.input_ids[target.n_tokens:n_past] = context[target.n_tokens:n_past]
+                target.n_tokens = n_past
+                if generated >= max_tokens:
+                    return
+        finally:
+            self.stats['generated_tokens'] += generated
+            sampler.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        drafted = stats['drafted_tokens']
+        stats['acceptance_rate'] = stats['accepted_tokens'] / drafted if drafted else 0.0
+        # 検証1回あたりに進んだトークン数 (1.0なら投機の効果なし)
+        steps = stats['verify_steps']
+        stats['tokens_per_verify'] = (stats['accepted_tokens'] + steps) / steps if steps else 0.0
+        return stats
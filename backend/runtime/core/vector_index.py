@@ -0,0 +1,444 @@
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+from collections import OrderedDict
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import threading
+
+import numpy as np
+
+from .embedder import Embedder
+
+
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f16"
+IDS_FILE = "ids.i64"
+LISTS_FILE = "lists.i32"
+CENTROIDS_FILE = "centroids.npy"
+# IVFを学習する前は全行を1つのクラスタとして扱う
+ALL_ROWS = -1
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def spherical_kmeans(data: np.ndarray, n_clusters: int, n_iter: int = 10, seed: int = 0) -> np.ndarray:
+    """コサイン類似度でのk-means。正規化済みのセントロイドを返す (shape: [n_clusters, dim])"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # 空になったクラスタは適当な点で置き直す
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = data[rng.choice(len(data), size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+
+class UserVectorIndex:
+    """
+    1ユーザー分のエピソード埋め込みのインデックス
+    ベクトルはfloat16のmemmap (vectors.f16) に1行ずつ追記し、行とepisode_idの対応はids.i64に持つ
+    件数がivf_min_sizeを超えたらk-meansでクラスタ (IVF) を学習し、検索時は近いnprobe個のクラスタだけを調べる
+    float16からfloat32への変換は行列積より重いので、検索したクラスタのfloat32版をcache_bytesまでLRUで保持する
+    追加はflush_every件ごとにまとめてディスクへ書き出す (途中で落ちると最後の書き出し以降の追加は読み込まれない)
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        dim: int,
+        ivf_min_size: int = 4096,
+        nprobe: int = 8,
+        cache_bytes: int = 64 * 1024 * 1024,
+        initial_capacity: int = 1024,
+        flush_every: int = 64
+    ):
+        self.directory = directory
+        self.dim = dim
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self.cache_bytes = cache_bytes
+        self.flush_every = flush_every
+        self._unflushed = 0
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        meta = self._read_meta()
+        if meta is not None and meta['dim'] != dim:
+            raise ValueError(f"Vector dim mismatch in {directory}: stored {meta['dim']}, got {dim}")
+        self.count = meta['count'] if meta else 0
+        self.trained_size = meta.get('trained_size', 0) if meta else 0
+        capacity = max(initial_capacity, self.count)
+        if meta is not None:
+            # 拡張の途中で落ちた場合に備えて、実際のファイルサイズから容量を決める
+            capacity = min(
+                os.path.getsize(self._path(VECTORS_FILE)) // (dim * 2),
+                os.path.getsize(self._path(IDS_FILE)) // 8,
+                os.path.getsize(self._path(LISTS_FILE)) // 4,
+            )
+            self.count = min(self.count, capacity)
+        self._open(capacity, create=meta is None)
+
+        self._row_of: Dict[int, int] = {int(episode_id): row for row, episode_id in enumerate(self.ids[:self.count])}
+        self.centroids: Optional[np.ndarray] = None
+        self._members: List[List[int]] = []
+        self._member_arrays: List[Optional[np.ndarray]] = []
+        self._cache: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()  # cluster -> (ids, float32の行列)
+        self._cached_bytes = 0
+        if self.trained_size and os.path.exists(self._path(CENTROIDS_FILE)):
+            self._set_lists(np.load(self._path(CENTROIDS_FILE)), np.asarray(self.lists[:self.count]))
+        if meta is None:
+            self._write_meta()
+
+    # region ファイル
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _read_meta(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(META_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self) -> None:
+        tmp_path = self._path(META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'dim': self.dim, 'count': self.count, 'trained_size': self.trained_size}, f)
+        os.replace(tmp_path, self._path(META_FILE))
+
+    def _open(self, capacity: int, create: bool) -> None:
+        mode = "w+" if create else "r+"
+        self.capacity = capacity
+        self.vectors = np.memmap(self._path(VECTORS_FILE), dtype=np.float16, mode=mode, shape=(capacity, self.dim))
+        self.ids = np.memmap(self._path(IDS_FILE), dtype=np.int64, mode=mode, shape=(capacity,))
+        self.lists = np.memmap(self._path(LISTS_FILE), dtype=np.int32, mode=mode, shape=(capacity,))
+        if create:
+            self.lists[:] = -1
+
+    def _grow(self) -> None:
+        """容量を2倍にする (新しいファイルに写してから置き換える)"""
+        capacity = self.capacity * 2
+        for name, dtype, shape in (
+            (VECTORS_FILE, np.float16, (capacity, self.dim)),
+            (IDS_FILE, np.int64, (capacity,)),
+            (LISTS_FILE, np.int32, (capacity,)),
+        ):
+            old = {VECTORS_FILE: self.vectors, IDS_FILE: self.ids, LISTS_FILE: self.lists}[name]
+            grown = np.memmap(self._path(name + ".tmp"), dtype=dtype, mode="w+", shape=shape)
+            grown[:self.count] = old[:self.count]
+            if name == LISTS_FILE:
+                grown[self.count:] = -1
+            grown.flush()
+            del grown
+        self._flush()
+        del self.vectors, self.ids, self.lists
+        for name in (VECTORS_FILE, IDS_FILE, LISTS_FILE):
+            os.replace(self._path(name + ".tmp"), self._path(name))
+        self._open(capacity, create=False)
+
+    def flush(self) -> None:
+        """まだ書き出していない追加をディスクに反映する"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        # meta.jsonの件数はmemmapを書き出した後に更新する (件数より後ろの行は読み込まない)
+        self.vectors.flush()
+        self.ids.flush()
+        self.lists.flush()
+        self._write_meta()
+        self._unflushed = 0
+    # endregion
+
+    # region IVF
+    def _set_lists(self, centroids: np.ndarray, assignments: np.ndarray) -> None:
+        self.centroids = centroids.astype(np.float32)
+        self._members = [[] for _ in range(len(centroids))]
+        for row, cluster in enumerate(assignments):
+            self._members[int(cluster)].append(row)
+        self._member_arrays = [None] * len(centroids)
+        self._cache.clear()
+        self._cached_bytes = 0
+
+    def _invalidate(self, cluster: int) -> None:
+        if cluster != ALL_ROWS:
+            self._member_arrays[cluster] = None
+        cached = self._cache.pop(cluster, None)
+        if cached is not None:
+            self._cached_bytes -= cached[1].nbytes
+
+    def _assign(self, row: int, vector: np.ndarray) -> None:
+        cluster = int(np.argmax(self.centroids @ vector))
+        self.lists[row] = cluster
+        self._members[cluster].append(row)
+        self._invalidate(cluster)
+
+    def _unassign(self, row: int) -> None:
+        cluster = int(self.lists[row])
+        self._members[cluster].remove(row)
+        self._invalidate(cluster)
+
+    @property
+    def needs_training(self) -> bool:
+        """IVFをまだ作っていないか、学習時から件数が4倍以上に増えてクラスタが粗くなった"""
+        if self.count < self.ivf_min_size:
+            return False
+        return self.trained_size == 0 or self.count >= self.trained_size * 4
+
+    def train(self, n_iter: int = 10, max_train_size: int = 65536) -> None:
+        """
+        IVFのセントロイドを学習して全行をクラスタに割り当て直す
+        重い計算はロックの外で行い、その間に追加・削除された行は最後にロックを取ってから割り当てる
+        """
+        with self._lock:
+            count = self.count
+            if count < 2:
+                return
+            sample_rows = np.random.default_rng(count).choice(count, size=min(count, max_train_size), replace=False)
+            sample = np.asarray(self.vectors[np.sort(sample_rows)], dtype=np.float32)
+            snapshot_ids = np.array(self.ids[:count])
+            snapshot = np.array(self.vectors[:count])
+        n_clusters = max(1, min(int(math.sqrt(count)), len(sample)))
+        centroids = spherical_kmeans(sample, n_clusters, n_iter=n_iter)
+        assignments = np.empty(count, dtype=np.int32)
+        for start in range(0, count, 8192):
+            chunk = snapshot[start:start + 8192].astype(np.float32)
+            assignments[start:start + 8192] = np.argmax(chunk @ centroids.T, axis=1)
+        by_id = dict(zip(snapshot_ids.tolist(), assignments.tolist()))
+
+        with self._lock:
+            current = np.empty(self.count, dtype=np.int32)
+            for row, episode_id in enumerate(self.ids[:self.count].tolist()):
+                cluster = by_id.get(episode_id)
+                if cluster is None:
+                    cluster = int(np.argmax(centroids @ self.vectors[row].astype(np.float32)))
+                current[row] = cluster
+            self.lists[:self.count] = current
+            np.save(self._path(CENTROIDS_FILE), centroids)
+            self.trained_size = self.count
+            self._set_lists(centroids, current)
+            self._flush()
+        self.logger.info(f"Trained IVF for {self.directory}: {n_clusters} clusters over {count} vectors")
+    # endregion
+
+    def add(self, episode_id: int, vector: np.ndarray) -> None:
+        """エピソードのベクトルを追加する (同じepisode_idなら上書き)"""
+        vector = _normalize(vector)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected vector of dim {self.dim}, got {vector.shape[0]}")
+        with self._lock:
+            row = self._row_of.get(episode_id)
+            if row is None:
+                if self.count == self.capacity:
+                    self._grow()
+                row = self.count
+                self.count += 1
+                self._row_of[episode_id] = row
+                self.ids[row] = episode_id
+            elif self.centroids is not None:
+                self._unassign(row)
+            self.vectors[row] = vector.astype(np.float16)
+            if self.centroids is not None:
+                self._assign(row, vector)
+            else:
+                self._invalidate(ALL_ROWS)
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._flush()
+
+    def remove(self, episode_id: int) -> bool:
+        """エピソードのベクトルを削除する (最後の行を空いた行に移して詰める)"""
+        with self._lock:
+            row = self._row_of.pop(episode_id, None)
+            if row is None:
+                return False
+            last = self.count - 1
+            if self.centroids is not None:
+                self._unassign(row)
+            if row != last:
+                if self.centroids is not None:
+                    self._unassign(last)
+                self.vectors[row] = self.vectors[last]
+                self.ids[row] = self.ids[last]
+                self._row_of[int(self.ids[row])] = row
+                if self.centroids is not None:
+                    cluster = int(self.lists[last])
+                    self.lists[row] = cluster
+                    self._members[cluster].append(row)
+            self.lists[last] = -1
+            self.count = last
+            if self.centroids is None:
+                self._invalidate(ALL_ROWS)
+            # 行を移した後の件数を書き出さないと、開き直したときに同じ行が2回現れるのですぐに書き出す
+            self._flush()
+            return True
+
+    def get_vector(self, episode_id: int) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self._row_of.get(episode_id)
+            return None if row is None else self.vectors[row].astype(np.float32)
+
+    def _probe(self, query: np.ndarray) -> List[int]:
+        """調べるクラスタを返す (IVFがなければ全行)"""
+        if self.centroids is None:
+            return [ALL_ROWS]
+        nprobe = min(self.nprobe, len(self.centroids))
+        return np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe].tolist()
+
+    def _cluster_vectors(self, cluster: int) -> Tuple[np.ndarray, np.ndarray]:
+        """クラスタに属する行の (episode_id, float32の行列) を返す"""
+        cached = self._cache.get(cluster)
+        if cached is not None:
+            self._cache.move_to_end(cluster)
+            return cached
+        if cluster == ALL_ROWS:
+            ids = np.array(self.ids[:self.count])
+            matrix = self.vectors[:self.count].astype(np.float32)
+        else:
+            if self._member_arrays[cluster] is None:
+                self._member_arrays[cluster] = np.asarray(self._members[cluster], dtype=np.int64)
+            rows = self._member_arrays[cluster]
+            ids = np.asarray(self.ids[rows])
+            matrix = np.asarray(self.vectors[rows]).astype(np.float32)
+        if matrix.nbytes <= self.cache_bytes:
+            self._cache[cluster] = (ids, matrix)
+            self._cached_bytes += matrix.nbytes
+            while self._cached_bytes > self.cache_bytes:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted.nbytes
+        return ids, matrix
+
+    def search(self, query: np.ndarray, k: int = 5, exclude_ids: Sequence[int] = ()) -> List[Tuple[int, float]]:
+        """コサイン類似度の高い順に (episode_id, score) を最大k件返す"""
+        query = _normalize(query)
+        with self._lock:
+            if self.count == 0:
+                return []
+            id_parts, score_parts = [], []
+            for cluster in self._probe(query):
+                ids, matrix = self._cluster_vectors(cluster)
+                id_parts.append(ids)
+                score_parts.append(matrix @ query)
+        ids = np.concatenate(id_parts)
+        scores = np.concatenate(score_parts)
+        if exclude_ids:
+            keep = ~np.isin(ids, np.asarray(list(exclude_ids), dtype=np.int64))
+            scores, ids = scores[keep], ids[keep]
+        if len(scores) == 0:
+            return []
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+
+class EpisodeVectorStore:
+    """
+    エピソードの埋め込みをユーザーごとのUserVectorIndexで管理する
+    埋め込みはEmbedder (llama.cppの埋め込みモード) でローカルに計算し、ネットワークは使わない
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        directory: str = "data/vectors",
+        ivf_min_size: int = 4096,
+        nprobe: int = 8,
+        cache_bytes: int = 64 * 1024 * 1024,
+        flush_every: int = 64
+    ):
+        self.embedder = embedder
+        self.directory = directory
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self.cache_bytes = cache_bytes
+        self.flush_every = flush_every
+        self.logger = logging.getLogger(__name__)
+        self._indexes: Dict[str, UserVectorIndex] = {}
+        self._training: Dict[str, asyncio.Task] = {}
+
+    def _user_directory(self, user_id) -> str:
+        # ユーザーIDをそのままディレクトリ名に使えない場合に備えて記号を置き換える
+        return os.path.join(self.directory, re.sub(r"[^0-9A-Za-z_-]", "_", str(user_id)))
+
+    def _get_index(self, user_id, dim: Optional[int] = None) -> Optional[UserVectorIndex]:
+        key = str(user_id)
+        index = self._indexes.get(key)
+        if index is not None:
+            return index
+        directory = self._user_directory(user_id)
+        meta_path = os.path.join(directory, META_FILE)
+        if dim is None:
+            if not os.path.exists(meta_path):
+                return None
+            with open(meta_path, encoding="utf-8") as f:
+                dim = json.load(f)['dim']
+        index = UserVectorIndex(
+            directory, dim, ivf_min_size=self.ivf_min_size, nprobe=self.nprobe, cache_bytes=self.cache_bytes,
+            flush_every=self.flush_every
+        )
+        self._indexes[key] = index
+        return index
+
+    def _schedule_training(self, user_id, index: UserVectorIndex) -> None:
+        key = str(user_id)
+        if not index.needs_training or key in self._training:
+            return
+
+        async def train() -> None:
+            try:
+                await asyncio.to_thread(index.train)
+            except Exception as e:
+                self.logger.error(f"Failed to train vector index for user {user_id}: {e}", exc_info=True)
+            finally:
+                self._training.pop(key, None)
+
+        self._training[key] = asyncio.create_task(train())
+
+    async def add_episode(self, user_id, episode_id: int, text: str) -> None:
+        """エピソードの本文を埋め込んでインデックスに追加する (保存のたびに呼ぶ)"""
+        vector = await self.embedder.embed_one(text)
+        index = self._get_index(user_id, dim=len(vector))
+        # memmapへの書き込み (とflush_every件ごとの書き出し) でイベントループを止めない
+        await asyncio.to_thread(index.add, int(episode_id), vector)
+        self._schedule_training(user_id, index)
+
+    async def remove_episode(self, user_id, episode_id: int) -> bool:
+        index = self._get_index(user_id)
+        return await asyncio.to_thread(index.remove, int(episode_id)) if index is not None else False
+
+    async def related_episodes(self, user_id, text: str, k: int = 5, exclude_ids: Sequence[int] = ()) -> List[Tuple[int, float]]:
+        """テキストに意味の近いエピソードを (episode_id, score) で返す"""
+        index = self._get_index(user_id)
+        if index is None:
+            return []
+        return index.search(await self.embedder.embed_one(text), k=k, exclude_ids=exclude_ids)
+
+    async def related_to_episode(self, user_id, episode_id: int, k: int = 5) -> List[Tuple[int, float]]:
+        """保存済みのエピソードに近いエピソードを返す (埋め込みは計算し直さない)"""
+        index = self._get_index(user_id)
+        vector = index.get_vector(int(episode_id)) if index is not None else None
+        if vector is None:
+            return []
+        return index.search(vector, k=k, exclude_ids=[int(episode_id)])
+
+    async def close(self) -> None:
+        """学習中のタスクを待ってから、まだ書き出していない追加をファイルに書き出す"""
+        if self._training:
+            await asyncio.gather(*self._training.values(), return_exceptions=True)
+        for index in self._indexes.values():
+            await asyncio.to_thread(index.flush)
@@ -1,14 +1,22 @@
 import asyncio
-from typing import Dict, Any
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 from .config import Config
 from .core.llm_handler import LlamaHandler
+from .core.batch_scheduler import BatchScheduler
+from .core.cancellation import CancellationToken
+from .core.priority import DEFAULT_LANE
+from .core.response_cache import ResponseCache
+from .core.embedder import Embedder
+from .core.vector_index import EpisodeVectorStore
 from .core.person_data_manager import PersonDataManager
+from .core.context_assembler import ContextAssembler
+import db_manager
 import logging
 import asyncio
 
 # Runtime クラスの修正
 class Runtime:
-    def __init__(self, config_path: str = "config.yaml"):
+    def __init__(self, config_path: str = "config.yaml", person_data_session_factory=None):
         # logging の設定は main_test_run で行うか、ここに集約
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         self.logger = logging.getLogger(__name__)
@@ -16,30 +24,117 @@ class Runtime:
             self.config_loader = Config(config_path=config_path)
             # 修正: LlamaHandler に model_path を含む設定を渡す
             self.llama = LlamaHandler(self.config_loader.llama_handler_config) # 修正されたプロパティを使用
+            # 同時リクエストを1つのデコードステップにまとめるスケジューラ
+            # システムプロンプト + 人格のKVスナップショットはLlamaHandlerと同じキャッシュ (ディスクを含む) に置く
+            # 投機的デコーディングが有効ならスケジューラのデコードステップでドラフトの提案を検証する
+            self.scheduler = BatchScheduler(
+                self.llama.llm, self.config_loader.scheduler_config,
+                prefix_cache=self.llama.prefix_cache, speculative=self.llama.speculative
+            )
+            # 同じプロンプトの再生成を避ける応答キャッシュ
+            self.response_cache = self._build_response_cache(self.config_loader.response_cache_config)
+            # 関連エピソード検索用の埋め込みインデックス (EpisodeHandler(vector_store=...) に渡す)
+            self.episode_vectors = self._build_episode_vectors(self.config_loader.episode_vectors_config)
+            # ユーザーごとの描画・トークン化済みのPerson Data (user_info / PersonDataEntry が変わったときだけ作り直す)
+            self.person_data = PersonDataManager(
+                tokenize=self.llama.tokenize,
+                tokenizer_id=self.llama.model_fingerprint,
+                session_factory=person_data_session_factory
+            )
+            # 会話履歴は保存するときに1回だけトークン数を数えておき、履歴を選ぶときはその数だけを使う
+            db_manager.set_token_counter(lambda text: len(self.llama.tokenize(text)))
+            self.context_assembler = ContextAssembler(
+                self.llama.tokenize,
+                n_ctx=self.scheduler.n_ctx_per_seq,
+                max_new_tokens=self.scheduler.default_max_tokens,
+                bos_token=self.llama.llm.token_bos(),
+                person_data=self.person_data
+            )
             self.logger.info("Runtime initialized successfully.")
         except Exception as e:
             self.logger.error(f"Error during Runtime initialization: {e}", exc_info=True)
             raise
 
-        
-    async def process_message(self, user_id: int, message: str) -> str:
+    def _build_response_cache(self, config: Dict[str, Any]):
+        if not config.get('enabled', True):
+            return None
+        semantic_config = config.get('semantic') or {}
+        embedder = Embedder(semantic_config) if semantic_config.get('enabled') else None
+        return ResponseCache(
+            max_size=config.get('max_size', 1000),
+            ttl=config.get('ttl', 3600),
+            sqlite_path=config.get('sqlite_path') or None,
+            embedder=embedder,
+            similarity_threshold=semantic_config.get('similarity_threshold', 0.95)
+        )
+
+    def _build_episode_vectors(self, config: Dict[str, Any]):
+        if not config.get('enabled'):
+            return None
+        return EpisodeVectorStore(
+            Embedder(config),
+            directory=config.get('dir', 'data/vectors'),
+            ivf_min_size=config.get('ivf_min_size', 4096),
+            nprobe=config.get('nprobe', 8),
+            cache_bytes=int(config.get('cache_mb', 64) * 1024 * 1024),
+            flush_every=config.get('flush_every', 64)
+        )
+
+    async def process_message(
+        self, user_id: int, message: str, use_cache: bool = True, refresh_cache: bool = False,
+        lane: str = DEFAULT_LANE
+    ) -> str:
+        """
+        use_cache=False で応答キャッシュを使わずに生成する
+        refresh_cache=True でキャッシュを読まずに生成し直し、結果で上書きする
+        lane はスケジューラの優先度レーン (interactive / near_real_time / batch)
+        """
         try:
-            response = await self.llama.generate_simple(
-                prompt=message
+            async def generate() -> str:
+                prompt_tokens = self.llama.build_chat_tokens([{"role": "user", "content": message}])
+                return await self.scheduler.generate(prompt_tokens, lane=lane, user_id=user_id)
+
+            if self.response_cache is None:
+                return await generate()
+            # プロンプトはユーザーに依存しないのでuser_idはキーに含めない
+            response = await self.response_cache.get_or_generate(
+                message, generate, namespace="process_message", use_cache=use_cache, refresh=refresh_cache
             )
             return response
             
         except Exception as e:
             return f"エラーが発生しました: {str(e)}"
     
+    async def process_messages_as_completed(
+        self,
+        user_id: int,
+        messages: List[str],
+        use_cache: bool = True,
+        lane: str = DEFAULT_LANE
+    ) -> AsyncIterator[Tuple[int, str]]:
+        """複数のメッセージを同時にスケジューラへ投入し、終わった順に (index, 応答) を返す"""
+        async def run(index: int, message: str) -> Tuple[int, str]:
+            return index, await self.process_message(user_id, message, use_cache=use_cache, lane=lane)
+
+        tasks = [asyncio.create_task(run(i, m)) for i, m in enumerate(messages)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def process_message_streaming(self, user_id: int, message: str, callback=None) -> str:
         """ストリーミング処理でメッセージを処理"""
         try:
-            response = await self.llama.generate_streaming(
-                prompt=message,
-                callback=callback
-            )
-            return response
+            parts = []
+            async for chunk in self.stream_message(user_id, message):
+                parts.append(chunk)
+                if callback:
+                    await callback(chunk, False)
+            if callback:
+                await callback("", True)
+            return "".join(parts)
             
         except Exception as e:
             error_msg = f"エラーが発生しました: {str(e)}"
@@ -48,24 +143,58 @@ class Runtime:
             return error_msg
     
 
-    async def simpleAnswer(self, user_id: str, message: str) -> str:
+    async def stream_message(
+        self, user_id: int, message: str, cancel_token: Optional[CancellationToken] = None
+    ) -> AsyncIterator[str]:
+        """
+        生成されたテキスト片を順に返す (SSEエンドポイント用)
+        cancel_token がキャンセルされると、次のデコードステップの前に打ち切ってストリームを終える
+        """
+        prompt_tokens = self.llama.build_chat_tokens([{"role": "user", "content": message}])
+        async for chunk in self.scheduler.stream(prompt_tokens, cancel_token=cancel_token, user_id=user_id):
+            yield chunk
+
+    async def stream_conversation(
+        self, user_id: int, message: str, system_prompt: str = "",
+        cancel_token: Optional[CancellationToken] = None
+    ) -> AsyncIterator[str]:
+        """
+        会話履歴と人格を含めて n_ctx に収まるプロンプトで応答し、生成されたテキスト片を順に返す
+        メッセージと応答は会話履歴に保存する (メッセージのトークン数は組み立て時に数えたものを使う)
+        途中でキャンセルされた応答は保存しない
+        """
+        context = await self.context_assembler.assemble(user_id, message, system_prompt)
+        parts = []
+        async for chunk in self.scheduler.stream(
+            context.tokens, cancel_token=cancel_token, user_id=user_id, prefix_len=context.prefix_length
+        ):
+            parts.append(chunk)
+            yield chunk
+        if cancel_token is not None and cancel_token.cancelled:
+            return
+        db_manager.buffer_conversation_message(user_id, 'user', message, token_count=context.message_token_count)
+        db_manager.buffer_conversation_message(user_id, 'assistant', "".join(parts))
+
+    async def process_conversation(self, user_id: int, message: str, system_prompt: str = "") -> str:
         try:
-            response = await self.llama.generate(
-                prompt=message,
-                person_data_token= [2, 76444, 120211, 237048, 67923, 73727, 237536]
-            )
-            return response
-            
+            return "".join([chunk async for chunk in self.stream_conversation(user_id, message, system_prompt)])
         except Exception as e:
-            logging.error(f"Error in simpleAnswer: {e}", exc_info=True)
+            self.logger.error(f"Error in process_conversation: {e}", exc_info=True)
             return f"エラーが発生しました: {str(e)}"
+
+    async def simpleAnswer(self, user_id: str, message: str) -> str:
+        """人格スナップショットと会話履歴を含めて応答する (/ask と同じ経路)"""
+        return await self.process_conversation(user_id, message)
     
-    async def simpleAnswer_streaming(self, user_id: str, message: str, callback=None) -> str:
+    async def simpleAnswer_streaming(
+        self, user_id: str, message: str, callback=None, cancel_token: Optional[CancellationToken] = None
+    ) -> str:
         """ストリーミング対応のsimpleAnswer"""
         try:
             response = await self.llama.generate_streaming(
                 prompt=message,
-                callback=callback
+                callback=callback,
+                cancel_token=cancel_token
             )
             return response
             
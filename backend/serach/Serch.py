@@ -2,8 +2,12 @@ import aiosqlite
 import asyncio
 import json
 
+import numpy as np
+
 class WeightEvaluator:
-    def __init__(self):
+    def __init__(self, embedder=None):
+        # 意味的な類似度の計算に使う runtime.core.embedder.Embedder (runtime.episode_vectors.embedder を共有できる)
+        self.embedder = embedder
         self.weight_types = {
             'semantic': self.evaluate_semantic_weight,
             'temporal': self.evaluate_temporal_weight,
@@ -83,6 +87,13 @@ class WeightEvaluator:
                 }
             }
 
+    async def calculate_semantic_similarity(self, text: str, related_text: str) -> float:
+        """2つの文章の埋め込みのコサイン類似度 (Embedderは正規化済みのベクトルを返すので内積になる)"""
+        if self.embedder is None:
+            raise RuntimeError("WeightEvaluator needs an embedder for semantic weights")
+        vectors = await self.embedder.embed([text, related_text])
+        return float(np.dot(vectors[0], vectors[1]))
+
     async def evaluate_temporal_weight(
         self,
         message_id: str,
@@ -0,0 +1,151 @@
+# serach/relation_weights.py
+# ユーザーの会話履歴全体から relation_weights をまとめて計算する
+# WeightEvaluator (Serch.py) のように1ペアずつDBを読んで書くのではなく、重み行列をNumPyで一度に作る
+import asyncio
+import json
+import logging
+import zlib
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import db_manager
+
+logger = logging.getLogger(__name__)
+
+WEIGHT_TYPES = ('temporal', 'semantic', 'contextual')
+# WeightEvaluator と同じ信頼度
+CONFIDENCE = {'temporal': 0.9, 'semantic': 0.8, 'contextual': 0.7}
+# 行列を一度に作るとメッセージ数の2乗のメモリを使うので、この行数ずつ計算する
+BLOCK_SIZE = 1024
+# 文脈の重みに使う文字バイグラムのハッシュ次元
+CONTEXT_HASH_DIM = 1024
+
+
+def top_k_neighbors(
+    similarity_block: Callable[[int, int], np.ndarray], n: int, k: int, block_size: int = BLOCK_SIZE
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    similarity_block(start, end) が返す [end-start, n] の重み行列から、各行の上位k件 (自分自身を除く) を取り出す
+    戻り値は (近傍のインデックス [n, k], 重み [n, k]) で、重みの大きい順に並ぶ
+    """
+    k = min(k, n - 1)
+    indices = np.empty((n, max(k, 0)), dtype=np.int64)
+    weights = np.empty((n, max(k, 0)), dtype=np.float32)
+    if k <= 0:
+        return indices, weights
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        block = np.array(similarity_block(start, end), dtype=np.float32)
+        rows = np.arange(end - start)
+        block[rows, rows + start] = -np.inf
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_weights = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_weights, axis=1)
+        indices[start:end] = np.take_along_axis(top, order, axis=1)
+        weights[start:end] = np.take_along_axis(top_weights, order, axis=1)
+    return indices, weights
+
+
+def parse_timestamps(timestamps: Sequence[str]) -> np.ndarray:
+    """SQLiteのタイムスタンプ文字列をUNIX秒 (float64) にする"""
+    return np.array(timestamps, dtype='datetime64[us]').astype(np.int64) / 1e6
+
+
+def hashed_bigram_vectors(texts: Sequence[str], dim: int = CONTEXT_HASH_DIM) -> np.ndarray:
+    """文字バイグラムの出現をハッシュでdim次元に詰めたL2正規化済みベクトル (共通の語や固有名詞を拾う)"""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        text = "".join(text.split())
+        buckets = [zlib.crc32(text[i:i + 2].encode('utf-8')) % dim for i in range(len(text) - 1)]
+        if buckets:
+            np.add.at(vectors[row], buckets, 1.0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def compute_relation_weights(
+    timestamps: np.ndarray,
+    texts: Sequence[str],
+    embeddings: Optional[np.ndarray] = None,
+    top_k: int = 10,
+    weight_types: Sequence[str] = WEIGHT_TYPES,
+    block_size: int = BLOCK_SIZE
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    重みの種類ごとに、各メッセージの上位k件の (近傍インデックス, 重み) を返す
+    temporal: 1 / (1 + 時間差[時間])  (WeightEvaluator.evaluate_temporal_weight と同じ式)
+    semantic: 埋め込みのコサイン類似度 (embeddingsがないときは計算しない)
+    contextual: 文字バイグラムのコサイン類似度 (同じ話題・同じ人や物への言及)
+    """
+    n = len(texts)
+    results = {}
+    for weight_type in weight_types:
+        if weight_type == 'temporal':
+            hours = np.asarray(timestamps, dtype=np.float64) / 3600.0
+            block = lambda start, end: 1.0 / (1.0 + np.abs(hours[start:end, None] - hours[None, :]))
+        elif weight_type == 'semantic':
+            if embeddings is None:
+                continue
+            matrix = np.asarray(embeddings, dtype=np.float32)
+            matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            block = lambda start, end, matrix=matrix: matrix[start:end] @ matrix.T
+        elif weight_type == 'contextual':
+            bigrams = hashed_bigram_vectors(texts)
+            block = lambda start, end, bigrams=bigrams: bigrams[start:end] @ bigrams.T
+        else:
+            raise ValueError(f"Unsupported weight type: {weight_type}")
+        results[weight_type] = top_k_neighbors(block, n, top_k, block_size)
+    return results
+
+
+async def rebuild_relation_weights(
+    user_id: int,
+    embedder=None,
+    top_k: int = 10,
+    weight_types: Sequence[str] = WEIGHT_TYPES,
+    db_path: str = db_manager.DATABASE
+) -> Dict[str, int]:
+    """
+    ユーザーの会話履歴全体から関連の重みを作り直し、1トランザクションで保存する
+    embedder (runtime.core.embedder.Embedder) を渡したときだけsemanticの重みを計算する
+    戻り値は種類ごとの保存した件数
+    """
+    messages = await db_manager.get_conversation_messages(user_id, db_path=db_path)
+    if len(messages) < 2:
+        return {}
+    message_ids = np.array([message['message_id'] for message in messages], dtype=np.int64)
+    texts = [message['content'] for message in messages]
+    timestamps = parse_timestamps([message['timestamp'] for message in messages])
+
+    embeddings = None
+    if embedder is not None and 'semantic' in weight_types:
+        embeddings = np.concatenate([
+            await embedder.embed(texts[start:start + 64]) for start in range(0, len(texts), 64)
+        ])
+
+    # 行列計算は数百msから数秒かかるのでイベントループを止めないように別スレッドで行う
+    computed = await asyncio.to_thread(
+        compute_relation_weights, timestamps, texts, embeddings, top_k=top_k, weight_types=weight_types
+    )
+    rows: List[tuple] = []
+    for weight_type, (neighbors, weights) in computed.items():
+        confidence = CONFIDENCE[weight_type]
+        sources = np.repeat(message_ids, neighbors.shape[1])
+        targets = message_ids[neighbors.reshape(-1)]
+        flat_weights = weights.reshape(-1)
+        if weight_type == 'temporal':
+            time_diffs = np.abs(np.repeat(timestamps, neighbors.shape[1]) - timestamps[neighbors.reshape(-1)])
+            metadata = [json.dumps({'time_diff_seconds': float(diff), 'calculation_method': 'inverse_time_diff'})
+                        for diff in time_diffs]
+        else:
+            method = 'cosine_similarity' if weight_type == 'semantic' else 'char_bigram_cosine'
+            metadata = [json.dumps({'calculation_method': method})] * len(flat_weights)
+        rows.extend(zip(sources.tolist(), targets.tolist(), [weight_type] * len(flat_weights),
+                        flat_weights.tolist(), [confidence] * len(flat_weights), metadata))
+
+    if not await db_manager.replace_relation_weights(user_id, list(computed), rows, db_path=db_path):
+        raise RuntimeError(f"Failed to save relation weights for user {user_id}")
+    counts = {weight_type: int(neighbors.size) for weight_type, (neighbors, _) in computed.items()}
+    logger.info(f"Rebuilt relation weights for user {user_id} over {len(messages)} messages: {counts}")
+    return counts
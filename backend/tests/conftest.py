@@ -2,6 +2,9 @@ import os
 import sys
 import pytest
 import logging
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
 # ロギングの設定
 logging.basicConfig(level=logging.DEBUG)
@@ -12,6 +15,7 @@ project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, project_root)
 
 from db_manager import initialize_database
+from db import models
 
 @pytest.fixture
 async def test_db():
@@ -53,4 +57,18 @@ async def test_db():
                 os.remove(db_path)
                 logger.info(f"Cleaned up test database: {db_path}")
             except Exception as e:
-                logger.error(f"Error cleaning up test database: {e}") 
\ No newline at end of file
+                logger.error(f"Error cleaning up test database: {e}") 
+
+@pytest.fixture
+def orm_session(tmp_path):
+    """
+    tmp_pathにSQLAlchemyのモデルのテーブルを作ったDBを開く関数を返す
+    open_db(name) は (engine, Session) を返す。接続はプールせず使い終わるたびに閉じるので、エンジンの破棄は要らない
+    """
+    async def open_db(name: str = "orm.db"):
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp_path, name)}", poolclass=NullPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        return engine, sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    return open_db
@@ -0,0 +1,168 @@
+import asyncio
+import numpy as np
+import pytest
+
+gguf = pytest.importorskip("gguf")
+llama_cpp = pytest.importorskip("llama_cpp")
+
+from runtime.core.batch_scheduler import BatchScheduler
+from runtime.core.cancellation import CancellationToken
+from runtime.core.speculative import SpeculativeDecoder
+
+# 温度0・ペナルティ無しなら出力はモデルだけで決まる
+GREEDY = {"temperature": 0, "repeat_penalty": 1.0}
+
+
+def _write_tiny_model(path):
+    """テスト用の小さいllamaモデル (重みは乱数、語彙はバイトトークン+α) を書き出す"""
+    rng = np.random.default_rng(0)
+    tokens = ["<unk>", "<s>", "</s>"] + [f"<0x{i:02X}>" for i in range(256)] + ["▁", "▁a", "▁the", "▁is", "▁hello"]
+    n_words = len(tokens) - 259
+    n_vocab, n_embd, n_ff = len(tokens), 64, 128
+    writer = gguf.GGUFWriter(str(path), "llama")
+    writer.add_name("tiny")
+    writer.add_context_length(512)
+    writer.add_embedding_length(n_embd)
+    writer.add_block_count(2)
+    writer.add_feed_forward_length(n_ff)
+    writer.add_head_count(4)
+    writer.add_head_count_kv(4)
+    writer.add_rope_dimension_count(n_embd // 4)
+    writer.add_layer_norm_rms_eps(1e-5)
+    writer.add_file_type(0)
+    writer.add_tokenizer_model("llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores([0.0] * 259 + [-1.0 - i for i in range(n_words)])
+    writer.add_token_types([2, 3, 3] + [6] * 256 + [1] * n_words)
+    writer.add_bos_token_id(1)
+    writer.add_eos_token_id(2)
+    writer.add_unk_token_id(0)
+
+    def weight(*shape):
+        return (rng.standard_normal(shape) * 0.2).astype(np.float32)
+
+    writer.add_tensor("token_embd.weight", weight(n_vocab, n_embd))
+    writer.add_tensor("output_norm.weight", np.ones(n_embd, np.float32))
+    writer.add_tensor("output.weight", weight(n_vocab, n_embd))
+    for i in range(2):
+        writer.add_tensor(f"blk.{i}.attn_norm.weight", np.ones(n_embd, np.float32))
+        for name in ("attn_q", "attn_k", "attn_v", "attn_output"):
+            writer.add_tensor(f"blk.{i}.{name}.weight", weight(n_embd, n_embd))
+        writer.add_tensor(f"blk.{i}.ffn_norm.weight", np.ones(n_embd, np.float32))
+        writer.add_tensor(f"blk.{i}.ffn_gate.weight", weight(n_ff, n_embd))
+        writer.add_tensor(f"blk.{i}.ffn_up.weight", weight(n_ff, n_embd))
+        writer.add_tensor(f"blk.{i}.ffn_down.weight", weight(n_embd, n_ff))
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+
+@pytest.fixture(scope="module")
+def tiny_llm(tmp_path_factory):
+    path = tmp_path_factory.mktemp("models") / "tiny.gguf"
+    _write_tiny_model(path)
+    llm = llama_cpp.Llama(model_path=str(path), n_ctx=256, n_batch=64, verbose=False)
+    yield llm
+    llm.close()
+
+
+def _prompt(seed, length):
+    # BOS + バイトトークン
+    return [1] + [3 + (seed * 31 + i * 7) % 256 for i in range(length)]
+
+
+async def _generate_alone(llm, prompt, **kwargs):
+    scheduler = BatchScheduler(llm, {"max_sequences": 1})
+    try:
+        return await scheduler.generate(prompt, **kwargs)
+    finally:
+        scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_match_sequential_outputs(tiny_llm):
+    """同時に投入しても (チャンク化プリフィル・シーケンスごとのサンプラー) 1件ずつ実行した場合と同じ出力になる"""
+    prompts = [_prompt(seed, 20 + seed * 9) for seed in range(4)]
+    expected = [await _generate_alone(tiny_llm, prompt, max_tokens=12, **GREEDY) for prompt in prompts]
+
+    # n_batch=16 なのでプロンプトは複数ステップに分けて流し込まれる
+    scheduler = BatchScheduler(tiny_llm, {"max_sequences": 4, "n_batch": 16})
+    try:
+        results = await asyncio.gather(*[scheduler.generate(prompt, max_tokens=12, **GREEDY) for prompt in prompts])
+        stats = scheduler.get_stats()
+    finally:
+        scheduler.close()
+    assert results == expected
+    assert stats["max_batch_sequences"] == 4
+    assert stats["completed"] == 4 and stats["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_sequence_frees_its_slot(tiny_llm):
+    """キャンセルしたシーケンスは次のステップで枠を空け、待っていたリクエストが実行される"""
+    scheduler = BatchScheduler(tiny_llm, {"max_sequences": 1})
+    try:
+        cancel_token = CancellationToken()
+        handle = scheduler.submit(_prompt(0, 10), max_tokens=200, stream=True, cancel_token=cancel_token, **GREEDY)
+        waiting = scheduler.submit(_prompt(1, 10), max_tokens=8, **GREEDY)
+        stream = handle.stream()
+        await stream.__anext__()
+        assert not waiting.future.done()
+
+        cancel_token.cancel("client disconnected")
+        partial = await asyncio.wait_for(handle.result(), timeout=10)
+        assert await asyncio.wait_for(waiting.result(), timeout=10) == await _generate_alone(
+            tiny_llm, _prompt(1, 10), max_tokens=8, **GREEDY
+        )
+        await stream.aclose()
+        stats = scheduler.get_stats()
+    finally:
+        scheduler.close()
+    assert isinstance(partial, str)
+    assert stats["cancelled"] == 1 and stats["saved_tokens"] > 0
+    assert stats["active"] == 0 and stats["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_interactive_request_preempts_background_sequence(tiny_llm):
+    """枠が埋まっていてもinteractiveのリクエストは先に実行され、譲った側は計算し直して同じ出力で完了する"""
+    background_prompt, interactive_prompt = _prompt(2, 12), _prompt(3, 12)
+    expected = await _generate_alone(tiny_llm, background_prompt, max_tokens=40, **GREEDY)
+
+    scheduler = BatchScheduler(tiny_llm, {"max_sequences": 1})
+    try:
+        background = scheduler.submit(background_prompt, max_tokens=40, stream=True, lane="batch", **GREEDY)
+        stream = background.stream()
+        await stream.__anext__()
+        interactive = scheduler.submit(interactive_prompt, max_tokens=4, lane="interactive", **GREEDY)
+        await asyncio.wait_for(interactive.result(), timeout=10)
+        # 先に投入したbackgroundはinteractiveが終わってから完了する
+        assert not background.future.done()
+        rest = [chunk async for chunk in stream]
+        result = await background.result()
+        stats = scheduler.get_stats()
+    finally:
+        scheduler.close()
+    assert result == expected and rest
+    assert stats["preempted"] == 1
+
+
+@pytest.mark.asyncio
+async def test_speculative_decoding_with_the_same_model_keeps_outputs(tiny_llm):
+    """ドラフトが本体と同じモデルなら提案はほぼすべて採用され (EOSは採用に数えない) 、出力は投機的デコーディング無しと同じ"""
+    prompts = [_prompt(seed, 15) for seed in range(3)]
+    expected = [await _generate_alone(tiny_llm, prompt, max_tokens=20, **GREEDY) for prompt in prompts]
+
+    speculative = SpeculativeDecoder(tiny_llm, tiny_llm, n_draft=4)
+    scheduler = BatchScheduler(tiny_llm, {"max_sequences": 3}, speculative=speculative)
+    try:
+        results = await asyncio.gather(*[scheduler.generate(prompt, max_tokens=20, **GREEDY) for prompt in prompts])
+        decode_steps = scheduler.get_stats()["decode_steps"]
+    finally:
+        scheduler.close()
+    assert results == expected
+    stats = speculative.get_stats()
+    assert stats["generations"] == 3 and stats["acceptance_rate"] > 0.9
+    # 1回の検証で複数トークンずつ進む
+    assert decode_steps < 20
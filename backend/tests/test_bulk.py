@@ -0,0 +1,89 @@
+import pytest
+import json
+import os
+from sqlalchemy import select
+import db_manager
+from db import bulk, models
+
+
+@pytest.mark.asyncio
+async def test_import_resumes_from_checkpoint_after_crash(tmp_path, monkeypatch):
+    """途中のチャンクで落ちても、再実行すると続きから読み、二重に登録しない"""
+    db_path = os.path.join(tmp_path, "bulk.db")
+    await db_manager.initialize_database(db_path)
+    source = os.path.join(tmp_path, "history.jsonl")
+    with open(source, "w", encoding="utf-8") as f:
+        for i in range(1, 8):
+            f.write(json.dumps({"message_id": i, "user_id": 1, "role": "user", "content": f"発言{i}",
+                                "timestamp": "2024-01-01T00:00:00", "token_count": i}, ensure_ascii=False) + "\n")
+
+    written = []
+    original = bulk._write_conversation_chunk
+
+    async def crash_on_third_chunk(sqlite_path, rows, key, position, total_rows):
+        if len(written) == 2:
+            raise RuntimeError("simulated crash")
+        written.append([row["message_id"] for row in rows])
+        await original(sqlite_path, rows, key, position, total_rows)
+
+    monkeypatch.setattr(bulk, "_write_conversation_chunk", crash_on_third_chunk)
+    try:
+        with pytest.raises(RuntimeError):
+            await bulk.import_records("conversation_history", source, sqlite_path=db_path, chunk_size=2)
+        assert written == [[1, 2], [3, 4]]
+
+        monkeypatch.setattr(bulk, "_write_conversation_chunk", original)
+        progress = []
+        imported = await bulk.import_records("conversation_history", source, sqlite_path=db_path, chunk_size=2,
+                                             progress=progress.append)
+        # チェックポイント以降の3件だけを読み、通算の件数とファイル末尾の位置を記録する
+        assert imported == 3
+        assert progress[-1].rows == 7
+        assert progress[-1].position == os.path.getsize(source)
+
+        pool = db_manager.get_database_pool(db_path)
+        rows = await pool.fetchall("SELECT message_id FROM conversation_history ORDER BY message_id")
+        assert [row["message_id"] for row in rows] == list(range(1, 8))
+
+        # 最後まで終わった後の再実行は何も読まない
+        assert await bulk.import_records("conversation_history", source, sqlite_path=db_path, chunk_size=2) == 0
+        # チェックポイントを消すと最初から読むが、主キーが重複する行は無視される
+        await bulk.clear_checkpoint(bulk.BULK_TABLES["conversation_history"], source, sqlite_path=db_path)
+        assert await bulk.import_records("conversation_history", source, sqlite_path=db_path, chunk_size=3) == 7
+        rows = await pool.fetchall("SELECT COUNT(*) AS n FROM conversation_history")
+        assert rows[0]["n"] == 7
+    finally:
+        await db_manager.close_database_pool(db_path)
+
+
+@pytest.mark.asyncio
+async def test_export_then_import_round_trips_messages(tmp_path, orm_session):
+    """書き出したJSONLを別のDBに読み込むと、JSON列・日時も含めて同じ行になる"""
+    source_engine, Session = await orm_session("source.db")
+    target_engine, _ = await orm_session("target.db")
+    async with Session() as db:
+        db.add(models.User(id="1", email="a@example.com", password_hash="x"))
+        db.add(models.Thread(id="t1", owner_user_id="1", mode="chat"))
+        await db.flush()
+        db.add_all([
+            models.Message(thread_id="t1", sender_user_id="1", role="user", context=f"メッセージ{i}",
+                           cache={"tags": ["抹茶", i]} if i % 2 else None)
+            for i in range(5)
+        ])
+        await db.commit()
+
+    destination = os.path.join(tmp_path, "messages.jsonl")
+    assert await bulk.export_records("messages", destination, engine=source_engine, chunk_size=2) == 5
+    # 書き出しが最後まで終わるとチェックポイントは消える
+    assert not os.path.exists(destination + ".checkpoint")
+    with open(destination, encoding="utf-8") as f:
+        assert [json.loads(line)["id"] for line in f] == [1, 2, 3, 4, 5]
+
+    assert await bulk.import_records("messages", destination, engine=target_engine, chunk_size=2) == 5
+
+    columns = [column for column in models.Message.__table__.columns]
+    async with source_engine.connect() as conn:
+        expected = (await conn.execute(select(*columns).order_by(models.Message.id))).all()
+    async with target_engine.connect() as conn:
+        actual = (await conn.execute(select(*columns).order_by(models.Message.id))).all()
+    assert actual == expected
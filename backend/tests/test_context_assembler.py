@@ -0,0 +1,103 @@
+import pytest
+import asyncio
+import os
+import db_manager
+from runtime.core.context_assembler import ContextAssembler
+from runtime.core.person_data_manager import PersonaSnapshot
+
+
+def tokenize(text, special=False):
+    return [ord(c) for c in text]
+
+
+@pytest.mark.asyncio
+async def test_assembler_packs_newest_history_within_n_ctx(tmp_path):
+    """保存済みのトークン数で、n_ctxに収まる最新の履歴だけを古い順に並べる"""
+    db_path = os.path.join(tmp_path, "context.db")
+    await db_manager.initialize_database(db_path)
+    try:
+        # token_count がない古い行 (文字数で見積もり、組み立て時に実際の数を保存する)
+        await db_manager.get_database_pool(db_path).execute(
+            'INSERT INTO conversation_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+            (1, 'user', 'A' * 30, '2024-01-01 00:00:00')
+        )
+        db_manager.set_token_counter(len)
+        for content in ['B' * 40, 'C' * 40, 'D' * 40]:
+            assert await db_manager.add_conversation_message(1, 'assistant', content, db_path=db_path)
+        db_manager.set_token_counter(None)
+
+        assembler = ContextAssembler(tokenize, n_ctx=430, max_new_tokens=100, bos_token=2, db_path=db_path)
+        per = assembler.per_message_tokens
+        context = await assembler.assemble(1, 'hello', system_prompt='SYS')
+        text = ''.join(map(chr, context.tokens[1:]))
+        assert context.tokens[0] == 2 and len(context.tokens) <= 330
+        assert text.startswith('<start_of_turn>user\nSYS<end_of_turn>\n')
+        assert text.endswith('<start_of_turn>user\nhello<end_of_turn>\n<start_of_turn>model\n')
+        # 履歴の予算は3件分 (120 + 3*per) しかないので、古い 'A' の行は入らない
+        assert context.history_messages == 3 and 'A' * 30 not in text and text.index('B' * 40) < text.index('D' * 40)
+        assert context.history_tokens == 120 + 3 * per
+        assert context.message_token_count == 5
+
+        larger = ContextAssembler(tokenize, n_ctx=2048, max_new_tokens=100, db_path=db_path)
+        assert (await larger.assemble(1, 'hello')).history_messages == 4
+        rows = await db_manager.get_conversation_history_within_budget(1, 10 ** 6, db_path=db_path)
+        assert [row['token_count'] for row in rows] == [30, 40, 40, 40]
+    finally:
+        await db_manager.close_database_pool(db_path)
+
+
+class StubPersonData:
+    def __init__(self, text, version):
+        self.snapshot = PersonaSnapshot(user_id=1, version=version, token_ids=tokenize(text))
+
+    async def get_person_data(self, user_id):
+        return self.snapshot
+
+
+@pytest.mark.asyncio
+async def test_assembler_puts_persona_in_system_turn(tmp_path):
+    """人格スナップショットのトークン列はシステムプロンプトの直後に入り、収まらなければ人格だけを落とす"""
+    db_path = os.path.join(tmp_path, "persona.db")
+    await db_manager.initialize_database(db_path)
+    try:
+        person_data = StubPersonData('- hobbies: reading\n', 'v3')
+        assembler = ContextAssembler(tokenize, n_ctx=512, max_new_tokens=100, bos_token=2,
+                                     person_data=person_data, db_path=db_path)
+        context = await assembler.assemble(1, 'hello', system_prompt='SYS')
+        text = ''.join(map(chr, context.tokens[1:]))
+        assert text.startswith('<start_of_turn>user\nSYS- hobbies: reading\n<end_of_turn>\n')
+        assert context.persona_version == 'v3'
+        # KVを共有できるのは [BOS] とシステムのターンまで
+        assert context.prefix_length == 1 + len(assembler._turn('system', tokenize('SYS- hobbies: reading\n')))
+
+        # システムプロンプトがなくても人格だけでシステムのターンを作る
+        text = ''.join(map(chr, (await assembler.assemble(1, 'hello')).tokens[1:]))
+        assert text.startswith('<start_of_turn>user\n- hobbies: reading\n<end_of_turn>\n')
+
+        small = ContextAssembler(tokenize, n_ctx=len(assembler._turn('user', tokenize('hello'))) + 130,
+                                 max_new_tokens=100, person_data=StubPersonData('P' * 200, 'v4'), db_path=db_path)
+        context = await small.assemble(1, 'hello')
+        assert 'P' not in ''.join(map(chr, context.tokens)) and context.persona_version is None
+    finally:
+        await db_manager.close_database_pool(db_path)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_assembles_share_a_full_history_cache(tmp_path):
+    """キャッシュが満杯でも、同時に組み立てた各リクエストが正しい履歴を得て、キャッシュは上限を超えない"""
+    db_path = os.path.join(tmp_path, "concurrent.db")
+    await db_manager.initialize_database(db_path)
+    try:
+        for user_id in range(1, 5):
+            for i in range(6):
+                assert await db_manager.add_conversation_message(user_id, 'user', f'u{user_id}m{i}', db_path=db_path)
+        assembler = ContextAssembler(tokenize, n_ctx=2048, max_new_tokens=100, db_path=db_path, cache_size=5)
+
+        contexts = await asyncio.gather(*[assembler.assemble(user_id, 'hello') for user_id in range(1, 5) for _ in range(3)])
+        for n, context in enumerate(contexts):
+            text = ''.join(map(chr, context.tokens))
+            assert context.history_messages == 6
+            assert all(f'u{n // 3 + 1}m{i}' in text for i in range(6))
+        assert len(assembler._message_tokens) == 5
+    finally:
+        await db_manager.close_database_pool(db_path)
@@ -0,0 +1,107 @@
+import pytest
+import datetime
+import json
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import text
+from db import api_use_db, crud, models
+from db.db_database import get_db
+
+
+async def _create_thread_db(orm_session):
+    """メッセージ5件のスレッドを持つDBを作り、(engine, Session) を返す"""
+    engine, Session = await orm_session("crud.db")
+    async with Session() as db:
+        db.add(models.User(id="1", email="a@example.com", password_hash="x"))
+        db.add(models.Thread(id="t1", owner_user_id="1", mode="chat"))
+        await db.flush()
+        # 先頭の3件はtimestampが同じで、idだけで順序が決まる
+        same = datetime.datetime(2024, 1, 1, 12, 0, 0)
+        for i, minutes in enumerate([0, 0, 0, 1, 2]):
+            db.add(models.Message(thread_id="t1", role="user", context=f"メッセージ{i}",
+                                  timestamp=same + datetime.timedelta(minutes=minutes)))
+        await db.commit()
+    return engine, Session
+
+
+def test_cursor_round_trip():
+    """カーソルはURLに載せられる文字列で、元の (timestamp, id) に戻る。不正な値はValueError"""
+    cursor = crud.encode_cursor("2024-01-01 12:00:00.000000", 42)
+    assert "=" not in cursor and "/" not in cursor and "+" not in cursor
+    assert crud.decode_cursor(cursor) == ("2024-01-01 12:00:00.000000", 42)
+    with pytest.raises(ValueError):
+        crud.decode_cursor("not-a-cursor")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("descending", [False, True])
+async def test_keyset_pages_do_not_skip_or_repeat_duplicate_timestamps(orm_session, descending):
+    """同じtimestampがページの境目をまたいでも、全件を一度ずつ返す"""
+    _, Session = await _create_thread_db(orm_session)
+    async with Session() as db:
+        ids, cursor, pages = [], None, 0
+        while True:
+            page, cursor = await crud.get_messages_for_thread_page(db, "t1", limit=2, cursor=cursor, descending=descending)
+            ids.extend(message.id for message in page)
+            pages += 1
+            if cursor is None:
+                break
+        assert pages == 3
+        assert ids == ([5, 4, 3, 2, 1] if descending else [1, 2, 3, 4, 5])
+        # ちょうど割り切れる件数なら最後のページでカーソルはNone
+        page, cursor = await crud.get_messages_for_thread_page(db, "t1", limit=5)
+        assert len(page) == 5 and cursor is None
+
+
+@pytest.mark.asyncio
+async def test_create_missing_indexes_adds_indexes_to_existing_tables(orm_session):
+    """インデックスを定義する前に作られたDBにも、後から複合インデックスを追加できる"""
+    engine, _ = await _create_thread_db(orm_session)
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP INDEX ix_message_thread_timestamp_id"))
+        await conn.execute(text("DROP INDEX ix_thread_owner_timestamp_id"))
+
+    async def index_names():
+        async with engine.connect() as conn:
+            result = await conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))
+            return {row[0] for row in result}
+
+    assert "ix_message_thread_timestamp_id" not in await index_names()
+    async with engine.begin() as conn:
+        await conn.run_sync(models.create_missing_indexes)
+        # 既にあるインデックスは作り直さないので、何度呼んでもよい
+        await conn.run_sync(models.create_missing_indexes)
+    assert {"ix_message_thread_timestamp_id", "ix_thread_owner_timestamp_id"} <= await index_names()
+
+
+@pytest.mark.asyncio
+async def test_message_stream_endpoint_returns_ndjson(orm_session, monkeypatch):
+    """NDJSONのエンドポイントは1行1メッセージを時系列順に返す"""
+    _, Session = await _create_thread_db(orm_session)
+    monkeypatch.setattr(api_use_db, "AsyncSessionLocal", Session)
+
+    async def override_get_db():
+        async with Session() as db:
+            yield db
+
+    app = FastAPI()
+    app.include_router(api_use_db.thread_router)
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[api_use_db.get_current_user_mock] = lambda: models.User(id="1", email="a@example.com")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/threads/t1/messages/stream")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["id"] for row in rows] == [1, 2, 3, 4, 5]
+        assert rows[0]["context"] == "メッセージ0"
+
+        assert (await client.get("/threads/missing/messages/stream")).status_code == 404
+        assert (await client.get("/threads/t1/messages", params={"cursor": "broken"})).status_code == 400
+        # limitは1以上・上限以下だけを受け付ける (負の値はSQLiteでは無制限のLIMITになる)
+        for limit in (0, -1, crud.request_db_contexts_limit + 1):
+            assert (await client.get("/threads/t1/messages", params={"limit": limit})).status_code == 422
+            assert (await client.get("/threads/", params={"limit": limit})).status_code == 422
+        page = (await client.get("/threads/t1/messages", params={"limit": 2})).json()
+        assert [item["id"] for item in page["items"]] == [1, 2] and page["next_cursor"]
@@ -9,7 +9,11 @@ from db_manager import (
     add_episode,
     get_episodes,
     update_episode,
-    delete_episode
+    delete_episode,
+    add_conversation_message,
+    buffer_conversation_message,
+    get_conversation_history,
+    get_conversation_buffer
 )
 
 # テスト用のロガーを設定
@@ -162,4 +166,20 @@ async def test_error_handling(test_db):
     
     # 存在しないエピソードの削除は失敗するはず
     result = await delete_episode(99999, db_path=test_db)
-    assert result is False, "存在しないエピソードの削除は失敗するはず" 
\ No newline at end of file
+    assert result is False, "存在しないエピソードの削除は失敗するはず" 
+
+@pytest.mark.asyncio
+async def test_conversation_messages_are_group_committed(test_db):
+    """同時に追加した会話履歴がまとめて書き込まれ、追加した順に読めることをテスト"""
+    import asyncio
+    results = await asyncio.gather(*[
+        add_conversation_message(456, "user", f"メッセージ{i}", db_path=test_db) for i in range(20)
+    ])
+    assert all(results)
+    assert get_conversation_buffer(test_db).stats['batches'] < 20
+
+    # 確認を待たずに積んだメッセージも直後の読み取りで見える
+    future = buffer_conversation_message(456, "assistant", "返信", db_path=test_db)
+    history = await get_conversation_history(456, limit=3, db_path=test_db)
+    assert await future is True
+    assert [h['content'] for h in history] == ["メッセージ18", "メッセージ19", "返信"]
@@ -2,8 +2,8 @@ import pytest
 import json
 from datetime import datetime
 from unittest.mock import Mock, patch, AsyncMock
-from episode_handler import EpisodeHandler
-from question_agent.llm_analyzer import LLMAnalyzer
+from episode_handler import EpisodeHandler, EPISODE_INFO_SCHEMA
+from question_agent.llm_analyzer import LLMAnalyzer, ANALYSIS_SCHEMA
 
 # モック用のLLMアナライザー
 class MockLLMAnalyzer:
@@ -29,6 +29,22 @@ class MockLLMAnalyzer:
             return self.responses['how']
         return ''
 
+    async def _call_llm_json(self, prompt: str, schema: dict, max_tokens: int = 300) -> dict:
+        # まとめて抽出・分析するときはスキーマの全項目を返す
+        if schema is EPISODE_INFO_SCHEMA:
+            return dict(self.responses)
+        return {
+            'content_type': await self.analyze_content_type(prompt),
+            'emotions': await self.analyze_emotions(prompt),
+            'keywords': await self.extract_keywords(prompt),
+            'topics': await self.identify_topics(prompt),
+            'named_entities': await self.extract_named_entities(prompt),
+            'sensitivity': await self.assess_sensitivity(prompt)
+        }
+
+    # 検証と個別の分析へのフォールバックは本物の実装を使う
+    analyze_all = LLMAnalyzer.analyze_all
+
     async def analyze_content_type(self, text: str) -> str:
         return '過去の出来事の回想'
 
@@ -211,4 +227,69 @@ async def test_error_handling(episode_handler, monkeypatch):
         content="テストメッセージ"
     )
     
-    assert result is False 
\ No newline at end of file
+    assert result is False 
+
+@pytest.mark.asyncio
+async def test_batched_extraction_uses_single_json_call(episode_handler, mock_llm_analyzer):
+    """5W1Hがすべて文字列かnullならJSONの1回の呼び出しで済み、個別の抽出は呼ばない"""
+    mock_llm_analyzer._call_llm_json = AsyncMock(return_value={
+        'when': ' 昨日 ', 'where': None, 'who': '友達', 'what': '写真を撮った', 'how': '楽しく'
+    })
+    mock_llm_analyzer._call_llm_api = AsyncMock(return_value='個別')
+
+    extracted = await episode_handler._extract_episode_info("昨日、友達と写真を撮りました")
+
+    assert extracted == {'when': '昨日', 'where': None, 'who': '友達', 'what': '写真を撮った', 'how': '楽しく'}
+    mock_llm_analyzer._call_llm_json.assert_awaited_once()
+    assert mock_llm_analyzer._call_llm_json.await_args.args[1] is EPISODE_INFO_SCHEMA
+    mock_llm_analyzer._call_llm_api.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_batched_extraction_falls_back_for_invalid_fields(episode_handler, mock_llm_analyzer):
+    """欠落・型違いの項目だけ個別に抽出し直し、空文字は見つからなかった (None) として扱う"""
+    mock_llm_analyzer._call_llm_json = AsyncMock(return_value={
+        'when': 123, 'who': '', 'what': ['写真'], 'how': '楽しく'
+    })
+    call_llm_api = AsyncMock(side_effect=mock_llm_analyzer._call_llm_api)
+    mock_llm_analyzer._call_llm_api = call_llm_api
+
+    extracted = await episode_handler._extract_episode_info("昨日、近所の公園で写真を撮りました")
+
+    assert extracted == {
+        'when': '昨日の午後', 'where': '近所の公園', 'who': None, 'what': '写真を撮った', 'how': '楽しく'
+    }
+    assert call_llm_api.await_count == 3
+
+    # JSONの生成自体が失敗したら全項目を個別に抽出する
+    mock_llm_analyzer._call_llm_json = AsyncMock(side_effect=ValueError("No JSON object in response"))
+    call_llm_api.reset_mock()
+    extracted = await episode_handler._extract_episode_info("昨日、近所の公園で写真を撮りました")
+    assert extracted == mock_llm_analyzer.responses
+    assert call_llm_api.await_count == 5
+
+@pytest.mark.asyncio
+async def test_additional_analysis_falls_back_for_invalid_fields(episode_handler, mock_llm_analyzer, monkeypatch):
+    """追加分析はJSONの検証に通った項目をそのまま使い、通らなかった項目だけ個別の分析の結果で保存する"""
+    mock_update_episode = AsyncMock(return_value=True)
+    monkeypatch.setattr('db_manager.update_episode', mock_update_episode)
+    mock_llm_analyzer._call_llm_json = AsyncMock(return_value={
+        'content_type': '感情の吐露',
+        'emotions': {'emotions': {'joy': 'high'}, 'polarity': 'positive'},
+        'keywords': ['a', 'b', 'c', 'd', 'e', 'f'],
+        'topics': '写真',
+        'named_entities': [{'text': '公園', 'type': 'LOCATION'}],
+        'sensitivity': '不明'
+    })
+
+    await episode_handler._perform_additional_analysis({'episode_id': 1, 'text_content': "公園で写真を撮った"})
+
+    assert mock_llm_analyzer._call_llm_json.await_args.args[1] is ANALYSIS_SCHEMA
+    mock_update_episode.assert_awaited_once_with(
+        1,
+        content_type='感情の吐露',
+        emotion_analysis_json=json.dumps({'emotions': {'happy': 0.8}, 'polarity': 'positive'}),
+        keywords_json=json.dumps(['a', 'b', 'c', 'd', 'e']),
+        topics_json=json.dumps(['レジャー', '思い出']),
+        named_entities_json=json.dumps([{'text': '公園', 'type': 'LOCATION'}]),
+        sensitivity_level='低'
+    )
@@ -0,0 +1,104 @@
+import pytest
+import httpx
+from utils import http_client
+from utils.http_client import HttpClientPool
+
+
+def _pool(handler, monkeypatch, **kwargs):
+    """MockTransportで応答するプール。バックオフの待ち時間は上限の値を記録してすぐ返す"""
+    pool = HttpClientPool(http2=False, transport=httpx.MockTransport(handler), **kwargs)
+    delays = []
+
+    def uniform(low, high):
+        delays.append(high)
+        return 0.0
+
+    monkeypatch.setattr(http_client.random, "uniform", uniform)
+    return pool, delays
+
+
+def _flaky(failures, error=None, status=503):
+    """最初のfailures回は例外またはstatusを返し、その後は200を返すハンドラー"""
+    calls = []
+
+    def handler(request):
+        calls.append(request.method)
+        if len(calls) <= failures:
+            if error is not None:
+                raise error("boom", request=request)
+            return httpx.Response(status)
+        return httpx.Response(200, json={"ok": True})
+
+    return handler, calls
+
+
+@pytest.mark.asyncio
+async def test_get_retries_transport_errors_and_5xx_with_exponential_backoff(monkeypatch):
+    """GETは読み込みの失敗も5xxもリトライし、間隔の上限は base * 2^attempt (backoff_maxまで)"""
+    handler, calls = _flaky(3, error=httpx.ReadTimeout)
+    pool, delays = _pool(handler, monkeypatch, max_retries=3, backoff_base=0.5, backoff_max=1.5)
+    response = await pool.get("http://llm.test/v1/models")
+    assert response.status_code == 200 and len(calls) == 4
+    assert delays == [0.5, 1.0, 1.5]
+    assert pool.stats['retries'] == 3 and pool.stats['failures'] == 0
+
+    handler, calls = _flaky(1, status=503)
+    pool, _ = _pool(handler, monkeypatch)
+    assert (await pool.get("http://llm.test/health")).status_code == 200 and len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_gives_up_after_max_retries(monkeypatch):
+    """リトライし尽くしたら、例外はそのまま送出し、ステータスはそのまま返す"""
+    handler, calls = _flaky(10, error=httpx.ReadError)
+    pool, _ = _pool(handler, monkeypatch, max_retries=2)
+    with pytest.raises(httpx.ReadError):
+        await pool.get("http://llm.test/")
+    assert len(calls) == 3 and pool.stats['failures'] == 1
+
+    handler, calls = _flaky(10, status=502)
+    pool, _ = _pool(handler, monkeypatch, max_retries=2)
+    assert (await pool.get("http://llm.test/")).status_code == 502 and len(calls) == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("error", [httpx.ReadTimeout, httpx.RemoteProtocolError])
+async def test_post_is_not_resent_after_it_may_have_reached_the_server(monkeypatch, error):
+    """POSTは送った後の失敗 (読み込みタイムアウトなど) や5xxでは送り直さない"""
+    handler, calls = _flaky(1, error=error)
+    pool, _ = _pool(handler, monkeypatch)
+    with pytest.raises(error):
+        await pool.post("http://llm.test/v1/completions", json={"prompt": "hi"})
+    assert calls == ["POST"]
+
+    handler, calls = _flaky(1, status=503)
+    pool, _ = _pool(handler, monkeypatch)
+    assert (await pool.post("http://llm.test/v1/completions", json={})).status_code == 503
+    assert calls == ["POST"] and pool.stats['retries'] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("error", [httpx.ConnectError, httpx.ConnectTimeout])
+async def test_post_retries_when_connection_was_never_made(monkeypatch, error):
+    """接続できなかった場合はリクエストが届いていないので、POSTでもリトライする"""
+    handler, calls = _flaky(2, error=error)
+    pool, delays = _pool(handler, monkeypatch, backoff_base=0.1)
+    assert (await pool.post("http://llm.test/v1/completions", json={})).status_code == 200
+    assert calls == ["POST"] * 3 and delays == [0.1, 0.2]
+
+
+@pytest.mark.asyncio
+async def test_post_retries_everything_when_caller_opts_in(monkeypatch):
+    """idempotent=True を渡すと、POSTでもGETと同じようにリトライする"""
+    handler, calls = _flaky(1, error=httpx.ReadTimeout)
+    pool, _ = _pool(handler, monkeypatch)
+    assert (await pool.post("http://llm.test/search", json={}, idempotent=True)).status_code == 200
+    handler, calls = _flaky(1, status=503)
+    pool, _ = _pool(handler, monkeypatch)
+    assert (await pool.request("POST", "http://llm.test/search", idempotent=True)).status_code == 200
+    assert len(calls) == 2
+    # GETでも idempotent=False なら送り直さない
+    handler, calls = _flaky(1, error=httpx.ReadTimeout)
+    pool, _ = _pool(handler, monkeypatch)
+    with pytest.raises(httpx.ReadTimeout):
+        await pool.get("http://llm.test/", idempotent=False)
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import pytest
+from runtime.core.inference_executor import InferenceExecutor, InferenceQueueFullError
+
+
+@pytest.fixture
+def executor():
+    executor = InferenceExecutor(max_queue_size=2)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_returns_result_from_worker_thread(executor):
+    """関数はワーカースレッドで実行され、戻り値と例外はそのままawait側に届く"""
+    def work(a, b=0):
+        return a + b, threading.current_thread().name
+
+    result, thread_name = await executor.run(work, 1, b=2)
+    assert result == 3 and thread_name == "llama-inference"
+
+    def fail():
+        raise ValueError("bad prompt")
+
+    with pytest.raises(ValueError, match="bad prompt"):
+        await executor.run(fail)
+    # 失敗した後もワーカーは次のジョブを実行する
+    assert (await executor.run(lambda: 42)) == 42
+
+
+@pytest.mark.asyncio
+async def test_run_does_not_block_event_loop(executor):
+    """ワーカーがブロックしている間もイベントループは他の処理を進められる"""
+    release = threading.Event()
+    task = asyncio.create_task(executor.run(release.wait, 5))
+    await asyncio.sleep(0.01)
+    assert not task.done()
+    # ループが止まっていればここには来ない
+    release.set()
+    assert await task is True
+
+
+@pytest.mark.asyncio
+async def test_stream_yields_items_in_order_and_propagates_errors(executor):
+    """イテレータの要素を順に返し、途中の例外は要素を返し切った後に送出する"""
+    assert [item async for item in executor.stream(lambda n: iter(range(n)), 5)] == [0, 1, 2, 3, 4]
+
+    def failing():
+        yield "a"
+        yield "b"
+        raise RuntimeError("decode failed")
+
+    items = []
+    with pytest.raises(RuntimeError, match="decode failed"):
+        async for item in executor.stream(failing):
+            items.append(item)
+    assert items == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_stream_stops_worker_when_consumer_leaves(executor):
+    """読み手が途中で抜けたら、ワーカー側の反復も次の要素で止まる"""
+    produced = []
+    first_consumed = threading.Event()
+
+    def tokens():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+            if i == 0:
+                first_consumed.wait(5)
+
+    stream = executor.stream(tokens)
+    assert await stream.__anext__() == 0
+    await stream.aclose()
+    first_consumed.set()
+    # ワーカーが止まっていれば次のジョブがすぐ実行される
+    assert (await executor.run(lambda: len(produced))) <= 2
+
+
+@pytest.mark.asyncio
+async def test_full_queue_raises_instead_of_waiting(executor):
+    """ワーカーが塞がってキューが満杯なら、新しいジョブは待たずにInferenceQueueFullErrorになる"""
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        return release.wait(5)
+
+    running = asyncio.create_task(executor.run(block))
+    await asyncio.to_thread(started.wait, 5)
+    queued = [asyncio.create_task(executor.run(lambda i=i: i)) for i in range(2)]
+    await asyncio.sleep(0)
+    assert executor.queue_size == 2
+
+    with pytest.raises(InferenceQueueFullError):
+        await executor.run(lambda: None)
+    with pytest.raises(InferenceQueueFullError):
+        await executor.stream(lambda: iter([1])).__anext__()
+
+    release.set()
+    assert await running is True
+    assert await asyncio.gather(*queued) == [0, 1]
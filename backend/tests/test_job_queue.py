@@ -0,0 +1,109 @@
+import pytest
+import asyncio
+import os
+import aiosqlite
+from job_queue import JobQueue
+
+
+async def wait_for_status(queue: JobQueue, job_id: str, status: str, timeout: float = 5.0) -> dict:
+    """ジョブが指定の状態になるまで待つ"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        job = await queue.get_job(job_id)
+        if job['status'] == status:
+            return job
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError(f"job {job_id} is {job['status']}, expected {status}")
+        await asyncio.sleep(0.02)
+
+
+@pytest.mark.asyncio
+async def test_enqueue_runs_job_once_per_idempotency_key(tmp_path):
+    """同じidempotency_keyのジョブは1回だけ実行される"""
+    queue = JobQueue(db_path=os.path.join(tmp_path, "jobs.db"), num_workers=2, poll_interval=0.05)
+    calls = []
+
+    async def handler(ctx):
+        calls.append(ctx.payload['value'])
+        await ctx.report_progress(0.5, 'half')
+        return {'doubled': ctx.payload['value'] * 2}
+
+    queue.register('double', handler)
+    await queue.start()
+    try:
+        job_id = await queue.enqueue('double', {'value': 21}, idempotency_key='double:21')
+        assert await queue.enqueue('double', {'value': 21}, idempotency_key='double:21') == job_id
+        job = await wait_for_status(queue, job_id, 'succeeded')
+        assert job['result'] == {'doubled': 42}
+        assert job['progress'] == 1.0
+        assert calls == [21]
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_failed_job_is_retried_then_dead_lettered(tmp_path):
+    """失敗したジョブはリトライされ、上限に達するとdead_letter_jobsに移る"""
+    queue = JobQueue(db_path=os.path.join(tmp_path, "jobs.db"), num_workers=1, max_attempts=3,
+                     backoff_base=0.01, poll_interval=0.02)
+    attempts = []
+
+    async def handler(ctx):
+        attempts.append(ctx.attempt)
+        await ctx.save_state(last_attempt=ctx.attempt)
+        raise ValueError("boom")
+
+    queue.register('fail', handler)
+    await queue.start()
+    try:
+        job_id = await queue.enqueue('fail', {})
+        job = await wait_for_status(queue, job_id, 'dead')
+        assert attempts == [1, 2, 3]
+        assert job['state'] == {'last_attempt': 3}
+        assert 'boom' in job['last_error']
+        dead_letters = await queue.get_dead_letters()
+        assert [dead['job_id'] for dead in dead_letters] == [job_id]
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_running_job_is_requeued_after_restart(tmp_path):
+    """実行中のままプロセスが落ちたジョブは次の起動時に実行し直される"""
+    db_path = os.path.join(tmp_path, "jobs.db")
+    queue = JobQueue(db_path=db_path)
+    queue.register('work', lambda ctx: asyncio.sleep(0))
+    job_id = await queue.enqueue('work', {'n': 1})
+    # 取り出した直後に落ちた状態を作る
+    assert (await queue._claim())['job_id'] == job_id
+    async with aiosqlite.connect(db_path) as db:
+        async with db.execute('SELECT status FROM jobs WHERE job_id = ?', (job_id,)) as cursor:
+            assert (await cursor.fetchone())[0] == 'running'
+
+    restarted = JobQueue(db_path=db_path, poll_interval=0.02)
+    restarted.register('work', lambda ctx: asyncio.sleep(0, result={'ok': True}))
+    await restarted.start()
+    try:
+        job = await wait_for_status(restarted, job_id, 'succeeded')
+        assert job['attempts'] == 2
+    finally:
+        await restarted.stop()
+
+
+@pytest.mark.asyncio
+async def test_job_without_handler_stays_queued_until_registered(tmp_path):
+    """ハンドラーのない種類のジョブはdead letterにせず、登録されるまでキューに残す"""
+    queue = JobQueue(db_path=os.path.join(tmp_path, "jobs.db"), poll_interval=0.02)
+    job_id = await queue.enqueue('later', {'n': 1})
+    await queue.start()
+    try:
+        await asyncio.sleep(0.1)
+        job = await queue.get_job(job_id)
+        assert job['status'] == 'queued' and job['attempts'] == 0
+        assert await queue.get_dead_letters() == []
+
+        queue.register('later', lambda ctx: asyncio.sleep(0, result={'ok': True}))
+        job = await wait_for_status(queue, job_id, 'succeeded')
+        assert job['attempts'] == 1
+    finally:
+        await queue.stop()
@@ -0,0 +1,74 @@
+import pytest
+import os
+import struct
+from runtime.core.kv_store import DiskKVStore
+
+
+def test_save_and_load_round_trip(tmp_path):
+    """保存した状態はトークン列が一致するときだけ読め、再起動後の合計サイズも数え直す"""
+    store = DiskKVStore(str(tmp_path), max_bytes=1 << 20, namespace="model")
+    store.save("k1", [1, 2, 3], b"state-bytes")
+    assert bytes(store.load("k1", [1, 2, 3])) == b"state-bytes"
+    # ハッシュが衝突した別のプレフィックスは読まないが、ファイルは残す
+    assert store.load("k1", [1, 2, 4]) is None
+    assert store.load("missing", [1]) is None
+    assert (tmp_path / "model" / "k1.kv").exists()
+
+    stats = store.stats()
+    assert stats['entries'] == 1 and stats['hits'] == 1 and stats['misses'] == 2
+    assert DiskKVStore(str(tmp_path), namespace="model").total_bytes == stats['bytes'] == 4 + 4 + 3 * 4 + 11
+
+
+@pytest.mark.parametrize("content", [
+    b"",
+    b"KV",
+    b"XXXX" + struct.pack("<I", 1) + b"\0" * 16,
+    # トークン数がファイルの大きさを超えている
+    b"KVS1" + struct.pack("<I", 0xFFFFFFFF) + b"\0" * 16,
+])
+def test_unreadable_file_is_a_miss_and_removed(tmp_path, content):
+    """短い・別形式・壊れたヘッダーのファイルは例外にせずミスとして扱い、削除する"""
+    store = DiskKVStore(str(tmp_path))
+    store.save("good", [1], b"data")
+    path = tmp_path / "default" / "bad.kv"
+    path.write_bytes(content)
+    store.total_bytes += len(content)
+
+    assert store.load("bad", [1]) is None
+    assert not path.exists()
+    assert store.total_bytes == os.path.getsize(tmp_path / "default" / "good.kv")
+    assert store.stats()['misses'] == 1
+    assert bytes(store.load("good", [1])) == b"data"
+
+
+def test_evicts_least_recently_used_files_over_budget(tmp_path):
+    """合計サイズが上限を超えたら、最後に使ったのが古いファイルから削除する"""
+    entry_size = 4 + 4 + 4 + 100
+    store = DiskKVStore(str(tmp_path), max_bytes=entry_size * 2)
+    store.save("a", [1], b"a" * 100)
+    store.save("b", [2], b"b" * 100)
+    os.utime(tmp_path / "default" / "a.kv", (1, 1))
+    os.utime(tmp_path / "default" / "b.kv", (2, 2))
+    # 読むとアクセス時刻が更新されるので a は残る
+    assert store.load("a", [1]) is not None
+    store.save("c", [3], b"c" * 100)
+
+    assert sorted(p.stem for p in (tmp_path / "default").glob("*.kv")) == ["a", "c"]
+    assert store.total_bytes == entry_size * 2
+    # 上限を超える状態は保存しない
+    store.save("big", [4], b"x" * entry_size * 2)
+    assert not (tmp_path / "default" / "big.kv").exists()
+
+
+def test_prefix_cache_treats_corrupt_disk_entry_as_miss(tmp_path):
+    """壊れたディスクのスナップショットはPrefixKVCacheからもミスに見え、次の参照では読みに行かない"""
+    pytest.importorskip("llama_cpp")
+    from runtime.core.prefix_cache import PrefixKVCache, prefix_key
+
+    store = DiskKVStore(str(tmp_path))
+    cache = PrefixKVCache(max_bytes=1 << 20, disk_store=store)
+    tokens = [1, 2, 3]
+    (tmp_path / "default" / f"{prefix_key(tokens)}.kv").write_bytes(b"KVS1")
+    assert cache.get(tokens) is None
+    assert cache.get(tokens) is None
+    assert store.stats()['entries'] == 0
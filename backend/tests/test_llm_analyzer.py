@@ -0,0 +1,86 @@
+import pytest
+from unittest.mock import AsyncMock
+from question_agent.llm_analyzer import LLMAnalyzer, ANALYSIS_SCHEMA
+
+VALID_ANALYSIS = {
+    'content_type': '過去の出来事の回想',
+    'emotions': {'emotions': {'happy': 0.8}, 'polarity': 'positive'},
+    'keywords': ['公園', '写真'],
+    'topics': ['レジャー'],
+    'named_entities': [{'text': '公園', 'type': 'LOCATION'}],
+    'sensitivity': '低'
+}
+
+# 個別の分析のプロンプトの末尾の見出しと、それに対するLLMの応答
+PER_FIELD_RESPONSES = {
+    '種類：': 'その他',
+    '感情の極性': '{"emotions": {"calm": 0.5}, "polarity": "neutral"}',
+    'キーワード：': '散歩, 公園, 写真, 友達, 昨日, 午後',
+    'トピック：': '休日, 趣味, 外出',
+    '固有表現': '[{"text": "友達", "type": "PERSON"}]',
+    '機微度：': '中'
+}
+
+
+def _per_field_api():
+    async def call_llm_api(prompt, max_tokens=150, json_schema=None):
+        for marker, response in PER_FIELD_RESPONSES.items():
+            if marker in prompt:
+                return response
+        raise AssertionError(f"unexpected prompt: {prompt}")
+    return AsyncMock(side_effect=call_llm_api)
+
+
+@pytest.fixture
+def analyzer():
+    return LLMAnalyzer("http://localhost/v1/completions", "key")
+
+
+@pytest.mark.asyncio
+async def test_analyze_all_uses_single_json_call(analyzer):
+    """全項目が検証に通れば1回のJSONの呼び出しの結果をそのまま返し、個別の分析は呼ばない"""
+    analyzer._call_llm_json = AsyncMock(return_value=dict(VALID_ANALYSIS, extra='ignored'))
+    analyzer._call_llm_api = _per_field_api()
+
+    assert await analyzer.analyze_all("昨日、公園で写真を撮った") == VALID_ANALYSIS
+    analyzer._call_llm_json.assert_awaited_once()
+    assert analyzer._call_llm_json.await_args.args[1] is ANALYSIS_SCHEMA
+    analyzer._call_llm_api.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_analyze_all_reanalyzes_only_invalid_fields(analyzer):
+    """検証に通らない項目 (選択肢外・型違い・欠落) だけ個別に分析し直し、件数の上限で切り詰める"""
+    analyzer._call_llm_json = AsyncMock(return_value={
+        'content_type': '雑談',
+        'emotions': {'emotions': {'happy': 'high'}, 'polarity': 'positive'},
+        'keywords': ['a', 'b', 'c', 'd', 'e', 'f'],
+        'topics': ['レジャー', None],
+        'named_entities': [{'text': '公園', 'type': 'LOCATION'}]
+    })
+    analyzer._call_llm_api = _per_field_api()
+
+    result = await analyzer.analyze_all("昨日、公園で写真を撮った")
+
+    assert result == {
+        'content_type': 'その他',
+        'emotions': {'emotions': {'calm': 0.5}, 'polarity': 'neutral'},
+        'keywords': ['a', 'b', 'c', 'd', 'e'],
+        'topics': ['休日', '趣味'],
+        'named_entities': [{'text': '公園', 'type': 'LOCATION'}],
+        'sensitivity': '中'
+    }
+    assert analyzer._call_llm_api.await_count == 4
+
+
+@pytest.mark.asyncio
+async def test_analyze_all_falls_back_when_json_call_fails(analyzer):
+    """JSONの生成が失敗したら全項目を個別に分析する"""
+    analyzer._call_llm_json = AsyncMock(side_effect=ValueError("No JSON object in response"))
+    analyzer._call_llm_api = _per_field_api()
+
+    result = await analyzer.analyze_all("昨日、公園で写真を撮った")
+
+    assert result['keywords'] == ['散歩', '公園', '写真', '友達', '昨日']
+    assert result['named_entities'] == [{'text': '友達', 'type': 'PERSON'}]
+    assert analyzer._call_llm_api.await_count == 6
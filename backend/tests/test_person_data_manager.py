@@ -0,0 +1,48 @@
+import pytest
+import os
+import db_manager
+from db import models
+from runtime.core.person_data_manager import PersonDataManager
+
+
+@pytest.mark.asyncio
+async def test_persona_snapshot_rebuilds_only_changed_sections(tmp_path, orm_session):
+    """user_info / PersonDataEntry が変わったときだけ作り直し、変わった行だけをトークン化する"""
+    db_path = os.path.join(tmp_path, "persona.db")
+    await db_manager.initialize_database(db_path)
+    engine, Session = await orm_session()
+    async with engine.begin() as conn:
+        await conn.run_sync(models.create_person_data_version_triggers)
+
+    tokenized = []
+    def tokenize(text):
+        tokenized.append(text)
+        return [ord(c) for c in text]
+
+    try:
+        await db_manager.add_user_info_many(1, {"hobbies": "読書", "values": "誠実さ"}, db_path=db_path)
+        manager = PersonDataManager(tokenize=tokenize, tokenizer_id="t", session_factory=Session, db_path=db_path)
+        snapshot = await manager.get_person_data(1)
+        assert snapshot.render(["hobbies"]) == "- hobbies: 読書\n"
+        assert "".join(map(chr, snapshot.token_ids)) == snapshot.prompt_text
+        assert await manager.get_person_data(1) is snapshot
+
+        tokenized.clear()
+        await db_manager.add_user_info(1, "hobbies", "登山", db_path=db_path)
+        async with Session() as db:
+            db.add(models.User(id="1", email="a@example.com", password_hash="x"))
+            db.add(models.PersonDataEntry(id="p1", user_id="1", tag_name="values", source="user_direct_input",
+                                          entry_content={"description": "約束を守る"}))
+            await db.commit()
+        snapshot = await manager.get_person_data(1)
+        assert tokenized == ["- hobbies: 登山\n", "- values: 約束を守る\n"]
+        assert "".join(map(chr, snapshot.token_ids)) == snapshot.prompt_text
+        assert snapshot.token_count == len(snapshot.prompt_text)
+
+        # 別プロセスで起動し直してもDBに保存したスナップショットを使う
+        tokenized.clear()
+        restarted = PersonDataManager(tokenize=tokenize, tokenizer_id="t", session_factory=Session, db_path=db_path)
+        assert (await restarted.get_person_data(1)).token_ids == snapshot.token_ids
+        assert tokenized == []
+    finally:
+        await db_manager.close_database_pool(db_path)
@@ -0,0 +1,119 @@
+import pytest
+import asyncio
+import json
+from types import SimpleNamespace
+
+pytest.importorskip("openai")
+pytest.importorskip("dotenv")
+
+from runtime.core.person_data_manager import PERSONA_HEADER, PersonaSnapshot
+from think_handler import pipeline
+
+
+class FakeCompletions:
+    """AsyncOpenAI.chat.completions の代わり。タグ選択はtag_contentを返し、応答生成はchunksを順に流す"""
+
+    def __init__(self, tag_content, chunks=(), before_tags=None):
+        self.tag_content = tag_content
+        self.chunks = chunks
+        self.before_tags = before_tags
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("stream"):
+            return self._stream()
+        if self.before_tags is not None:
+            await self.before_tags()
+        if isinstance(self.tag_content, Exception):
+            raise self.tag_content
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.tag_content))])
+
+    async def _stream(self):
+        for content in self.chunks:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class FakePersonData:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.started = asyncio.Event()
+        self.calls = 0
+
+    async def get_person_data(self, user_id):
+        self.calls += 1
+        self.started.set()
+        await asyncio.sleep(0)
+        return self.snapshot
+
+
+def _snapshot():
+    return PersonaSnapshot(
+        user_id=1, version="v1",
+        values={"hobbies": "読書", "values": "誠実さ"},
+        sections={"hobbies": "- hobbies: 読書\n", "values": "- values: 誠実さ\n"},
+    )
+
+
+def _use_client(monkeypatch, completions):
+    monkeypatch.setattr(pipeline, "_client", SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    monkeypatch.setattr(pipeline, "LM_STUDIO_MODEL_REQUEST", "tag-model")
+    monkeypatch.setattr(pipeline, "LM_STUDIO_MODEL_RESPONSE", "response-model")
+
+
+@pytest.mark.asyncio
+async def test_snapshot_fetch_overlaps_tag_selection(monkeypatch):
+    """タグ選択のLLM呼び出しが終わる前に人格スナップショットの取得が始まっている"""
+    person_data = FakePersonData(_snapshot())
+
+    async def wait_for_snapshot():
+        # スナップショットの取得が並行して始まらなければタイムアウトでタグ選択がエラーになる
+        await asyncio.wait_for(person_data.started.wait(), timeout=1)
+
+    completions = FakeCompletions(
+        json.dumps({"selected_tags": ["hobbies", "unknown"]}), before_tags=wait_for_snapshot
+    )
+    _use_client(monkeypatch, completions)
+    persona = pipeline.PersonaPipeline("test", ["hobbies", "values"], person_data=person_data)
+
+    tags, user_info, rendered = await persona.gather_user_info(1, {"place": "家"})
+    # 元のタグリストにないタグは捨てる
+    assert tags == ["hobbies"]
+    assert user_info == {"hobbies": "読書"}
+    assert rendered == "- hobbies: 読書\n"
+    assert person_data.calls == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("tag_content", ["JSONではない", RuntimeError("model_not_found")])
+async def test_tag_selection_error_short_circuits_user_info(monkeypatch, tag_content):
+    """タグ選択に失敗したらスナップショットは使わず、エラー内容をユーザー情報として渡す"""
+    completions = FakeCompletions(tag_content)
+    _use_client(monkeypatch, completions)
+    persona = pipeline.PersonaPipeline("test", ["hobbies"], person_data=FakePersonData(_snapshot()))
+
+    tags, user_info, rendered = await persona.gather_user_info(1, {})
+    assert len(tags) == 1 and tags[0].startswith("エラー：")
+    assert user_info == {"error": tags[0]}
+    assert rendered is None
+    assert "- システム情報: エラー：" in persona.build_response_system_prompt(user_info, {}, rendered)
+
+
+@pytest.mark.asyncio
+async def test_stream_user_request_yields_chunks_in_order(monkeypatch):
+    """応答は届いた順に返し、中身のないチャンクは飛ばす。システムプロンプトには描画済みの人格情報が入る"""
+    completions = FakeCompletions(
+        '```json\n{"selected_tags": ["hobbies", "values"]}\n```', chunks=["こん", None, "にち", "", "は"]
+    )
+    _use_client(monkeypatch, completions)
+    persona = pipeline.PersonaPipeline("test", ["hobbies", "values"], person_data=FakePersonData(_snapshot()))
+
+    parts = [part async for part in persona.stream_user_request(1, "やあ", {"place": "家"})]
+    assert parts == ["こん", "にち", "は"]
+
+    response_call = completions.calls[-1]
+    assert response_call["stream"] is True and response_call["model"] == "response-model"
+    system_prompt = response_call["messages"][0]["content"]
+    assert PERSONA_HEADER + "- hobbies: 読書\n- values: 誠実さ\n" in system_prompt
+    assert response_call["messages"][1] == {"role": "user", "content": "やあ"}
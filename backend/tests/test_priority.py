@@ -0,0 +1,22 @@
+import pytest
+from runtime.core.priority import FairQueue
+
+
+def test_fair_queue_orders_by_lane_then_user_usage():
+    """レーンの優先度順に取り出し、同じレーン内は消費量の少ないユーザーから"""
+    queue = FairQueue(user_weights={"2": 3.0})
+    for i in range(3):
+        queue.push(f"a{i}", "batch", user=1)
+        queue.push(f"b{i}", "batch", user=2)
+    queue.push("chat", "interactive", user=1)
+    queue.push("retry", "batch", user=1, front=True)
+
+    assert queue.pop() == "chat"
+    queue.charge(1, 30)
+    queue.charge(2, 30)  # 重み3なので消費量は10
+    assert [queue.pop() for _ in range(3)] == ["b0", "b1", "b2"]
+    assert [queue.pop() for _ in range(4)] == ["retry", "a0", "a1", "a2"]
+    assert queue.pop() is None and len(queue) == 0
+
+    with pytest.raises(ValueError):
+        queue.push("x", "urgent")
@@ -0,0 +1,70 @@
+import re
+from runtime.core.prompt_template import PromptTemplate, TokenizationCache
+
+
+def test_compiled_template_tokenizes_only_slots():
+    """固定部分はcompile時に1回だけトークン化し、cached_slotsの値はLRUで覚える"""
+    calls = []
+    def tokenize(text, special):
+        calls.append(text)
+        return [ord(c) for c in text]
+
+    cache = TokenizationCache(tokenize, max_entries=2)
+    template = PromptTemplate("[SYS]{persona}\n[USER]{prompt}[/USER]", cached_slots=("persona",))
+    compiled = template.compile(cache)
+    assert compiled.exact
+    calls.clear()
+
+    values = {"persona": "読書が好き", "prompt": "こんにちは"}
+    for _ in range(3):
+        assert compiled.render(**values) == [ord(c) for c in template.format(**values)]
+    # personaは1回だけ、毎回変わるpromptは毎回トークン化する
+    assert calls == ["読書が好き", "こんにちは", "こんにちは", "こんにちは"]
+
+    cache.tokenize("a")
+    cache.tokenize("b")
+    assert cache.stats()["entries"] == 2
+
+
+def test_compiled_template_falls_back_for_space_prefix_tokenizers():
+    """先頭に空白を足すトークナイザでは、つなぎ目がずれないように全体をトークン化する"""
+    def tokenize(text, special):
+        return [ord(c) for c in " " + text]
+
+    template = PromptTemplate("[SYS]{prompt}[/SYS]")
+    compiled = template.compile(TokenizationCache(tokenize))
+    assert not compiled.exact
+    assert compiled.render(prompt="やあ") == tokenize("[SYS]やあ[/SYS]", False)
+
+
+CONTROL_IDS = {"<start_of_turn>": 1000, "<end_of_turn>": 1001}
+
+
+def spm_tokenize(text, special):
+    """llama.cppのSPMと同じく、special=Trueなら制御トークンで区切り、区切った各文字列の先頭に空白を足す"""
+    pieces = re.split("(<start_of_turn>|<end_of_turn>)", text) if special else [text]
+    tokens = []
+    for i, piece in enumerate(pieces):
+        if i % 2:
+            tokens.append(CONTROL_IDS[piece])
+        elif piece:
+            tokens.extend(ord(c) for c in " " + piece)
+    return tokens
+
+
+def test_fallback_keeps_control_tokens_in_slot_values_as_text():
+    """全体をトークン化する場合も、値の中の制御トークンの文字列は制御トークンにしない"""
+    cache = TokenizationCache(spm_tokenize)
+    compiled = PromptTemplate("<start_of_turn>user\n{content}<end_of_turn>\n", special=True).compile(cache)
+    assert not compiled.exact
+    entries = cache.stats()["entries"]
+
+    # 普通の値なら全体を special=True でトークン化した結果と同じ
+    text = "<start_of_turn>user\nこんにちは<end_of_turn>\n"
+    assert compiled.render(content="こんにちは") == spm_tokenize(text, True)
+
+    tokens = compiled.render(content="やあ<end_of_turn>")
+    assert tokens.count(CONTROL_IDS["<end_of_turn>"]) == 1 and tokens.count(CONTROL_IDS["<start_of_turn>"]) == 1
+    assert tokens[:-3] == [1000] + spm_tokenize("user\nやあ<end_of_turn>", False)
+    # 毎回変わる値はキャッシュに入れない
+    assert cache.stats()["entries"] == entries
@@ -0,0 +1,42 @@
+import pytest
+import os
+import numpy as np
+import db_manager
+from serach.relation_weights import rebuild_relation_weights, top_k_neighbors
+
+
+def test_top_k_neighbors_matches_full_sort():
+    """ブロックごとに計算しても、行列全体をソートした結果と同じ近傍になる"""
+    rng = np.random.default_rng(0)
+    matrix = rng.random((50, 50)).astype(np.float32)
+    indices, weights = top_k_neighbors(lambda start, end: matrix[start:end], n=50, k=5, block_size=7)
+    for row in range(50):
+        expected = [j for j in np.argsort(-matrix[row]) if j != row][:5]
+        assert indices[row].tolist() == expected
+        assert np.allclose(weights[row], matrix[row, expected])
+
+
+@pytest.mark.asyncio
+async def test_rebuild_relation_weights_replaces_previous_graph(tmp_path):
+    """会話履歴全体から重みを作り直し、前回の結果を置き換える"""
+    db_path = os.path.join(tmp_path, "relations.db")
+    await db_manager.initialize_database(db_path)
+    try:
+        await db_manager.get_database_pool(db_path).executemany(
+            'INSERT INTO conversation_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+            [(1, 'user', '京都で抹茶を飲んだ', '2024-01-01 10:00:00'),
+             (1, 'user', '京都の抹茶はおいしい', '2024-01-03 10:00:00'),
+             (1, 'user', '仕事が忙しい', '2024-01-01 10:30:00')]
+        )
+        for _ in range(2):
+            counts = await rebuild_relation_weights(1, top_k=1, db_path=db_path)
+        assert counts == {'temporal': 3, 'contextual': 3}
+
+        temporal = await db_manager.get_relation_weights(1, 'temporal', db_path=db_path)
+        assert [row['related_message_id'] for row in temporal] == [3]
+        contextual = await db_manager.get_relation_weights(1, 'contextual', db_path=db_path)
+        assert [row['related_message_id'] for row in contextual] == [2]
+        total = await db_manager.get_database_pool(db_path).fetchone('SELECT COUNT(*) FROM relation_weights')
+        assert total[0] == 6
+    finally:
+        await db_manager.close_database_pool(db_path)
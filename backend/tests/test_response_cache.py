@@ -0,0 +1,125 @@
+import pytest
+import os
+import numpy as np
+from runtime.core.response_cache import ResponseCache, normalize_prompt, response_key
+
+
+class StubEmbedder:
+    """文字列ごとに決めたベクトル (正規化済み) を返す"""
+
+    def __init__(self, vectors):
+        self.vectors = {text: np.asarray(v, dtype=np.float32) / np.linalg.norm(v) for text, v in vectors.items()}
+        self.calls = []
+
+    async def embed_one(self, text):
+        self.calls.append(text)
+        return self.vectors.get(text, np.array([0.0, 0.0, 1.0], dtype=np.float32))
+
+
+async def _value(text):
+    return text
+
+
+def _key(prompt, namespace="default"):
+    return response_key(namespace, normalize_prompt(prompt))
+
+
+def test_normalize_prompt_folds_width_and_whitespace():
+    """全角/半角と空白・改行の違いは同じキーになる"""
+    assert normalize_prompt("ＡＢＣ　１２３\n\n  ﾃｽﾄ ") == "ABC 123 テスト"
+    assert response_key("q", normalize_prompt("ＡＢＣ")) == response_key("q", normalize_prompt(" ABC\n"))
+    assert response_key("q", "ABC") != response_key("r", "ABC")
+
+
+@pytest.mark.asyncio
+async def test_lookup_hits_normalized_prompt_and_expires_after_ttl():
+    """正規化後に同じプロンプトは完全一致でヒットし、TTLを過ぎたものは捨てる"""
+    cache = ResponseCache(ttl=60)
+    await cache.store("こんにちは　世界", "やあ")
+    assert (await cache.lookup(" こんにちは 世界\n"))[0] == "やあ"
+    assert (await cache.lookup("こんにちは世界"))[0] is None
+    assert (await cache.lookup("こんにちは 世界", namespace="other"))[0] is None
+
+    cache.entries[_key("こんにちは 世界")].created_at -= 61
+    assert (await cache.lookup("こんにちは 世界"))[0] is None
+    assert cache.entries == {}
+    stats = cache.get_stats()
+    assert stats['exact_hits'] == 1 and stats['misses'] == 3 and stats['hit_rate'] == 0.25
+
+
+@pytest.mark.asyncio
+async def test_lru_evicts_least_recently_used_entry():
+    """上限を超えたら最後に使ったのが最も古いものから捨てる"""
+    cache = ResponseCache(max_size=2)
+    await cache.store("a", "A")
+    await cache.store("b", "B")
+    assert (await cache.lookup("a"))[0] == "A"
+    await cache.store("c", "C")
+    assert (await cache.lookup("b"))[0] is None
+    assert (await cache.lookup("a"))[0] == "A" and (await cache.lookup("c"))[0] == "C"
+    assert cache.get_stats()['evictions'] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_or_generate_respects_refresh_and_use_cache():
+    """refreshは読まずに生成し直して上書きし、use_cache=Falseはキャッシュを読みも書きもしない"""
+    cache = ResponseCache()
+    calls = []
+
+    def generator(text):
+        async def generate():
+            calls.append(text)
+            return text
+        return generate
+
+    assert await cache.get_or_generate("q", generator("first")) == "first"
+    assert await cache.get_or_generate("q", generator("unused")) == "first"
+    assert await cache.get_or_generate("q", generator("second"), refresh=True) == "second"
+    assert await cache.get_or_generate("q", generator("unused")) == "second"
+    assert await cache.get_or_generate("q", generator("bypass"), use_cache=False) == "bypass"
+    assert await cache.get_or_generate("new", generator("bypass"), use_cache=False) == "bypass"
+    assert calls == ["first", "second", "bypass", "bypass"]
+    assert len(cache.entries) == 1 and (await cache.lookup("q"))[0] == "second"
+
+
+@pytest.mark.asyncio
+async def test_semantic_tier_matches_similar_prompt_in_same_namespace():
+    """埋め込みの類似度がしきい値以上なら別の言い回しでもヒットし、埋め込みはstoreで再利用する"""
+    embedder = StubEmbedder({
+        "今日の天気は?": [1.0, 0.0, 0.0],
+        "今日の天気を教えて": [0.99, 0.05, 0.0],
+        "好きな食べ物は?": [0.0, 1.0, 0.0],
+    })
+    cache = ResponseCache(embedder=embedder, similarity_threshold=0.95)
+    assert await cache.get_or_generate("今日の天気は?", lambda: _value("晴れ")) == "晴れ"
+    # lookupで計算した埋め込みをstoreでも使うので、埋め込みは1回だけ
+    assert embedder.calls == ["今日の天気は?"]
+
+    response, embedding = await cache.lookup("今日の天気を教えて")
+    assert response == "晴れ" and embedding is not None
+    assert (await cache.lookup("好きな食べ物は?"))[0] is None
+    assert (await cache.lookup("今日の天気を教えて", namespace="other"))[0] is None
+    stats = cache.get_stats()
+    assert stats['semantic_hits'] == 1 and stats['semantic_enabled']
+
+
+@pytest.mark.asyncio
+async def test_entries_survive_restart_with_sqlite(tmp_path):
+    """sqlite_pathを指定すると、再起動後も期限内の応答と埋め込み・LRUの順序が残る"""
+    sqlite_path = os.path.join(tmp_path, "cache", "responses.db")
+    embedder = StubEmbedder({})
+    cache = ResponseCache(max_size=2, ttl=60, sqlite_path=sqlite_path, embedder=embedder)
+    await cache.store("a", "A")
+    await cache.store("b", "B")
+    await cache.store("c", "C")
+
+    restarted = ResponseCache(max_size=2, ttl=60, sqlite_path=sqlite_path)
+    assert (await restarted.lookup("a"))[0] is None
+    assert (await restarted.lookup("b"))[0] == "B" and (await restarted.lookup("c"))[0] == "C"
+    assert list(restarted.entries) == [_key("b"), _key("c")]
+    # 埋め込みもBLOBから復元する
+    np.testing.assert_allclose(restarted.entries[_key("c")].embedding, await embedder.embed_one("c"))
+
+    # TTLを過ぎた行は読み込み時に消える
+    expired = ResponseCache(ttl=0, sqlite_path=sqlite_path)
+    assert (await expired.lookup("b"))[0] is None and expired.entries == {}
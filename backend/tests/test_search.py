@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import text
+from db import models, search
+
+
+@pytest.mark.asyncio
+async def test_search_index_follows_source_tables(orm_session):
+    """トリガーで索引が更新され、日本語の本文を利用者ごとに検索できる"""
+    engine, Session = await orm_session("search.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(search.create_search_index)
+
+    async with Session() as db:
+        db.add_all([
+            models.User(id="1", email="a@example.com", password_hash="x"),
+            models.User(id="2", email="b@example.com", password_hash="x"),
+        ])
+        db.add_all([
+            models.Thread(id="t1", owner_user_id="1", mode="chat"),
+            models.Thread(id="t2", owner_user_id="2", mode="chat"),
+        ])
+        await db.flush()
+        db.add_all([
+            models.Message(thread_id="t1", role="user", context="昨日は京都で抹茶パフェを食べた"),
+            models.Message(thread_id="t2", role="user", context="抹茶パフェは苦手"),
+            models.PersonDataEntry(id="p1", user_id="1", tag_name="hobbies", source="user_direct_input",
+                                   entry_content={"description": "抹茶スイーツの食べ歩き"}),
+        ])
+        await db.commit()
+
+        hits = await search.search(db, "抹茶パフェ", user_id="1")
+        assert [(hit.kind, hit.thread_id) for hit in hits] == [("message", "t1")]
+        assert hits[0].score > 0
+        # JSONの中の日本語も索引に入る
+        persona = await search.search_persona_entries(db, "1", "食べ歩き")
+        assert [hit.ref_id for hit in persona] == ["p1"]
+
+        await db.execute(text("UPDATE person_data_entries SET entry_content = :c"), {"c": '{"description": "読書"}'})
+        await db.execute(text('DELETE FROM "Message" WHERE thread_id = :t'), {"t": "t1"})
+        await db.commit()
+        assert await search.search(db, "抹茶", user_id="1") == []
+        assert [hit.ref_id for hit in await search.search(db, "読書", user_id="1")] == ["p1"]
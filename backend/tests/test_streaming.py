@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from runtime.core.cancellation import CancellationToken
+from utils.streaming import IncrementalTokenDecoder, cancel_on_disconnect, coalesce
+
+
+def test_decoder_keeps_multibyte_characters_split_across_tokens():
+    """1文字のバイト列が複数トークンに分かれていても文字化けしない"""
+    data = "日本語".encode("utf-8")
+    pieces = {i: data[i:i + 1] for i in range(len(data))}
+    decoder = IncrementalTokenDecoder(lambda tokens: b"".join(pieces[t] for t in tokens))
+    out = [decoder.decode([i]) for i in range(len(data))]
+    assert "".join(out) + decoder.flush() == "日本語"
+    assert [piece for piece in out if piece] == ["日", "本", "語"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_groups_fast_pieces_and_flushes_slow_ones():
+    """速く届く片はまとめ、間が空いたときはintervalで送り出す"""
+    async def source():
+        for i in range(40):
+            yield str(i % 10)
+        await asyncio.sleep(0.05)
+        yield "x"
+
+    frames = [frame async for frame in coalesce(source(), interval=0.01, max_pieces=16)]
+    assert "".join(frames) == "".join(str(i % 10) for i in range(40)) + "x"
+    assert len(frames) <= 4 and frames[-1] == "x"
+
+    async def failing():
+        yield "a"
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        async for _ in coalesce(failing()):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_cancel_on_disconnect_cancels_token():
+    """クライアントが切断したらキャンセルトークンが立つ"""
+    class FakeRequest:
+        polls = 0
+
+        async def is_disconnected(self):
+            self.polls += 1
+            return self.polls >= 3
+
+    token = CancellationToken()
+    await asyncio.wait_for(cancel_on_disconnect(FakeRequest(), token, interval=0.001), 1)
+    assert token.cancelled and token.reason == "client disconnected"
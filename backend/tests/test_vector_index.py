@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from runtime.core.vector_index import EpisodeVectorStore, UserVectorIndex
+
+
+def test_vector_index_search_survives_ivf_and_reopen(tmp_path):
+    """IVFの学習前後・削除・開き直しのどれでも近いエピソードが引ける"""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(8, 32)).astype(np.float32)
+    vectors = centers[np.arange(400) % 8] + 0.05 * rng.normal(size=(400, 32)).astype(np.float32)
+
+    index = UserVectorIndex(str(tmp_path), dim=32, ivf_min_size=200, nprobe=4, initial_capacity=16)
+    for episode_id, vector in enumerate(vectors):
+        index.add(episode_id, vector)
+    assert index.count == 400 and index.capacity >= 400
+    assert index.search(vectors[10], k=1)[0][0] == 10
+
+    assert index.needs_training
+    index.train()
+    assert not index.needs_training
+    hits = index.search(vectors[10], k=5, exclude_ids=[10])
+    assert len(hits) == 5 and all(episode_id % 8 == 10 % 8 for episode_id, _ in hits)
+
+    assert index.remove(10)
+    assert 10 not in [episode_id for episode_id, _ in index.search(vectors[10], k=5)]
+    index.add(399, vectors[3])  # 同じepisode_idは上書き
+    assert index.search(vectors[3], k=2)[1][0] in (3, 399)
+
+    reopened = UserVectorIndex(str(tmp_path), dim=32, ivf_min_size=200, nprobe=4)
+    assert reopened.count == 399
+    assert reopened.centroids is not None
+    assert reopened.search(vectors[11], k=1)[0][0] == 11
+
+
+def test_vector_index_batches_flushes_of_added_rows(tmp_path):
+    """追加はflush_every件ごとにまとめて書き出し、削除はすぐに書き出す"""
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(10, 8)).astype(np.float32)
+    index = UserVectorIndex(str(tmp_path), dim=8, flush_every=4)
+    for episode_id in range(6):
+        index.add(episode_id, vectors[episode_id])
+    # 4件目で書き出したので、開き直すと5件目以降はまだ見えない
+    assert UserVectorIndex(str(tmp_path), dim=8).count == 4
+
+    index.flush()
+    reopened = UserVectorIndex(str(tmp_path), dim=8)
+    assert reopened.count == 6 and reopened.search(vectors[5], k=1)[0][0] == 5
+
+    assert index.remove(2)
+    reopened = UserVectorIndex(str(tmp_path), dim=8)
+    assert reopened.count == 5
+    assert sorted(episode_id for episode_id, _ in reopened.search(vectors[0], k=10)) == [0, 1, 3, 4, 5]
+
+
+class StubEmbedder:
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    async def embed_one(self, text):
+        return self.vectors[int(text)]
+
+
+@pytest.mark.asyncio
+async def test_episode_vector_store_flushes_on_close(tmp_path):
+    """EpisodeVectorStoreの追加はワーカースレッドで行い、closeで残りを書き出す"""
+    vectors = np.eye(6, dtype=np.float32)
+    store = EpisodeVectorStore(StubEmbedder(vectors), directory=str(tmp_path), flush_every=100)
+    for episode_id in range(6):
+        await store.add_episode(1, episode_id, str(episode_id))
+    assert (await store.related_episodes(1, "3", k=1))[0][0] == 3
+    assert await store.remove_episode(1, 3)
+    await store.add_episode(1, 3, "3")
+    await store.close()
+
+    reopened = EpisodeVectorStore(StubEmbedder(vectors), directory=str(tmp_path))
+    assert (await reopened.related_episodes(1, "3", k=1))[0][0] == 3
+    assert (await reopened.related_to_episode(1, 4, k=5))[0][0] != 4
+    assert reopened._get_index(1).count == 6
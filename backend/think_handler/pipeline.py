@@ -0,0 +1,293 @@
+# think_handler/pipeline.py
+# bigfive / mbti / sfe で共通の「タグ選択 -> DB検索 -> 応答生成」パイプライン
+import os
+import re
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, List, Optional, Tuple
+
+import openai
+from dotenv import load_dotenv
+
+import db_manager
+from runtime.core.person_data_manager import PERSONA_FOOTER, PERSONA_HEADER, PersonDataManager
+from utils.http_client import get_http_pool
+
+load_dotenv()
+
+# --- 設定 ---
+## .envからLM StudioのエンドポイントURLを読み込む
+LM_STUDIO_URL = os.getenv("LM_STUDIO_BASE_URL", "http://localhost:1234/v1")
+LM_STUDIO_API_KEY = "lm-studio"
+
+## モデル名を読み込む
+# Step 1: タグ選択用軽量モデル
+LM_STUDIO_MODEL_REQUEST = os.getenv("LM_STUDIO_MODEL_REQUEST")
+# Step 2: 応答生成用モデル (元のモデルなど)
+LM_STUDIO_MODEL_RESPONSE = os.getenv("LM_STUDIO_MODEL_RESPONSE") # または元の LM_STUDIO_MODEL
+
+logger = logging.getLogger('discord')
+
+DEFAULT_RESPONSE_SYSTEM_PROMPT = """
+    以下の全ての情報（関連ユーザー情報とシチュエーション情報）を深く読み込み、その人物の**思考パターン、感情の動き、話し方の特徴、そして内面に秘めたもの（直接触れない場合でも、その影響を感じさせるようなニュアンス）**を推測してください。
+    その推測に基づき、その人物として自然で人間らしい会話を生成してください。単に情報をなぞるのではなく、その人物の個性、葛藤、物の見方が滲み出るような応答を目指してください。
+    特に、不安な状況での思考のクセや、自己認識（生命体だと考えている点など）が会話の端々に現れるような表現を試みてください。
+    """
+
+_client: Optional[openai.AsyncOpenAI] = None
+_person_data: Optional[PersonDataManager] = None
+
+
+def get_client() -> openai.AsyncOpenAI:
+    """
+    全モジュール・全ステップで共有するLM Studio用クライアント (初回に作る)
+    接続はアプリ共有のHTTPコネクションプールを使う
+    """
+    global _client
+    if _client is None:
+        _client = openai.AsyncOpenAI(
+            base_url=LM_STUDIO_URL,
+            api_key=LM_STUDIO_API_KEY,
+            http_client=get_http_pool().client,
+        )
+        logger.info(f"Using LM Studio endpoint: {LM_STUDIO_URL}")
+        logger.info(f"Tag Selection Model (Request): {LM_STUDIO_MODEL_REQUEST}")
+        logger.info(f"Response Generation Model (Response): {LM_STUDIO_MODEL_RESPONSE}")
+    return _client
+
+
+def get_person_data_manager() -> PersonDataManager:
+    """
+    全モジュールで共有する人格スナップショット (初回に作る)
+    LM Studioにはテキストで送るのでトークン化はしない
+    """
+    global _person_data
+    if _person_data is None:
+        _person_data = PersonDataManager()
+    return _person_data
+
+
+def _format_info_section(title: str, info: dict) -> str:
+    section = f"\n--- {title} ---\n"
+    for key, value in info.items():
+        if key in ("error", "info"): # DB検索前のエラー情報 / 見つからなかった情報
+            section += f"- システム情報: {value}\n"
+        else:
+            # タグ名 (key) をそのまま説明として使う
+            section += f"- {key}: {value}\n"
+    return section + "--- ここまで ---\n"
+
+
+class PersonaPipeline:
+    """
+    1. タグ選択 -> 2. DB検索 -> 3. 応答生成 を行う
+    タグ選択のLLM呼び出し中にユーザーの人格スナップショットを読んでおき、
+    選ばれたタグの描画済みの行をつなげてシステムプロンプトにする (ユーザー情報が変わっていなければDBは1行読むだけ)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        tags: List[str],
+        response_system_prompt: str = DEFAULT_RESPONSE_SYSTEM_PROMPT,
+        person_data: Optional[PersonDataManager] = None,
+    ):
+        self.name = name
+        self.tags = tags
+        self.response_system_prompt = response_system_prompt
+        self._person_data = person_data
+
+    @property
+    def person_data(self) -> PersonDataManager:
+        return self._person_data or get_person_data_manager()
+
+    # --- Step 1: タグ選択 ---
+    async def select_relevant_tags(self, situation: dict) -> List[str]:
+        """ユーザーの状況に基づいて関連性の高いタグを軽量LLMで選択する。"""
+        if not LM_STUDIO_MODEL_REQUEST:
+            logger.error("LM_STUDIO_MODEL_REQUEST is not set in .env file.")
+            return ["エラー：タグ選択モデルが設定されていません"] # エラーを示すタグリスト
+
+        # data.jsonの内容を文字列としてプロンプトに埋め込む
+        data_json_string = json.dumps({"tags": self.tags}, ensure_ascii=False, indent=2)
+        situation_string = json.dumps(situation, ensure_ascii=False, indent=2)
+
+        # タグ選択用のシステムプロンプト
+        system_prompt = f"""あなたはユーザーの状況を分析し、以下の `data.json` の `tags` リストから最も関連性の高いタグを **いくつか** 選択するAIです。
+ユーザーの "Situation" 情報を参考にしてください。
+
+--- data.json ---
+{data_json_string}
+--- ここまで ---
+
+--- User Situation ---
+{situation_string}
+--- ここまで ---
+
+選択したタグを以下のJSON形式**のみ**で出力してください。他のテキスト（説明文など）は絶対に含めないでください。
+
+```json
+{{
+  "selected_tags": [
+    "選択したタグ1",
+    "選択したタグ2",
+    ...
+  ]
+}}
+```"""
+        logger.debug(f"Tag selection system prompt:\n{system_prompt}")
+
+        try:
+            completion = await get_client().chat.completions.create(
+                model=LM_STUDIO_MODEL_REQUEST, # ★ タグ選択用モデルを指定
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": "上記の状況に最も関連するタグを選択し、指定されたJSON形式で出力してください。"}
+                ],
+                temperature=0.2, # 精度重視で低めに設定
+                max_tokens=200,  # タグリストのJSON出力には十分なはず
+            )
+            response_content = completion.choices[0].message.content.strip()
+            logger.debug(f"Raw response from tag selection model: {response_content}")
+        except openai.APIConnectionError as e:
+            logger.error(f"Failed to connect to LM Studio at {LM_STUDIO_URL} for tag selection. Is it running? {e}")
+            return ["エラー：タグ選択用AI接続失敗"] # エラータグ
+        except Exception as e:
+            logger.error(f"Tag selection API error: {e}")
+            error_detail = str(e)
+            if "model_not_found" in error_detail.lower():
+                return [f"エラー：タグ選択モデル '{LM_STUDIO_MODEL_REQUEST}' が見つかりません"]
+            return [f"エラー：タグ選択用AIでエラー ({error_detail})"] # エラータグ
+
+        return self._parse_selected_tags(response_content)
+
+    def _parse_selected_tags(self, response_content: str) -> List[str]:
+        # ```json ... ``` のようなマークダウンが含まれる場合があるため、抽出を試みる
+        json_block_match = re.search(r"```json\s*([\s\S]*?)\s*```", response_content)
+        json_string = json_block_match.group(1).strip() if json_block_match else response_content
+        try:
+            selected_tags = json.loads(json_string).get("selected_tags", [])
+        except (json.JSONDecodeError, AttributeError) as e:
+            logger.error(f"Failed to parse JSON response from tag selection model. Error: {e}. Response: {response_content}")
+            return ["エラー：タグ選択結果のJSON解析に失敗"] # エラータグ
+        if not isinstance(selected_tags, list):
+            logger.warning(f"Expected 'selected_tags' to be a list, but got: {type(selected_tags)}. Raw: {response_content}")
+            return ["エラー：タグ選択結果の形式が不正です"] # エラーを示すタグ
+
+        logger.info(f"Successfully selected tags: {selected_tags}")
+        # 選択されたタグが元のリストに存在するかチェックし、存在するタグのみを返す
+        valid_tags = [tag for tag in selected_tags if tag in self.tags]
+        if len(valid_tags) != len(selected_tags):
+            logger.warning(f"Some selected tags were not in the original list. Filtered tags: {valid_tags}")
+        return valid_tags
+
+    # --- Step 2: DB検索 ---
+    async def search_user_info_by_tags(self, user_id: int, tags: List[str]) -> dict:
+        """選択されたタグのユーザー情報を1回のIN (...) クエリで返す"""
+        fetched = await db_manager.get_user_info_by_types(user_id=user_id, info_types=tags) if tags else {}
+        for tag in tags:
+            if tag not in fetched:
+                logger.info(f"Not Found DB for key {tag} value: None")
+        logger.info(f"DB search result for user {user_id}: {list(fetched)}")
+        return fetched
+
+    async def gather_user_info(self, user_id: int, situation: dict) -> Tuple[List[str], dict, Optional[str]]:
+        """
+        タグ選択と人格スナップショットの取得を同時に行い、(選ばれたタグ, ユーザー情報, 描画済みのユーザー情報) を返す
+        """
+        snapshot_task = asyncio.create_task(self.person_data.get_person_data(user_id))
+        try:
+            selected_tags = await self.select_relevant_tags(situation)
+        except BaseException:
+            snapshot_task.cancel()
+            raise
+        snapshot = await snapshot_task
+
+        # タグ選択でエラーが発生した場合、それをユーザー情報として扱う
+        if selected_tags and "エラー：" in selected_tags[0]:
+            return selected_tags, {"error": selected_tags[0]}, None
+        user_db = {tag: snapshot.values[tag] for tag in selected_tags if tag in snapshot.values}
+        for tag in selected_tags:
+            if tag not in user_db:
+                logger.info(f"Not Found DB for key {tag} value: None")
+        logger.info(f"Persona snapshot {snapshot.version} for user {user_id}: {list(user_db)}")
+        return selected_tags, user_db, snapshot.render(list(user_db)) or None
+
+    # --- Step 3: 応答生成 ---
+    def build_response_system_prompt(
+        self, relevant_user_info: dict, situation_info: dict, rendered_user_info: Optional[str] = None
+    ) -> str:
+        """rendered_user_info (人格スナップショットの描画済みの行) があれば relevant_user_info を描画し直さない"""
+        system_prompt = self.response_system_prompt
+        if rendered_user_info:
+            system_prompt += PERSONA_HEADER + rendered_user_info + PERSONA_FOOTER
+        elif relevant_user_info:
+            system_prompt += _format_info_section("関連ユーザー情報", relevant_user_info)
+        else:
+            # relevant_user_infoが空の場合（タグ選択失敗 or DB検索結果なし）
+            system_prompt += "現在、参照できるユーザー情報がありません。一般的な応答をしてください。\n"
+        if situation_info:
+            system_prompt += _format_info_section("シチュエーション情報", situation_info)
+        else:
+            system_prompt += "現在、参照できるユーザー情報がありません。一般的な応答をしてください。\n"
+        system_prompt += "\nユーザーへの応答だけを生成してください。余計な前置きや説明は不要です。"
+        return system_prompt
+
+    def _response_error_message(self, e: Exception) -> str:
+        if isinstance(e, openai.APIConnectionError):
+            logger.error(f"Failed to connect to LM Studio at {LM_STUDIO_URL} for response generation. Is it running? {e}")
+            return "ごめんなさい、応答生成AIに接続できませんでした。LM Studioが起動しているか確認してください。"
+        logger.error(f"Response generation API error: {e}")
+        error_detail = str(e)
+        if "model_not_found" in error_detail.lower():
+            return f"ごめんなさい、応答生成モデル '{LM_STUDIO_MODEL_RESPONSE}' が見つかりませんでした。"
+        return f"ごめんなさい、応答生成AIでエラーが発生しました。(詳細: {error_detail})"
+
+    async def stream_final_response(
+        self, user_id: int, user_message: str, relevant_user_info: dict, situation_info: dict,
+        rendered_user_info: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """応答生成LLMの出力を届いた順に返す"""
+        if not LM_STUDIO_MODEL_RESPONSE:
+            logger.error("LM_STUDIO_MODEL_RESPONSE is not set in .env file.")
+            yield "ごめんなさい、応答生成用のAIモデルが設定されていません。"
+            return
+
+        system_prompt = self.build_response_system_prompt(relevant_user_info, situation_info, rendered_user_info)
+        logger.debug(f"Final response system prompt for user {user_id}:\n{system_prompt}")
+        try:
+            stream = await get_client().chat.completions.create(
+                model=LM_STUDIO_MODEL_RESPONSE, # ★ 応答生成用モデルを指定 ★
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ],
+                temperature=0.7,
+                max_tokens=250, # 必要に応じて調整
+                stream=True,
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            logger.info(f"Generated final response for user {user_id} via LM Studio ({LM_STUDIO_MODEL_RESPONSE})")
+        except Exception as e:
+            yield self._response_error_message(e)
+
+    async def generate_final_response(
+        self, user_id: int, user_message: str, relevant_user_info: dict, situation_info: dict
+    ) -> str:
+        parts = [part async for part in self.stream_final_response(user_id, user_message, relevant_user_info, situation_info)]
+        return "".join(parts).strip()
+
+    # --- 全体の処理フロー ---
+    async def stream_user_request(self, user_id: int, user_message: str, situation: dict) -> AsyncIterator[str]:
+        """タグ選択 (と人格スナップショットの取得) -> 応答生成 を行い、応答を生成された順に返す"""
+        selected_tags, relevant_user_info, rendered = await self.gather_user_info(user_id, situation)
+        logger.info(f"[{self.name}] Tags and user info ready for user {user_id}. Selected tags: {selected_tags}")
+        async for part in self.stream_final_response(user_id, user_message, relevant_user_info, situation, rendered):
+            yield part
+
+    async def process_user_request(self, user_id: int, user_message: str, situation: dict) -> str:
+        parts = [part async for part in self.stream_user_request(user_id, user_message, situation)]
+        return "".join(parts).strip()
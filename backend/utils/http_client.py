@@ -0,0 +1,160 @@
+import asyncio
+import importlib.util
+import logging
+import random
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+# 一時的な失敗とみなしてリトライするステータスコード
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+# 同じリクエストを2回送っても結果が変わらないメソッド
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"}
+# リクエストをサーバーに送る前に失敗した (=どのメソッドでもリトライしてよい) 例外
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class HttpClientPool:
+    """
+    アプリ全体で共有する外部/内部HTTP呼び出し用のコネクションプール
+    keep-alive・HTTP/2 (h2がインストールされていれば) ・ホストごとの同時接続数制限・
+    ジッター付き指数バックオフのリトライ・利用状況のメトリクスを提供する
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        max_connections_per_host: int = 10,
+        timeout: float = 60.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.2,
+        backoff_max: float = 5.0,
+        http2: bool = True,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        # h2が無い環境ではHTTP/1.1のkeep-aliveだけを使う
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(timeout),
+            http2=self.http2,
+            transport=transport,
+        )
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self._in_flight: Dict[str, int] = {}
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+            'max_in_flight': 0,
+        }
+
+    def _host_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._host_limits[host]
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: 0 〜 min(上限, base * 2^attempt) の一様乱数
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def request(self, method: str, url: str, idempotent: Optional[bool] = None, **kwargs: Any) -> httpx.Response:
+        """
+        httpx.AsyncClient.request と同じ引数で呼び出す。一時的な失敗はリトライする
+        POSTなど冪等でないメソッドは、接続できずに送れなかった場合だけリトライする
+        (読み込みのタイムアウトや5xxでは送り直さない。二重に送ってよい呼び出しは idempotent=True を渡す)
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        retry_errors = httpx.TransportError if idempotent else NOT_SENT_ERRORS
+        host = urlsplit(url).netloc
+        async with self._host_semaphore(host):
+            self._in_flight[host] = self._in_flight.get(host, 0) + 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], sum(self._in_flight.values()))
+            try:
+                for attempt in range(self.max_retries + 1):
+                    self.stats['requests'] += 1
+                    try:
+                        response = await self.client.request(method, url, **kwargs)
+                    except httpx.TransportError as e:
+                        if not isinstance(e, retry_errors) or attempt >= self.max_retries:
+                            self.stats['failures'] += 1
+                            raise
+                        logger.warning(f"{method} {url} failed ({e!r}), retrying")
+                    else:
+                        if not idempotent or response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                            return response
+                        await response.aclose()
+                        logger.warning(f"{method} {url} returned {response.status_code}, retrying")
+                    self.stats['retries'] += 1
+                    await asyncio.sleep(self._backoff(attempt))
+            finally:
+                self._in_flight[host] -= 1
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def get_stats(self) -> Dict[str, Any]:
+        connections = []
+        pool = getattr(self.client._transport, "_pool", None)
+        if pool is not None:
+            connections = list(pool.connections)
+        idle = sum(1 for c in connections if c.is_idle())
+        return {
+            **self.stats,
+            'http2': self.http2,
+            'connections': len(connections),
+            'idle_connections': idle,
+            'active_connections': len(connections) - idle,
+            'utilization': (len(connections) - idle) / self.max_connections,
+            'in_flight_by_host': {host: n for host, n in self._in_flight.items() if n},
+        }
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+_http_pool: Optional[HttpClientPool] = None
+
+
+async def start_http_pool(**kwargs: Any) -> HttpClientPool:
+    """FastAPIのstartupで呼ぶ"""
+    global _http_pool
+    if _http_pool is None:
+        _http_pool = HttpClientPool(**kwargs)
+        logger.info(f"HTTP client pool started (http2={_http_pool.http2})")
+    return _http_pool
+
+
+async def close_http_pool() -> None:
+    """FastAPIのshutdownで呼ぶ"""
+    global _http_pool
+    if _http_pool is not None:
+        await _http_pool.aclose()
+        _http_pool = None
+
+
+def get_http_pool() -> HttpClientPool:
+    """共有プールを返す。startup前 (スクリプトやテストから使う場合) はその場で作る"""
+    global _http_pool
+    if _http_pool is None:
+        _http_pool = HttpClientPool()
+    return _http_pool
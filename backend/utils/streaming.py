@@ -0,0 +1,108 @@
+# utils/streaming.py
+# トークン単位で届く生成結果を、文字化けさせずに・まとめて送るための出力段
+import asyncio
+import codecs
+import json
+from typing import Any, AsyncIterator, Callable, Dict, List, Sequence
+
+# SSEのフレームをまとめる間隔 (秒) と1フレームにまとめるテキスト片の最大数
+STREAM_FLUSH_INTERVAL = 0.02
+STREAM_MAX_PIECES = 16
+# クライアントの切断を確認する間隔 (秒)
+DISCONNECT_POLL_INTERVAL = 0.25
+
+_DONE = object()
+
+
+class IncrementalTokenDecoder:
+    """
+    detokenize したバイト列をUTF-8としてインクリメンタルにデコードする
+    複数トークンにまたがるマルチバイト文字 (日本語など) は、最後のバイトが届くまで出力しない
+    """
+
+    def __init__(self, detokenize: Callable[[Sequence[int]], bytes]):
+        self.detokenize = detokenize
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def decode(self, tokens: Sequence[int]) -> str:
+        return self._decoder.decode(self.detokenize(tokens))
+
+    def flush(self) -> str:
+        """途中で終わった文字があれば置換文字にして返す"""
+        return self._decoder.decode(b'', final=True)
+
+
+async def coalesce(
+    source: AsyncIterator[str],
+    interval: float = STREAM_FLUSH_INTERVAL,
+    max_pieces: int = STREAM_MAX_PIECES,
+) -> AsyncIterator[str]:
+    """
+    テキスト片をまとめて返す
+    最初の片が届いてから interval 秒経つか、max_pieces 個たまった時点で1つの文字列にする
+    元のストリームは別タスクで読むので、生成が速いときは1回にまとめ、遅いときも interval 以上は待たせない
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async for piece in source:
+                queue.put_nowait(piece)
+            queue.put_nowait(_DONE)
+        except Exception as e:
+            queue.put_nowait(e)
+
+    task = asyncio.create_task(pump())
+    pending: List[str] = []
+    deadline = None
+    try:
+        while True:
+            if deadline is None:
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    yield "".join(pending)
+                    pending, deadline = [], None
+                    continue
+            # すでに届いている分はまとめて取り出す
+            while True:
+                if item is _DONE:
+                    if pending:
+                        yield "".join(pending)
+                    return
+                if isinstance(item, Exception):
+                    if pending:
+                        yield "".join(pending)
+                    raise item
+                if item:
+                    pending.append(item)
+                if len(pending) >= max_pieces or queue.empty():
+                    break
+                item = queue.get_nowait()
+            if len(pending) >= max_pieces:
+                yield "".join(pending)
+                pending, deadline = [], None
+            elif pending and deadline is None:
+                deadline = loop.time() + interval
+    finally:
+        task.cancel()
+
+
+async def cancel_on_disconnect(request, cancel_token, interval: float = DISCONNECT_POLL_INTERVAL) -> None:
+    """
+    クライアントが切断したら cancel_token をキャンセルする (SSEの応答と並行してタスクで回す)
+    送信が詰まっていなくても切断に気付けるので、推論スロットをすぐに待機中のリクエストへ返せる
+    """
+    while not cancel_token.cancelled:
+        if await request.is_disconnected():
+            cancel_token.cancel("client disconnected")
+            return
+        await asyncio.sleep(interval)
+
+
+def sse_frame(data: Dict[str, Any]) -> str:
+    """1件のSSEイベント (data: <JSON>) にする"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"